@@ -611,11 +611,19 @@ class UserGroup(OwnerUserMixin):
         return self.members.filter(user=user).exists()
 
     def add_user(self, user) -> UserGroupMember:
+        from establishment.funnel.permission_checking import invalidate_subscription_decisions
+
         group_member, created = UserGroupMember.objects.get_or_create(user=user, group=self)
+        if created:
+            invalidate_subscription_decisions(user.id)
         return group_member
 
     def remove_user(self, user):
-        return self.members.filter(user=user).delete()
+        from establishment.funnel.permission_checking import invalidate_subscription_decisions
+
+        result = self.members.filter(user=user).delete()
+        invalidate_subscription_decisions(user.id)
+        return result
 
     def add_to_state(self, state, user=None):
         state.add(self)
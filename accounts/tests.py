@@ -0,0 +1,88 @@
+import re
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, RequestFactory
+
+from establishment.accounts.models import UserGroup
+from establishment.accounts.views import change_user_group
+from establishment.funnel.permission_checking import user_can_subscribe_to_stream, invalidate_subscription_decisions
+from establishment.funnel.stream import register_stream_handler, STREAM_HANDLERS, STREAM_HANDLER_PREFIX_INDEX
+
+
+class UserGroupStreamHandler(object):
+    """
+    Stream handler for the tests, that lets only the members of a group subscribe to its stream
+    """
+    stream_name_prefix = "test-user-group-"
+    stream_name_pattern = re.compile(r"^test-user-group-(?P<group_id>\d+)$")
+
+    @classmethod
+    def parse_stream_name(cls, stream_name):
+        match = cls.stream_name_pattern.match(stream_name)
+        return match.groupdict() if match else None
+
+    @classmethod
+    def can_subscribe(cls, user, stream_name, stream_params=None):
+        group = UserGroup.get_group_by_id(int(stream_params["group_id"]))
+        if group.has_user(user):
+            return True, "OK"
+        return False, "Not a member"
+
+    @classmethod
+    def guest_can_subscribe(cls, stream_name, stream_params=None):
+        return False, "Not a member"
+
+
+class UserGroupSubscriptionTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        register_stream_handler(UserGroupStreamHandler)
+
+    @classmethod
+    def tearDownClass(cls):
+        STREAM_HANDLERS.remove(UserGroupStreamHandler)
+        for prefix_length, handlers_by_prefix in STREAM_HANDLER_PREFIX_INDEX:
+            if UserGroupStreamHandler.stream_name_prefix in handlers_by_prefix:
+                handlers_by_prefix[UserGroupStreamHandler.stream_name_prefix].remove(UserGroupStreamHandler)
+        super().tearDownClass()
+
+    def setUp(self):
+        user_manager = get_user_model().objects
+        self.owner = user_manager.create(email="owner@example.com")
+        self.user = user_manager.create(email="member@example.com")
+        self.group = UserGroup.objects.create(name="Test group", owner=self.owner)
+        self.stream_name = "test-user-group-" + str(self.group.id)
+        invalidate_subscription_decisions(self.user.id)
+
+    def can_subscribe(self) -> bool:
+        return user_can_subscribe_to_stream(self.user, self.stream_name)[0]
+
+    def change_user_group(self, action: str):
+        request = RequestFactory().post("/", {"groupId": self.group.id, "userId": self.user.id, "action": action},
+                                        HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        request.user = self.owner
+        change_user_group(request)
+
+    def test_group_methods_take_effect_immediately(self):
+        self.assertFalse(self.can_subscribe())
+        self.group.add_user(self.user)
+        self.assertTrue(self.can_subscribe())
+        self.group.remove_user(self.user)
+        self.assertFalse(self.can_subscribe())
+
+    def test_change_user_group_takes_effect_immediately(self):
+        # The first check caches the denial
+        self.assertFalse(self.can_subscribe())
+        self.change_user_group("add")
+        self.assertTrue(self.can_subscribe())
+        self.change_user_group("remove")
+        self.assertFalse(self.can_subscribe())
+
+    def test_social_group_add_user_takes_effect_immediately(self):
+        from establishment.social.models import SocialGroup
+
+        social_group = SocialGroup.objects.create(owner=self.owner, group=self.group, url_name="test-group")
+        self.assertFalse(self.can_subscribe())
+        social_group.add_user(self.user)
+        self.assertTrue(self.can_subscribe())
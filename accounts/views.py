@@ -11,6 +11,7 @@ from django.http import HttpResponseRedirect
 from django.urls import reverse
 from django.utils.http import base36_to_int, int_to_base36
 
+from establishment.funnel.permission_checking import invalidate_subscription_decisions
 from establishment.utils.errors_deprecated import BaseError
 from establishment.webapp.base_views import login_required, login_required_ajax, ajax_required, global_renderer
 from establishment.webapp.base_views import single_page_app
@@ -470,7 +471,10 @@ def change_user_group(request):
     action = request.POST["action"]
     if action == "remove":
         UserGroupMember.objects.filter(user_id=user_id, group_id=group_id).delete()
+        invalidate_subscription_decisions(user_id)
     elif action == "add":
         group_member, created = UserGroupMember.objects.get_or_create(user_id=user_id, group_id=group_id)
+        if created:
+            invalidate_subscription_decisions(user_id)
         state.add(group_member)
     return state
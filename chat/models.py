@@ -11,7 +11,7 @@ from establishment.chat.errors import ChatError
 from establishment.utils.errors import APIError
 from establishment.utils.errors_deprecated import BaseError
 from establishment.funnel.nodews_meta import NodeWSMeta
-from establishment.funnel.stream import register_stream_handler, StreamObjectMixin
+from establishment.funnel.stream import register_stream_handler, StreamObjectMixin, StreamParams
 from establishment.utils.state import State
 
 
@@ -352,7 +352,8 @@ class GroupChat(StreamObjectMixin):
     group = models.ForeignKey("accounts.UserGroup", on_delete=models.CASCADE, null=True, blank=True)
     max_message_size = models.IntegerField(default=4096)
 
-    stream_name_pattern = re.compile(r"messagethread-groupchat-(\d+)-m=(\d+)")
+    stream_name_prefix = "messagethread-groupchat-"
+    stream_name_pattern = re.compile(r"messagethread-groupchat-(?P<group_chat_id>\d+)-m=(?P<message_thread_id>\d+)")
 
     class Meta:
         db_table = "GroupChat"
@@ -377,23 +378,21 @@ class GroupChat(StreamObjectMixin):
         return group_chat
 
     @classmethod
-    def matches_stream_name(cls, stream_name: str) -> bool:
-        return cls.stream_name_pattern.match(stream_name) is not None
-
-    @classmethod
-    def can_subscribe(cls, user, stream_name: str) -> tuple[bool, str]:
-        result, reason = cls.guest_can_subscribe(stream_name)
+    def can_subscribe(cls, user, stream_name: str, stream_params: Optional[StreamParams] = None) -> tuple[bool, str]:
+        result, reason = cls.guest_can_subscribe(stream_name, stream_params)
         if (user is None) or (result is True):
             return result, reason
         return False, "DAFUQ?!"
 
     @classmethod
-    def guest_can_subscribe(cls, stream_name: str) -> tuple[bool, str]:
-        return cls.matches_stream_name(stream_name), "It matches stream name so should be just fine!"
+    def guest_can_subscribe(cls, stream_name: str, stream_params: Optional[StreamParams] = None) -> tuple[bool, str]:
+        if stream_params is None:
+            stream_params = cls.parse_stream_name(stream_name)
+        return stream_params is not None, "It matches stream name so should be just fine!"
 
     @classmethod
     def get_message_thread_id(cls, stream_name):
-        return int(cls.stream_name_pattern.split(stream_name)[2])
+        return int(cls.parse_stream_name(stream_name)["message_thread_id"])
 
     def can_post(self, user, message: str) -> tuple[bool, bool | APIError]:
         if user.chat_muted:
@@ -67,10 +67,7 @@ class EmailGateway(StreamObjectMixin):
         if extra:
             event.update(extra)
         stream_name = "admin-email-manager"
-        RedisStreamPublisher.publish_to_stream(stream_name, event)
-        if extra_stream_names:
-            for extra_stream_name in extra_stream_names:
-                RedisStreamPublisher.publish_to_stream(extra_stream_name, event)
+        RedisStreamPublisher.publish_to_streams([stream_name] + list(extra_stream_names or []), event)
 
     def to_json(self):
         return {
@@ -121,10 +118,7 @@ class EmailCampaign(StreamObjectMixin):
         if extra:
             event.update(extra)
         stream_name = "admin-email-manager"
-        RedisStreamPublisher.publish_to_stream(stream_name, event)
-        if extra_stream_names:
-            for extra_stream_name in extra_stream_names:
-                RedisStreamPublisher.publish_to_stream(extra_stream_name, event)
+        RedisStreamPublisher.publish_to_streams([stream_name] + list(extra_stream_names or []), event)
 
     def to_json(self):
         return {
@@ -185,10 +179,7 @@ class EmailTemplate(StreamObjectMixin):
         if extra:
             event.update(extra)
         stream_name = "admin-email-manager"
-        RedisStreamPublisher.publish_to_stream(stream_name, event)
-        if extra_stream_names:
-            for extra_stream_name in extra_stream_names:
-                RedisStreamPublisher.publish_to_stream(extra_stream_name, event)
+        RedisStreamPublisher.publish_to_streams([stream_name] + list(extra_stream_names or []), event)
 
     def send_to_user(self, receiver, context_dict={}, clear_existing_status=False):
         from django.template import Context, Template
@@ -300,10 +291,7 @@ class EmailStatus(StreamObjectMixin):
         if extra:
             event.update(extra)
         stream_name = "admin-email-manager"
-        RedisStreamPublisher.publish_to_stream(stream_name, event)
-        if extra_stream_names:
-            for extra_stream_name in extra_stream_names:
-                RedisStreamPublisher.publish_to_stream(extra_stream_name, event)
+        RedisStreamPublisher.publish_to_streams([stream_name] + list(extra_stream_names or []), event)
 
     def get_receiver_id(self):
         if self.get_receiver_type() == "user":
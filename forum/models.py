@@ -14,7 +14,8 @@ class Forum(StreamObjectMixin):
     name = models.CharField(max_length=256)
     parent = models.ForeignKey("Forum", on_delete=models.PROTECT, related_name="sub_forums", null=True, blank=True)
 
-    stream_name_pattern = re.compile(r"forum-(\d+)")
+    stream_name_prefix = "forum-"
+    stream_name_pattern = re.compile(r"forum-(?P<forum_id>\d+)")
 
     class Meta:
         db_table = "Forum"
@@ -27,19 +28,17 @@ class Forum(StreamObjectMixin):
         return "forum-" + str(self.id)
 
     @classmethod
-    def matches_stream_name(cls, stream_name):
-        return cls.stream_name_pattern.match(stream_name) is not None
-
-    @classmethod
-    def can_subscribe(cls, user, stream_name):
-        result, reason = cls.guest_can_subscribe(stream_name)
+    def can_subscribe(cls, user, stream_name, stream_params=None):
+        result, reason = cls.guest_can_subscribe(stream_name, stream_params)
         if (user is None) or (result is True):
             return result, reason
         return False, "DAFUQ?!"
 
     @classmethod
-    def guest_can_subscribe(cls, stream_name):
-        return cls.matches_stream_name(stream_name), "It matches stream name so should be just fine!"
+    def guest_can_subscribe(cls, stream_name, stream_params=None):
+        if stream_params is None:
+            stream_params = cls.parse_stream_name(stream_name)
+        return stream_params is not None, "It matches stream name so should be just fine!"
 
     def to_json(self):
         return {
@@ -70,7 +69,8 @@ class ForumThread(StreamObjectMixin):
     hidden = models.BooleanField(default=False)
     pinned_index = models.IntegerField(blank=True, null=True)
 
-    stream_name_pattern = re.compile(r"messagethread-forumthread-(\d+)-m=(\d+)")
+    stream_name_prefix = "messagethread-forumthread-"
+    stream_name_pattern = re.compile(r"messagethread-forumthread-(?P<forum_thread_id>\d+)-m=(?P<message_thread_id>\d+)")
 
     class Meta:
         db_table = "ForumThread"
@@ -106,19 +106,17 @@ class ForumThread(StreamObjectMixin):
         return forum_thread
 
     @classmethod
-    def matches_stream_name(cls, stream_name):
-        return cls.stream_name_pattern.match(stream_name)
-
-    @classmethod
-    def can_subscribe(cls, user, stream_name):
-        result, reason = cls.guest_can_subscribe(stream_name)
+    def can_subscribe(cls, user, stream_name, stream_params=None):
+        result, reason = cls.guest_can_subscribe(stream_name, stream_params)
         if (user is None) or (result is True):
             return result, reason
         return False, "DAFUQ?!"
 
     @classmethod
-    def guest_can_subscribe(cls, stream_name):
-        return cls.matches_stream_name(stream_name), "It matches stream name so should be just fine!"
+    def guest_can_subscribe(cls, stream_name, stream_params=None):
+        if stream_params is None:
+            stream_params = cls.parse_stream_name(stream_name)
+        return stream_params is not None, "It matches stream name so should be just fine!"
 
     def can_post(self, user, message):
         if user.chat_muted:
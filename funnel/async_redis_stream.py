@@ -0,0 +1,141 @@
+import asyncio
+import json
+import weakref
+from typing import Any, Optional
+
+from redis.asyncio import Redis as AsyncRedis, ConnectionPool as AsyncConnectionPool
+from redis.commands.core import AsyncScript
+from redis.exceptions import NoScriptError, ResponseError
+
+from establishment.funnel.encoder import StreamJSONEncoder
+from establishment.funnel.redis_stream import RedisStreamPublisher, StreamPersistenceBackend
+from establishment.utils.redis_connections import get_async_redis_pool
+
+
+def get_default_async_redis_connection_pool() -> AsyncConnectionPool:
+    return get_async_redis_pool("default")
+
+
+class AsyncRedisStreamPublisher(object):
+    """
+    Asyncio version of RedisStreamPublisher, with the same message format, keys and persistence backends.
+    Without an explicit connection, the global connection of the event loop that publishes is used.
+    """
+    # A client can only be used from the event loop it was first used in, so there's one per loop
+    global_connections: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def __init__(self, stream_name: str, connection: Optional[AsyncRedis] = None, persistence: bool = True,
+                 raw: bool = False, expire_time: Optional[int] = None):
+        self.connection = connection
+        self.name = stream_name
+        self.persistence = persistence
+        self.raw = raw
+        if expire_time is not None:
+            self.expire_time = expire_time
+        else:
+            self.expire_time = RedisStreamPublisher.message_timeout
+
+    async def publish(self, message: Any) -> Any:
+        return await self.publish_to_stream(self.name, message, connection=self.connection,
+                                            persistence=self.persistence, raw=self.raw, expire_time=self.expire_time)
+
+    @classmethod
+    def get_global_connection(cls) -> AsyncRedis:
+        """
+        :return: The client of the running event loop, so it must be called from a coroutine
+        """
+        loop = asyncio.get_running_loop()
+        connection = cls.global_connections.get(loop)
+        if connection is None:
+            connection = cls.global_connections[loop] = AsyncRedis(connection_pool=get_default_async_redis_connection_pool())
+        return connection
+
+    @classmethod
+    async def publish_to_stream(cls, stream_name: str, message: Any, serializer_class=StreamJSONEncoder,
+                                connection: Optional[AsyncRedis] = None, persistence: bool = True, raw: bool = False,
+                                expire_time: Optional[int] = None) -> Any:
+        if connection is None:
+            connection = cls.get_global_connection()
+        original_message = message
+        if not isinstance(message, str):
+            message = json.dumps(message, cls=serializer_class)
+        if not raw:
+            if persistence:
+                if expire_time is None:
+                    expire_time = RedisStreamPublisher.message_timeout
+                await cls.publish_persisted(connection, stream_name, message, expire_time)
+                return original_message
+            message = RedisStreamPublisher.format_message_vanilla(message)
+        await connection.publish(stream_name, message)
+        return original_message
+
+    @classmethod
+    async def get_publish_script(cls, persistence_backend: StreamPersistenceBackend,
+                                 connection: AsyncRedis) -> Optional[AsyncScript]:
+        """
+        Same as StreamPersistenceBackend.get_publish_script, but loads the script without blocking the event loop
+        """
+        if not persistence_backend.scripts_enabled():
+            return None
+        publish_scripts = persistence_backend.get_pool_publish_scripts(connection)
+        if persistence_backend not in publish_scripts:
+            publish_script = connection.register_script(persistence_backend.publish_script_source)
+            try:
+                await connection.script_load(persistence_backend.publish_script_source)
+            except ResponseError as e:
+                persistence_backend.disable_publish_script(connection, e)
+                return None
+            publish_scripts[persistence_backend] = publish_script
+        return publish_scripts[persistence_backend]
+
+    @classmethod
+    async def publish_persisted(cls, connection: AsyncRedis, stream_name: str, message: str, expire_time: int):
+        persistence_backend = RedisStreamPublisher.get_persistence_backend(stream_name)
+        publish_script = await cls.get_publish_script(persistence_backend, connection)
+        if publish_script is not None:
+            try:
+                await persistence_backend.call_publish_script(publish_script, connection, stream_name, message, expire_time)
+                return
+            except NoScriptError as e:
+                # Any other error is raised, like in the synchronous version
+                persistence_backend.disable_publish_script(connection, e)
+
+        message_id = await connection.incr(RedisStreamPublisher.get_stream_id_counter(stream_name))
+        pipe = connection.pipeline(transaction=False)
+        persistence_backend.persist(pipe, stream_name, message_id, message, expire_time)
+        pipe.publish(stream_name, RedisStreamPublisher.format_message_with_id(message, message_id))
+        await pipe.execute()
+
+
+class AsyncRedisStreamSubscriber(object):
+    """
+    Asyncio version of RedisStreamSubscriber, without an explicit connection it needs to be created from a coroutine
+    """
+    def __init__(self, connection: Optional[AsyncRedis] = None):
+        self.connection = connection or AsyncRedisStreamPublisher.get_global_connection()
+        self.subscription = self.connection.pubsub()
+
+    async def next_message(self, timeout: Optional[float] = None) -> tuple[Optional[bytes], Optional[bytes]]:
+        """
+        Wait for the next published message, or at most timeout seconds if it's not None
+        :return: A pair of the message and the stream name, or (None, None) if no message arrived
+        """
+        raw_message = await self.subscription.get_message(ignore_subscribe_messages=True, timeout=timeout)
+        if raw_message is not None and raw_message["type"] == "message":
+            return (raw_message["data"], raw_message["channel"])
+        return (None, None)
+
+    async def subscribe(self, stream_name: str) -> Any:
+        return await self.subscription.subscribe(stream_name)
+
+    async def unsubscribe(self, stream_name: str):
+        await self.subscription.unsubscribe(stream_name)
+
+    @property
+    def num_streams(self) -> int:
+        return len(self.subscription.channels)
+
+    async def close(self):
+        if self.subscription and self.subscription.subscribed:
+            await self.subscription.unsubscribe()
+        await self.subscription.reset()
@@ -1,36 +1,48 @@
+from establishment.utils.convert import memoize_key_conversion
+
 orda = ord('a')
 ordA = ord('A')
 
 
+@memoize_key_conversion
 def to_camel_case(txt: str) -> str:
+    if '_' not in txt:
+        return txt
+
     capitalise_next = False
-    new_txt = ""
+    new_chars = []
 
     for c in txt:
         if 'A' <= c <= 'Z':
-            new_txt += c
+            new_chars.append(c)
         elif capitalise_next and 'a' <= c <= 'z':
-            new_txt += chr(ord(c) - orda + ordA)
+            new_chars.append(chr(ord(c) - orda + ordA))
             capitalise_next = False
         elif c == '_':
             capitalise_next = True
         else:
             capitalise_next = False
-            new_txt += c
+            new_chars.append(c)
 
-    return new_txt
+    return "".join(new_chars)
 
 
+@memoize_key_conversion
 def to_underscore_case(txt):
-    new_txt = ""
+    if txt.islower():
+        # No upper case letter to convert
+        return txt
+
+    new_chars = []
 
     for c in txt:
         if 'A' <= c <= 'Z':
-            new_txt += "_" + chr(ord(c) + orda - ordA)
+            new_chars.append("_")
+            new_chars.append(chr(ord(c) + orda - ordA))
         else:
-            new_txt += c
+            new_chars.append(c)
 
-    return new_txt
+    return "".join(new_chars)
 
 
 def to_space_case(txt):
@@ -53,11 +65,7 @@ def to_space_case(txt):
 
 def from_json_dict(json_obj):
     # make all keys underscore_case
-    arg_list = dict()
-    for key in json_obj:
-        arg_list[to_underscore_case(key)] = json_obj[key]
-
-    return arg_list
+    return {to_underscore_case(key): value for key, value in json_obj.items()}
 
 
 def update_dict(target, *args):
@@ -72,12 +80,6 @@ def update_dict(target, *args):
 
 
 def to_json_dict(*args, **kwargs):
-    if len(args) > 0:
-        for arg in args:
-            update_dict(kwargs, arg)
-    result = dict()
-    for key, value in kwargs.items():
-        json_like_key = to_camel_case(key)
-        json_like_value = value
-        result[json_like_key] = json_like_value
-    return result
+    for arg in args:
+        update_dict(kwargs, arg)
+    return {to_camel_case(key): value for key, value in kwargs.items()}
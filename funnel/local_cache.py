@@ -0,0 +1,155 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+from establishment.utils.logging import logger
+
+LOCAL_CACHE_INVALIDATION_STREAM = "local-cache-invalidation"
+
+
+class LocalLRUCache(object):
+    """
+    In-process LRU cache, bounded in size and entry age, meant to sit in front of redis for hot, tiny values.
+    The cached values are shared between callers, so they must not be mutated.
+    Invalidations are broadcast over a redis stream, so that all the processes drop their stale entries.
+    """
+    all_caches: dict[str, "LocalLRUCache"] = {}
+    all_caches_lock = threading.Lock()
+    invalidation_subscribed = False
+
+    def __init__(self, name: str, max_size: int = 1024, ttl: float = 60.0, max_tracked_keys: Optional[int] = None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[Any, float]] = OrderedDict()
+        self.lock = threading.Lock()
+        # Per key [hits, misses], kept for a bounded number of recently used keys
+        self.max_tracked_keys = max_tracked_keys or 2 * max_size
+        self.key_stats: OrderedDict[str, list[int]] = OrderedDict()
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+        self.num_invalidations = 0
+        self.register()
+
+    def register(self):
+        from establishment.services.status import ServiceStatus
+
+        with LocalLRUCache.all_caches_lock:
+            LocalLRUCache.all_caches[self.name] = self
+        ServiceStatus.add_stats_provider("localCaches", LocalLRUCache.get_all_stats)
+
+    def update_key_stats(self, key: str, hit: bool):
+        key_stats = self.key_stats.get(key)
+        if key_stats is None:
+            key_stats = self.key_stats[key] = [0, 0]
+            if len(self.key_stats) > self.max_tracked_keys:
+                self.key_stats.popitem(last=False)
+        else:
+            self.key_stats.move_to_end(key)
+        key_stats[0 if hit else 1] += 1
+
+    def get(self, key: str) -> tuple[bool, Any]:
+        """
+        :return: A pair of whether the key was found and its value
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] < time.time():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.num_misses += 1
+                self.update_key_stats(key, False)
+                return False, None
+            self.entries.move_to_end(key)
+            self.num_hits += 1
+            self.update_key_stats(key, True)
+            return True, entry[0]
+
+    def get_generation(self) -> int:
+        """
+        :return: A value that changes with every invalidation, to pass to set() for values computed after reading it
+        """
+        return self.num_invalidations
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None, generation: Optional[int] = None) -> bool:
+        """
+        :param generation: If given, the value is only stored if there was no invalidation since get_generation() returned it
+        :return: True if the value was stored
+        """
+        if not LocalLRUCache.invalidation_subscribed:
+            LocalLRUCache.ensure_invalidation_subscription()
+        expire_at = time.time() + (ttl if ttl is not None else self.ttl)
+        with self.lock:
+            if generation is not None and generation != self.num_invalidations:
+                return False
+            self.entries[key] = (value, expire_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.num_evictions += 1
+        return True
+
+    def delete(self, key: Optional[str] = None):
+        """
+        Drop a key from this process only, or all of them if key is None
+        """
+        with self.lock:
+            self.num_invalidations += 1
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def invalidate(self, key: Optional[str] = None):
+        """
+        Drop a key, or all of them if key is None, from this cache in all processes
+        """
+        from establishment.funnel.redis_stream import simple_stream_publish
+
+        self.delete(key)
+        simple_stream_publish(LOCAL_CACHE_INVALIDATION_STREAM, {"cache": self.name, "key": key})
+
+    def get_stats(self) -> dict[str, Any]:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.num_hits,
+                "misses": self.num_misses,
+                "evictions": self.num_evictions,
+                "invalidations": self.num_invalidations,
+                "keys": {key: {"hits": hits, "misses": misses} for key, (hits, misses) in self.key_stats.items()},
+            }
+
+    @classmethod
+    def get_all_stats(cls) -> dict[str, Any]:
+        with cls.all_caches_lock:
+            caches = list(cls.all_caches.values())
+        return {cache.name: cache.get_stats() for cache in caches}
+
+    @classmethod
+    def handle_invalidation_message(cls, message: bytes, stream_name: str):
+        try:
+            invalidation = json.loads(message)
+        except Exception:
+            logger.error("Invalid local cache invalidation message " + str(message))
+            return
+        cache = cls.all_caches.get(invalidation.get("cache"))
+        if cache is not None:
+            cache.delete(invalidation.get("key"))
+
+    @classmethod
+    def ensure_invalidation_subscription(cls):
+        """
+        Start listening to invalidations from other processes, done before the first value is cached
+        """
+        from establishment.funnel.redis_stream_hub import RedisStreamSubscriberHub
+
+        with cls.all_caches_lock:
+            if cls.invalidation_subscribed:
+                return
+            cls.invalidation_subscribed = True
+        RedisStreamSubscriberHub.get_default().subscribe(LOCAL_CACHE_INVALIDATION_STREAM, cls.handle_invalidation_message)
@@ -1,8 +1,11 @@
+import functools
+import time
+
 from django.conf import settings
-from redis import StrictRedis, ConnectionPool
 
 from establishment.misc.util import stringify, serializify
-from establishment.funnel.redis_stream import get_default_redis_connection_pool
+from establishment.utils.logging import logger
+from establishment.utils.redis_connections import get_redis
 
 REDIS_ENTRY_CONNECTIONIDS = "nodews-meta-connectionids"
 REDIS_ENTRY_USERIDS = "nodews-meta-userids"
@@ -91,7 +94,7 @@ class WSStreamData:
 class NodeWSMeta(object):
     def __init__(self, connection=None):
         if not connection:
-            connection = StrictRedis(connection_pool=get_default_redis_connection_pool())
+            connection = get_redis()
         self.connection = connection
 
     def get_all(self):
@@ -166,6 +169,108 @@ class NodeWSMeta(object):
 
         return serializify(metadata)
 
+    def get_counts(self):
+        """
+        Cheap aggregate counters for dashboards, SCARD is O(1) so this doesn't need to walk the sets
+        """
+        pipe = self.connection.pipeline(transaction=False)
+        for key in [REDIS_ENTRY_CONNECTIONIDS, REDIS_ENTRY_USERIDS, REDIS_ENTRY_STREAMS]:
+            pipe.scard(key)
+
+        num_connections, num_users, num_streams = pipe.execute()
+
+        return {
+            "connections": num_connections,
+            "users": num_users,
+            "streams": num_streams
+        }
+
+    def scan_page(self, set_key, cursor, count, queries):
+        """
+        Fetch a page of members of set_key with SSCAN, and run the queries for each of them in a single pipeline
+        :param queries: A list of (redis command, key prefix) pairs, the member is appended to the prefix
+        :return: The next cursor (0 when done), the members and for each member the list of query results
+        """
+        cursor, members = self.connection.sscan(set_key, cursor=cursor, count=count)
+        members = stringify(members)
+
+        pipe = self.connection.pipeline(transaction=False)
+        for member in members:
+            for command, key_prefix in queries:
+                getattr(pipe, command)(key_prefix + member)
+
+        result = pipe.execute() if members else []
+        num_queries = len(queries)
+        member_results = [stringify(result[index * num_queries:(index + 1) * num_queries]) for index in range(len(members))]
+
+        return int(cursor), members, member_results
+
+    def iter_connections(self, cursor=0, count=500):
+        """
+        Paginated alternative to get_all() for connections
+        :return: The next cursor (0 when done) and a list of WSConnectionData
+        """
+        cursor, connection_ids, results = self.scan_page(REDIS_ENTRY_CONNECTIONIDS, cursor, count, [
+            ("get", REDIS_ENTRY_CONNECTIONID_TO_USERID_PREFIX),
+            ("smembers", REDIS_ENTRY_CONNECTIONID_TO_STREAMS_PREFIX),
+            ("hgetall", REDIS_ENTRY_CONNECTIONID_TO_DATA_PREFIX),
+        ])
+
+        metadata = {
+            "connectionIdToUserId": {},
+            "connectionIdToStreams": {},
+            "connectionIdToData": {}
+        }
+        for connection_id, (user_id, streams, data) in zip(connection_ids, results):
+            metadata["connectionIdToUserId"][connection_id] = user_id
+            metadata["connectionIdToStreams"][connection_id] = streams
+            metadata["connectionIdToData"][connection_id] = data
+        metadata = serializify(metadata)
+
+        return cursor, [WSConnectionData(connection_id, metadata) for connection_id in connection_ids]
+
+    def iter_users(self, cursor=0, count=500):
+        """
+        Paginated alternative to get_all() for users
+        :return: The next cursor (0 when done) and a list of WSUserData
+        """
+        cursor, user_ids, results = self.scan_page(REDIS_ENTRY_USERIDS, cursor, count, [
+            ("smembers", REDIS_ENTRY_USERID_TO_CONNECTIONID_PREFIX),
+            ("smembers", REDIS_ENTRY_USERID_TO_STREAMS_PREFIX),
+        ])
+
+        metadata = {
+            "userIdToConnectionIds": {},
+            "userIdToStreams": {}
+        }
+        for user_id, (connection_ids, streams) in zip(user_ids, results):
+            metadata["userIdToConnectionIds"][user_id] = connection_ids
+            metadata["userIdToStreams"][user_id] = streams
+        metadata = serializify(metadata)
+
+        return cursor, [WSUserData(user_id, metadata) for user_id in user_ids]
+
+    def iter_streams(self, cursor=0, count=500):
+        """
+        Paginated alternative to get_all() for streams
+        :return: The next cursor (0 when done) and a list of WSStreamData
+        """
+        cursor, streams, results = self.scan_page(REDIS_ENTRY_STREAMS, cursor, count, [
+            ("smembers", REDIS_ENTRY_STREAM_TO_CONNECTIONIDS_PREFIX),
+            ("smembers", REDIS_ENTRY_STREAM_TO_USERIDS_PREFIX),
+        ])
+
+        metadata = {
+            "streamToConnectionIds": {},
+            "streamToUserIds": {}
+        }
+        for stream, (connection_ids, user_ids) in zip(streams, results):
+            metadata["streamToConnectionIds"][stream] = connection_ids
+            metadata["streamToUserIds"][stream] = user_ids
+        metadata = serializify(metadata)
+
+        return cursor, [WSStreamData(stream, metadata) for stream in streams]
+
     def get_online_users(self, stream):
         pipe = self.connection.pipeline(transaction=False)
 
@@ -222,48 +327,180 @@ class NodeWSMeta(object):
             stream.add_to_state(state)
 
     def clean_zombie_connectionid_data(self):
-        pipe = self.connection.pipeline(transaction=False)
-
-        pipe.smembers(REDIS_ENTRY_CONNECTIONIDS)
-
-        result = pipe.execute()
-
-        connection_ids = stringify(result[0])
-
-        to_delete = []
-        for connection_id_data in self.connection.scan_iter(match=REDIS_ENTRY_CONNECTIONID_TO_DATA_PREFIX+"*"):
-            connection_id_data = stringify(connection_id_data)
-            connection_id = connection_id_data[len(REDIS_ENTRY_CONNECTIONID_TO_DATA_PREFIX):]
-            if connection_id not in connection_ids:
-                to_delete.append(connection_id_data)
-        for connection_id_data in to_delete:
-            print("Deleting connection id data: " + connection_id_data)
-            self.connection.delete(connection_id_data)
+        NodeWSMetaGarbageCollector(self.connection).run_phase_to_completion("connection-data")
 
     def clean_null_stream_to_userid_counter(self):
-        stream_to_delete = []
-        for stream in self.connection.scan_iter(match=REDIS_ENTRY_STREAM_TO_USERID_CONNECTION_COUNTER_PREFIX+"*"):
-            stream = str(stream)
-            to_delete = []
-            for userid in self.connection.hscan_iter(stream):
-                userid = str(userid)
-                if str(self.connection.hget(stream, userid)) == "0":
-                    to_delete.append(userid)
-            if len(to_delete) != 0:
-                print("From \"" + stream + "\" deleting fields:")
-            for userid in to_delete:
-                print("\t\t" + userid)
-                self.connection.hdelete(stream, userid)
-            if str(self.connection.hlen(stream)) == "0":
-                stream_to_delete.append(stream)
-        for stream in stream_to_delete:
-            stream = str(stream)
-            stream = " " + stream
-            stream = stream[3:-1]
-            print("Deleting \"" + stream + "\"")
-            self.connection.delete(stream)
+        NodeWSMetaGarbageCollector(self.connection).run_phase_to_completion("stream-counters")
 
     def gc(self):
         self.clean_zombie_connectionid_data()
         self.clean_null_stream_to_userid_counter()
-        print("NodeWS Meta GC: Done!")
+        logger.info("NodeWS Meta GC: Done!")
+
+
+# Deletes the connection data hashes of the given keys whose connection id is no longer registered
+# KEYS: the registered connection ids set, followed by the connection data keys
+# ARGV: the connection data key prefix length
+# Returns the number of deleted keys
+CLEAN_CONNECTION_DATA_SCRIPT = """
+local prefix_length = tonumber(ARGV[1])
+local num_deleted = 0
+for index = 2, #KEYS do
+    local connection_id = string.sub(KEYS[index], prefix_length + 1)
+    if redis.call("SISMEMBER", KEYS[1], connection_id) == 0 then
+        num_deleted = num_deleted + redis.call("DEL", KEYS[index])
+    end
+end
+return num_deleted
+"""
+
+# Removes the users with a zero connection count from the given stream counter hashes
+# Redis deletes a hash by itself when its last field is removed
+# KEYS: the counter hash keys
+# Returns the number of deleted fields and the number of deleted keys
+CLEAN_STREAM_COUNTERS_SCRIPT = """
+local num_deleted_fields = 0
+local num_deleted_keys = 0
+for index = 1, #KEYS do
+    local counters = redis.call("HGETALL", KEYS[index])
+    for field_index = 1, #counters, 2 do
+        if tonumber(counters[field_index + 1]) == 0 then
+            num_deleted_fields = num_deleted_fields + redis.call("HDEL", KEYS[index], counters[field_index])
+        end
+    end
+    if #counters > 0 and redis.call("EXISTS", KEYS[index]) == 0 then
+        num_deleted_keys = num_deleted_keys + 1
+    end
+end
+return {num_deleted_fields, num_deleted_keys}
+"""
+
+
+class NodeWSMetaGarbageCollector(object):
+    """
+    Incremental garbage collector for the websocket node metadata. It processes one SCAN page at a time,
+    each page in a single script call, and checkpoints its cursor in redis so it can resume across ticks
+    and processes. Meant to run as a RedisScheduledJob, with a time budget per tick.
+    """
+    PHASES = ["connection-data", "stream-counters"]
+    CHECKPOINT_KEY = "nodews-meta-gc-checkpoint"
+
+    def __init__(self, connection=None, page_size=500):
+        if not connection:
+            connection = get_redis()
+        self.connection = connection
+        self.page_size = page_size
+        self.clean_connection_data_script = self.connection.register_script(CLEAN_CONNECTION_DATA_SCRIPT)
+        self.clean_stream_counters_script = self.connection.register_script(CLEAN_STREAM_COUNTERS_SCRIPT)
+
+        self.num_keys_scanned = 0
+        self.num_keys_deleted = 0
+        self.num_fields_deleted = 0
+        self.num_completed_passes = 0
+        self.last_tick_duration = 0.0
+        self.last_tick_keys_scanned_per_second = 0.0
+        self.last_tick_keys_deleted_per_second = 0.0
+
+    def get_stats(self):
+        return {
+            "keysScanned": self.num_keys_scanned,
+            "keysDeleted": self.num_keys_deleted,
+            "fieldsDeleted": self.num_fields_deleted,
+            "completedPasses": self.num_completed_passes,
+            "lastTickDuration": self.last_tick_duration,
+            "keysScannedPerSecond": self.last_tick_keys_scanned_per_second,
+            "keysDeletedPerSecond": self.last_tick_keys_deleted_per_second,
+        }
+
+    def load_checkpoint(self):
+        checkpoint = stringify(self.connection.hgetall(self.CHECKPOINT_KEY))
+        phase = checkpoint.get("phase")
+        if phase not in self.PHASES:
+            return self.PHASES[0], 0
+        return phase, int(checkpoint.get("cursor", 0))
+
+    def save_checkpoint(self, phase, cursor):
+        self.connection.hset(self.CHECKPOINT_KEY, mapping={"phase": phase, "cursor": cursor})
+
+    def process_page(self, phase, cursor):
+        """
+        :return: The next cursor of the phase, 0 if the phase is done
+        """
+        if phase == "connection-data":
+            match = REDIS_ENTRY_CONNECTIONID_TO_DATA_PREFIX + "*"
+        else:
+            match = REDIS_ENTRY_STREAM_TO_USERID_CONNECTION_COUNTER_PREFIX + "*"
+
+        cursor, keys = self.connection.scan(cursor=cursor, match=match, count=self.page_size)
+        keys = stringify(keys)
+        self.num_keys_scanned += len(keys)
+
+        if keys:
+            if phase == "connection-data":
+                self.num_keys_deleted += self.clean_connection_data_script(
+                    keys=[REDIS_ENTRY_CONNECTIONIDS] + keys,
+                    args=[len(REDIS_ENTRY_CONNECTIONID_TO_DATA_PREFIX)])
+            else:
+                num_deleted_fields, num_deleted_keys = self.clean_stream_counters_script(keys=keys)
+                self.num_fields_deleted += num_deleted_fields
+                self.num_keys_deleted += num_deleted_keys
+
+        return int(cursor)
+
+    def advance(self, phase, cursor):
+        """
+        Process one page and checkpoint the position
+        :return: The new phase and cursor
+        """
+        cursor = self.process_page(phase, cursor)
+        if cursor == 0:
+            phase_index = self.PHASES.index(phase) + 1
+            if phase_index == len(self.PHASES):
+                self.num_completed_passes += 1
+                phase_index = 0
+            phase = self.PHASES[phase_index]
+        self.save_checkpoint(phase, cursor)
+        return phase, cursor
+
+    def run(self, time_budget=1.0):
+        """
+        Process pages until the time budget runs out, or until a full pass over all the phases is done
+        """
+        tick_start = time.time()
+        num_keys_scanned = self.num_keys_scanned
+        num_keys_deleted = self.num_keys_deleted
+        num_completed_passes = self.num_completed_passes
+
+        phase, cursor = self.load_checkpoint()
+        while time.time() - tick_start < time_budget and self.num_completed_passes == num_completed_passes:
+            phase, cursor = self.advance(phase, cursor)
+
+        self.last_tick_duration = max(time.time() - tick_start, 1e-6)
+        self.last_tick_keys_scanned_per_second = (self.num_keys_scanned - num_keys_scanned) / self.last_tick_duration
+        self.last_tick_keys_deleted_per_second = (self.num_keys_deleted - num_keys_deleted) / self.last_tick_duration
+
+    def run_phase_to_completion(self, phase):
+        """
+        Run a full phase right away, without touching the checkpoint of the scheduled runs
+        """
+        cursor = None
+        while cursor != 0:
+            cursor = self.process_page(phase, cursor or 0)
+
+    def run_scheduled(self, redis_scheduled_job=None, time_budget=1.0):
+        self.run(time_budget)
+
+    @classmethod
+    def create_processor(cls, logger_name=None, time_interval=60, time_budget=1.0):
+        """
+        :return: A processor that runs a GC tick every time_interval seconds, in a single process of the cluster
+        """
+        from establishment.misc.command_processor import RedisScheduledJobProcessor
+        from establishment.services.status import ServiceStatus
+
+        garbage_collector = cls()
+        ServiceStatus.add_stats_provider("nodewsMetaGC", garbage_collector.get_stats)
+        return RedisScheduledJobProcessor("nodews-meta-gc",
+                                          functools.partial(garbage_collector.run_scheduled, time_budget=time_budget),
+                                          logger_name=logger_name,
+                                          time_interval=time_interval)
@@ -1,5 +1,29 @@
-from .stream import get_stream_handler, StreamPermissionResponse
+import threading
+import time
+from typing import Any, Optional
+
+from redis import StrictRedis
+from redis.commands.core import Script
+
+from .local_cache import LocalLRUCache
+from .redis_stream import redis_response_to_str
+from .stream import resolve_stream_handler, StreamPermissionResponse
 from ..accounts.models import AbstractStreamObjectUser
+from ..utils.redis_connections import get_redis
+
+
+# Stores newly computed subscription decisions, unless the user was invalidated since they were computed
+# KEYS: generation key, decisions hash key
+# ARGV: the generation read before computing the decisions, expire time, then stream name and decision pairs
+# Returns 1 if the decisions were stored
+STORE_SUBSCRIPTION_DECISIONS_SCRIPT = """
+if (redis.call("GET", KEYS[1]) or "") ~= ARGV[1] then
+    return 0
+end
+redis.call("HSET", KEYS[2], unpack(ARGV, 3))
+redis.call("EXPIRE", KEYS[2], ARGV[2])
+return 1
+"""
 
 
 def guest_can_subscribe_to_stream(stream_name: str) -> StreamPermissionResponse:
@@ -15,10 +39,13 @@ def guest_can_subscribe_to_stream(stream_name: str) -> StreamPermissionResponse:
     if stream_name == "global-events":
         return True, "Default streams"
 
-    stream_handler = get_stream_handler(stream_name)
+    stream_handler, stream_params = resolve_stream_handler(stream_name)
 
     if stream_handler:
-        can_subscribe, reason = stream_handler.guest_can_subscribe(stream_name)
+        if stream_params is not None:
+            can_subscribe, reason = stream_handler.guest_can_subscribe(stream_name, stream_params=stream_params)
+        else:
+            can_subscribe, reason = stream_handler.guest_can_subscribe(stream_name)
         if can_subscribe:
             return True, "OK"
         else:
@@ -28,16 +55,11 @@ def guest_can_subscribe_to_stream(stream_name: str) -> StreamPermissionResponse:
     return False, "No matching streams"
 
 
-def user_can_subscribe_to_stream(user: AbstractStreamObjectUser, stream_name: str) -> StreamPermissionResponse:
+def get_default_subscription_decision(user: AbstractStreamObjectUser, stream_name: str) -> Optional[StreamPermissionResponse]:
     """
-    Function to test if the current user can subscribe to a given stream
-    :param user: The user
-    :param stream_name: The stream the user wants to subscribe to
-    :return: A pair of bool and string, that mean if the user can subscribe and a reason
+    The decisions that don't need a stream handler, and so are not worth caching
+    :return: The decision, or None if the stream handler needs to be asked
     """
-    if user is None or user.is_anonymous:
-        return guest_can_subscribe_to_stream(stream_name)
-
     # Admins can subscribe to anything
     if user.is_superuser:
         return True, "Admin"
@@ -49,10 +71,25 @@ def user_can_subscribe_to_stream(user: AbstractStreamObjectUser, stream_name: st
     if stream_name == "global-events" or (user.is_authenticated and stream_name in (str(user.id), "user-" + str(user.id) + "-events")):
         return True, "Default streams"
 
-    stream_handler = get_stream_handler(stream_name)
+    return None
+
+
+def user_can_subscribe_to_stream_uncached(user: AbstractStreamObjectUser, stream_name: str) -> StreamPermissionResponse:
+    if user is None or user.is_anonymous:
+        return guest_can_subscribe_to_stream(stream_name)
+
+    default_decision = get_default_subscription_decision(user, stream_name)
+    if default_decision is not None:
+        return default_decision
+
+    stream_handler, stream_params = resolve_stream_handler(stream_name)
 
     if stream_handler:
-        can_subscribe, reason = stream_handler.can_subscribe(user, stream_name)
+        # Indexed handlers receive the already parsed stream name parameters
+        if stream_params is not None:
+            can_subscribe, reason = stream_handler.can_subscribe(user, stream_name, stream_params=stream_params)
+        else:
+            can_subscribe, reason = stream_handler.can_subscribe(user, stream_name)
         if can_subscribe:
             return True, "OK"
         else:
@@ -61,3 +98,205 @@ def user_can_subscribe_to_stream(user: AbstractStreamObjectUser, stream_name: st
 
     return False, "No matching streams"
 
+
+class SubscriptionDecisionCache(object):
+    """
+    Short-lived cache of the subscription decisions of each user, both in process and in redis.
+    In redis, there's a hash per user with the decisions for each stream, so that a user can be invalidated in one command.
+    In process, the decisions of a user are kept as a single dict value of a LocalLRUCache, that must be replaced, not mutated.
+    Every invalidation increments a per user generation, and decisions are only stored if the generation didn't change
+    while they were computed, so that a check running concurrently with an invalidation can't store stale decisions.
+    """
+    local_ttl = 2.0
+    redis_ttl = 10
+    # Needs to outlive any check that's in progress when the user is invalidated
+    generation_ttl = 24 * 60 * 60
+    local_cache: Optional[LocalLRUCache] = None
+    redis_connection: Optional[StrictRedis] = None
+    store_script: Optional[Script] = None
+    lock = threading.Lock()
+
+    # Rough stats, not synchronized
+    num_calls = 0
+    num_checks = 0
+    num_local_hits = 0
+    num_redis_hits = 0
+    num_computed = 0
+    total_time = 0.0
+    max_time = 0.0
+
+    @classmethod
+    def get_local_cache(cls) -> LocalLRUCache:
+        if cls.local_cache is None:
+            with cls.lock:
+                if cls.local_cache is None:
+                    from establishment.services.status import ServiceStatus
+
+                    cls.local_cache = LocalLRUCache("subscriptionDecisions", max_size=4096, ttl=cls.local_ttl)
+                    ServiceStatus.add_stats_provider("subscriptionDecisions", cls.get_stats)
+        return cls.local_cache
+
+    @classmethod
+    def get_redis_connection(cls) -> StrictRedis:
+        if cls.redis_connection is None:
+            cls.redis_connection = get_redis("caching")
+        return cls.redis_connection
+
+    @classmethod
+    def get_store_script(cls) -> Script:
+        if cls.store_script is None:
+            cls.store_script = cls.get_redis_connection().register_script(STORE_SUBSCRIPTION_DECISIONS_SCRIPT)
+        return cls.store_script
+
+    @staticmethod
+    def get_cache_id(user: Optional[AbstractStreamObjectUser]) -> str:
+        if user is None or user.is_anonymous:
+            return "guest"
+        return str(user.id)
+
+    @staticmethod
+    def get_redis_key(cache_id: str) -> str:
+        return "subscription-decisions-" + cache_id
+
+    @staticmethod
+    def get_generation_key(cache_id: str) -> str:
+        return "subscription-decisions-generation-" + cache_id
+
+    @staticmethod
+    def serialize_decision(decision: StreamPermissionResponse) -> str:
+        return ("1" if decision[0] else "0") + decision[1]
+
+    @staticmethod
+    def deserialize_decision(value: Any) -> StreamPermissionResponse:
+        value = redis_response_to_str(value)
+        return value[0] == "1", value[1:]
+
+    @classmethod
+    def get_decisions(cls, user: Optional[AbstractStreamObjectUser], stream_names: list[str]) -> dict[str, StreamPermissionResponse]:
+        cache_id = cls.get_cache_id(user)
+        local_cache = cls.get_local_cache()
+        local_generation = local_cache.get_generation()
+        found, local_decisions = local_cache.get(cache_id)
+        local_decisions = local_decisions if found else {}
+
+        decisions = {}
+        missing_stream_names = []
+        for stream_name in stream_names:
+            decision = local_decisions.get(stream_name)
+            if decision is not None:
+                decisions[stream_name] = decision
+            else:
+                missing_stream_names.append(stream_name)
+        cls.num_local_hits += len(decisions)
+        if not missing_stream_names:
+            return decisions
+
+        redis_key = cls.get_redis_key(cache_id)
+        generation_key = cls.get_generation_key(cache_id)
+        pipe = cls.get_redis_connection().pipeline(transaction=False)
+        pipe.get(generation_key)
+        pipe.hmget(redis_key, missing_stream_names)
+        generation, values = pipe.execute()
+
+        new_decisions = {}
+        computed_decisions = {}
+        for stream_name, value in zip(missing_stream_names, values):
+            if value is not None:
+                new_decisions[stream_name] = cls.deserialize_decision(value)
+                cls.num_redis_hits += 1
+            else:
+                computed_decisions[stream_name] = user_can_subscribe_to_stream_uncached(user, stream_name)
+                cls.num_computed += 1
+
+        decisions.update(new_decisions)
+        decisions.update(computed_decisions)
+
+        if computed_decisions:
+            args = [redis_response_to_str(generation) if generation is not None else "", cls.redis_ttl]
+            for stream_name, decision in computed_decisions.items():
+                args += [stream_name, cls.serialize_decision(decision)]
+            if not cls.get_store_script()(keys=[generation_key, redis_key], args=args):
+                # Invalidated meanwhile, the decisions are still returned, but not cached anywhere
+                return decisions
+            new_decisions.update(computed_decisions)
+
+        local_cache.set(cache_id, {**local_decisions, **new_decisions}, generation=local_generation)
+        return decisions
+
+    @classmethod
+    def invalidate(cls, user_id: int):
+        """
+        Drop the cached decisions of a user in all processes, needs to be called whenever their permissions change
+        """
+        cache_id = str(user_id)
+        generation_key = cls.get_generation_key(cache_id)
+        pipe = cls.get_redis_connection().pipeline()
+        pipe.incr(generation_key)
+        pipe.expire(generation_key, cls.generation_ttl)
+        pipe.delete(cls.get_redis_key(cache_id))
+        pipe.execute()
+        cls.get_local_cache().invalidate(cache_id)
+
+    @classmethod
+    def update_stats(cls, num_checks: int, duration: float):
+        cls.num_calls += 1
+        cls.num_checks += num_checks
+        cls.total_time += duration
+        cls.max_time = max(cls.max_time, duration)
+
+    @classmethod
+    def get_stats(cls) -> dict[str, Any]:
+        num_cached_checks = cls.num_local_hits + cls.num_redis_hits + cls.num_computed
+        return {
+            "numCalls": cls.num_calls,
+            "numChecks": cls.num_checks,
+            "numLocalHits": cls.num_local_hits,
+            "numRedisHits": cls.num_redis_hits,
+            "numComputed": cls.num_computed,
+            "hitRate": (cls.num_local_hits + cls.num_redis_hits) / num_cached_checks if num_cached_checks else 0.0,
+            "averageTime": cls.total_time / cls.num_calls if cls.num_calls else 0.0,
+            "maxTime": cls.max_time,
+        }
+
+
+def user_can_subscribe_to_streams(user: AbstractStreamObjectUser, stream_names: list[str]) -> dict[str, StreamPermissionResponse]:
+    """
+    Batch version of user_can_subscribe_to_stream, with the decisions that need a stream handler cached for a few seconds
+    :param user: The user, or None for guests
+    :param stream_names: The streams the user wants to subscribe to
+    :return: A dict from each stream name to a pair of bool and string, that mean if the user can subscribe and a reason
+    """
+    start_time = time.time()
+    decisions = {}
+    handler_stream_names = []
+    for stream_name in stream_names:
+        if user is not None and not user.is_anonymous:
+            default_decision = get_default_subscription_decision(user, stream_name)
+        elif len(stream_name) > 512:
+            default_decision = False, "Invalid stream name"
+        else:
+            default_decision = None
+        if default_decision is not None:
+            decisions[stream_name] = default_decision
+        else:
+            handler_stream_names.append(stream_name)
+
+    if handler_stream_names:
+        decisions.update(SubscriptionDecisionCache.get_decisions(user, handler_stream_names))
+
+    SubscriptionDecisionCache.update_stats(len(stream_names), time.time() - start_time)
+    return decisions
+
+
+def user_can_subscribe_to_stream(user: AbstractStreamObjectUser, stream_name: str) -> StreamPermissionResponse:
+    """
+    Function to test if the current user can subscribe to a given stream
+    :param user: The user
+    :param stream_name: The stream the user wants to subscribe to
+    :return: A pair of bool and string, that mean if the user can subscribe and a reason
+    """
+    return user_can_subscribe_to_streams(user, [stream_name])[stream_name]
+
+
+def invalidate_subscription_decisions(user_id: int):
+    SubscriptionDecisionCache.invalidate(user_id)
@@ -1,18 +1,117 @@
+import functools
+import hashlib
 import json
 import time
 import threading
+import uuid
 from collections.abc import Callable
 from typing import Union, Any, Optional
 
 from django.conf import settings
 from redis import StrictRedis, ConnectionPool
+from redis.commands.core import Script
+from redis.exceptions import NoScriptError, ResponseError
 
 from establishment.misc.util import jsonify, same_dict
 from establishment.misc.threading_helper import ThreadIntervalHandler
 from establishment.funnel.encoder import StreamJSONEncoder
-
-
-redis_connection_pool = None
+from establishment.utils.logging import logger
+from establishment.utils.redis_connections import get_redis, get_redis_pool
+
+
+# Atomically assigns the next message id of a stream, persists the message in its own key and publishes it
+# KEYS: stream id counter
+# ARGV: stream name, message key prefix, expire time, message
+KEY_PER_MESSAGE_PUBLISH_SCRIPT = """
+local message_id = redis.call("INCR", KEYS[1])
+redis.call("SETEX", ARGV[2] .. message_id, ARGV[3], ARGV[4])
+redis.call("PUBLISH", ARGV[1], "i " .. message_id .. " " .. ARGV[4])
+return message_id
+"""
+
+# Same as above, but the message is appended to a capped redis stream, as the entry <message id>-0
+# KEYS: stream id counter, messages stream key
+# ARGV: stream name, trim strategy (MAXLEN or MINID), max length, expire time, message
+CAPPED_STREAM_PUBLISH_SCRIPT = """
+local message_id = redis.call("INCR", KEYS[1])
+local threshold = tonumber(ARGV[3])
+if ARGV[2] == "MINID" then
+    threshold = math.max(message_id - threshold + 1, 0)
+end
+redis.call("XADD", KEYS[2], ARGV[2], "~", threshold, message_id .. "-0", "m", ARGV[5])
+redis.call("EXPIRE", KEYS[2], ARGV[4])
+redis.call("PUBLISH", ARGV[1], "i " .. message_id .. " " .. ARGV[5])
+return message_id
+"""
+
+# Stores a regenerated cache value, releases the lock if we still own it and wakes up the waiters
+# KEYS: key, stale key, lock key
+# ARGV: value, timeout in ms, stale timeout in ms (0 for no stale copy), lock token, notify channel
+CACHE_UPDATE_SCRIPT = """
+redis.call("PSETEX", KEYS[1], ARGV[2], ARGV[1])
+if tonumber(ARGV[3]) > 0 then
+    redis.call("PSETEX", KEYS[2], ARGV[3], ARGV[1])
+end
+if ARGV[4] ~= "" and redis.call("GET", KEYS[3]) == ARGV[4] then
+    redis.call("DEL", KEYS[3])
+end
+redis.call("PUBLISH", ARGV[5], ARGV[1])
+"""
+
+# Takes the mutex under the owner token, and assigns it the next fencing token
+# KEYS: mutex key, fencing counter key
+# ARGV: owner token, expire time in seconds
+MUTEX_ACQUIRE_SCRIPT = """
+if redis.call("SET", KEYS[1], ARGV[1], "NX", "EX", ARGV[2]) then
+    return redis.call("INCR", KEYS[2])
+end
+return 0
+"""
+
+# Extends the expiration of the mutex, only if it's still held under the owner token
+# KEYS: mutex key
+# ARGV: owner token, expire time in seconds
+MUTEX_RENEW_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("EXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Deletes the mutex, only if it's still held under the owner token, and wakes up the waiters
+# KEYS: mutex key
+# ARGV: owner token, release notification channel
+MUTEX_RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    redis.call("DEL", KEYS[1])
+    redis.call("PUBLISH", ARGV[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+# Puts back the in-flight elements whose visibility timeout expired, then moves the due elements in flight.
+# Both steps handle at most max count elements, to keep the script short and under the unpack() limit.
+# KEYS: queue, in-flight queue
+# ARGV: current timestamp, visibility deadline, max count
+RELIABLE_QUEUE_POP_SCRIPT = """
+local expired = redis.call("ZRANGEBYSCORE", KEYS[2], "-inf", ARGV[1], "LIMIT", 0, tonumber(ARGV[3]))
+for i = 1, #expired do
+    redis.call("ZADD", KEYS[1], ARGV[1], expired[i])
+end
+if #expired > 0 then
+    redis.call("ZREM", KEYS[2], unpack(expired))
+end
+local due = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, tonumber(ARGV[3]))
+if #due == 0 then
+    return due
+end
+redis.call("ZREM", KEYS[1], unpack(due))
+for i = 1, #due do
+    redis.call("ZADD", KEYS[2], ARGV[2], due[i])
+end
+return due
+"""
 
 
 def redis_response_to_json(data: Optional[Union[str, bytes]]) -> Any:
@@ -26,10 +125,7 @@ def redis_response_to_json(data: Optional[Union[str, bytes]]) -> Any:
 
 
 def get_default_redis_connection_pool() -> ConnectionPool:
-    global redis_connection_pool
-    if redis_connection_pool is None:
-        redis_connection_pool = ConnectionPool(**settings.REDIS_CONNECTION)
-    return redis_connection_pool
+    return get_redis_pool("default")
 
 
 class RetryRedis(StrictRedis):
@@ -55,9 +151,186 @@ def simple_stream_publish(stream_name: str, message: Union[str, dict]) -> None:
     connection.publish(stream_name, message)
 
 
+def redis_response_to_str(data: Union[str, bytes]) -> str:
+    if isinstance(data, bytes):
+        return str(data, "utf-8")
+    return data
+
+
+class StreamPersistenceBackend(object):
+    """
+    Base class for the ways persisted stream messages are stored, so that reconnecting clients can fetch what they missed
+    """
+    publish_script_source = ""
+
+    @staticmethod
+    def scripts_enabled() -> bool:
+        return getattr(settings, "REDIS_STREAM_USE_SCRIPTS", True)
+
+    @staticmethod
+    def get_pool_publish_scripts(connection: StrictRedis) -> dict["StreamPersistenceBackend", Optional[Script]]:
+        """
+        The scripts are kept on the connection pool itself, since a script references its client and so the pool,
+        and a registry here would keep alive the asyncio pools of all the event loops that ever published.
+        :return: The publish script of every persistence backend used with this connection pool, None if disabled
+        """
+        connection_pool = connection.connection_pool
+        publish_scripts = getattr(connection_pool, "stream_publish_scripts", None)
+        if publish_scripts is None:
+            publish_scripts = connection_pool.stream_publish_scripts = {}
+        return publish_scripts
+
+    def get_publish_script(self, connection: StrictRedis) -> Optional[Script]:
+        """
+        :return: The publish script, registered and loaded once per connection pool, or None if scripting is disabled
+        or the script can't be loaded
+        """
+        if not self.scripts_enabled():
+            return None
+        publish_scripts = self.get_pool_publish_scripts(connection)
+        if self not in publish_scripts:
+            publish_script = connection.register_script(self.publish_script_source)
+            try:
+                connection.script_load(self.publish_script_source)
+            except ResponseError as e:
+                self.disable_publish_script(connection, e)
+                return None
+            publish_scripts[self] = publish_script
+        return publish_scripts[self]
+
+    def disable_publish_script(self, connection: StrictRedis, error: Exception):
+        logger.warning("Disabling the stream publish script of " + self.__class__.__name__ + ": " + str(error))
+        self.get_pool_publish_scripts(connection)[self] = None
+
+    def call_publish_script(self, publish_script: Script, client: StrictRedis, stream_name: str, message: str,
+                            expire_time: int) -> Any:
+        return publish_script(keys=self.get_publish_script_keys(stream_name),
+                              args=self.get_publish_script_args(stream_name, message, expire_time),
+                              client=client)
+
+    def publish_with_script(self, connection: StrictRedis, stream_name: str, message: str, expire_time: int) -> bool:
+        """
+        Assign the id, persist and publish a message in a single round trip.
+        Any error other than the script missing from redis (OOM, READONLY, errors in the script) is raised.
+        :return: False if scripting isn't available, and the caller needs to use the multi command path
+        """
+        publish_script = self.get_publish_script(connection)
+        if publish_script is None:
+            return False
+        try:
+            self.call_publish_script(publish_script, connection, stream_name, message, expire_time)
+        except NoScriptError as e:
+            # The script is reloaded on NOSCRIPT, so it only gets here if redis keeps dropping it
+            self.disable_publish_script(connection, e)
+            return False
+        return True
+
+    def get_publish_script_keys(self, stream_name: str) -> list[str]:
+        return [RedisStreamPublisher.get_stream_id_counter(stream_name)]
+
+    def get_publish_script_args(self, stream_name: str, message: str, expire_time: int) -> list[Any]:
+        raise NotImplementedError
+
+    def persist(self, connection: StrictRedis, stream_name: str, message_id: int, message: str, expire_time: int):
+        """
+        Store a message that already has an id, used when scripting is disabled. The connection can be a pipeline.
+        """
+        raise NotImplementedError
+
+    def get_messages_since(self, connection: StrictRedis, stream_name: str, message_id: int,
+                           max_count: int) -> list[tuple[int, str]]:
+        """
+        :return: The (id, message) pairs still persisted with an id greater than message_id, oldest first
+        """
+        raise NotImplementedError
+
+
+class KeyPerMessagePersistence(StreamPersistenceBackend):
+    """
+    Every message is stored in its own key, that expires independently
+    """
+    publish_script_source = KEY_PER_MESSAGE_PUBLISH_SCRIPT
+
+    def get_publish_script_args(self, stream_name: str, message: str, expire_time: int) -> list[Any]:
+        return [stream_name, RedisStreamPublisher.get_stream_message_id_prefix(stream_name), expire_time, message]
+
+    def persist(self, connection: StrictRedis, stream_name: str, message_id: int, message: str, expire_time: int):
+        connection.setex(RedisStreamPublisher.get_stream_message_id_prefix(stream_name) + str(message_id),
+                         expire_time, message)
+
+    def get_messages_since(self, connection: StrictRedis, stream_name: str, message_id: int,
+                           max_count: int) -> list[tuple[int, str]]:
+        last_message_id = connection.get(RedisStreamPublisher.get_stream_id_counter(stream_name))
+        if last_message_id is None:
+            return []
+        last_message_id = min(int(last_message_id), message_id + max_count)
+        message_ids = range(message_id + 1, last_message_id + 1)
+        if len(message_ids) == 0:
+            return []
+
+        message_id_prefix = RedisStreamPublisher.get_stream_message_id_prefix(stream_name)
+        messages = connection.mget([message_id_prefix + str(missed_id) for missed_id in message_ids])
+        return [(missed_id, redis_response_to_str(message))
+                for missed_id, message in zip(message_ids, messages) if message is not None]
+
+
+class CappedStreamPersistence(StreamPersistenceBackend):
+    """
+    All the messages of a stream are kept in a single redis stream, trimmed to about max_length entries.
+    The entry ids are the message ids, so with the MINID trim strategy the last max_length ids are kept,
+    even if some of them were never used. The whole stream expires if nothing was published for expire_time.
+    """
+    publish_script_source = CAPPED_STREAM_PUBLISH_SCRIPT
+
+    def __init__(self, max_length: int = 1024, trim_strategy: str = "MAXLEN"):
+        if trim_strategy not in ("MAXLEN", "MINID"):
+            raise ValueError("Invalid trim strategy " + str(trim_strategy))
+        self.max_length = max_length
+        self.trim_strategy = trim_strategy
+
+    @classmethod
+    def get_messages_stream_key(cls, stream_name: str) -> str:
+        return "meta-" + stream_name + "-messages"
+
+    def get_publish_script_keys(self, stream_name: str) -> list[str]:
+        return [RedisStreamPublisher.get_stream_id_counter(stream_name), self.get_messages_stream_key(stream_name)]
+
+    def get_publish_script_args(self, stream_name: str, message: str, expire_time: int) -> list[Any]:
+        return [stream_name, self.trim_strategy, self.max_length, expire_time, message]
+
+    def persist(self, connection: StrictRedis, stream_name: str, message_id: int, message: str, expire_time: int):
+        messages_stream_key = self.get_messages_stream_key(stream_name)
+        if self.trim_strategy == "MINID":
+            trim_args = {"minid": max(message_id - self.max_length + 1, 0)}
+        else:
+            trim_args = {"maxlen": self.max_length}
+        connection.xadd(messages_stream_key, {"m": message}, id=str(message_id) + "-0", approximate=True, **trim_args)
+        connection.expire(messages_stream_key, expire_time)
+
+    def get_messages_since(self, connection: StrictRedis, stream_name: str, message_id: int,
+                           max_count: int) -> list[tuple[int, str]]:
+        entries = connection.xrange(self.get_messages_stream_key(stream_name), min=str(message_id + 1) + "-0",
+                                    count=max_count)
+        messages = []
+        for entry_id, fields in entries:
+            entry_message_id = int(redis_response_to_str(entry_id).split("-")[0])
+            message = fields.get(b"m", fields.get("m"))
+            messages.append((entry_message_id, redis_response_to_str(message)))
+        return messages
+
+
 class RedisStreamPublisher(object):
     message_timeout = 60 * 60 * 5   # Default expire time - 5 hours
     global_connection = None
+    default_persistence_backend: StreamPersistenceBackend = KeyPerMessagePersistence()
+    # Pairs of (stream name prefix, backend), longest prefix first
+    persistence_backends: list[tuple[str, StreamPersistenceBackend]] = []
+
+    # Rough stats on message serialization, updated without locking
+    num_encoded_events = 0
+    num_encoded_bytes = 0
+    total_encode_time = 0.0
+    num_published_messages = 0
 
     def __init__(self, stream_name: str, connection=None, persistence=True, raw=False, expire_time=None):
         if not connection:
@@ -85,23 +358,33 @@ class RedisStreamPublisher(object):
     @classmethod
     def get_global_connection(cls) -> StrictRedis:
         if cls.global_connection is None:
-            cls.global_connection = StrictRedis(connection_pool=get_default_redis_connection_pool())
+            cls.global_connection = get_redis()
         return cls.global_connection
 
     @classmethod
     def publish_to_stream(cls, stream_name: str, message: Any, serializer_class=StreamJSONEncoder,
                           connection: Optional[StrictRedis] = None, persistence: bool = True, raw: bool = False, expire_time: Optional[int] = None) -> str:
+        original_message = message
+        message = cls.encode_message(message, serializer_class)
+        cls.num_published_messages += 1
+        batch = RedisStreamPublishBatch.get_active()
+        if batch is not None:
+            if expire_time is None:
+                expire_time = cls.message_timeout
+            batch.add(stream_name, message, persistence=persistence, raw=raw, expire_time=expire_time,
+                      connection=connection)
+            return original_message
         if connection is None:
             connection = cls.get_global_connection()
-        original_message = message
-        if not isinstance(message, str):
-            message = json.dumps(message, cls=serializer_class)
         if not raw:
             if persistence:
-                message_id = connection.incr(cls.get_stream_id_counter(stream_name))
                 if expire_time is None:
                     expire_time = cls.message_timeout
-                connection.setex(cls.get_stream_message_id_prefix(stream_name) + str(message_id), expire_time, message)
+                persistence_backend = cls.get_persistence_backend(stream_name)
+                if persistence_backend.publish_with_script(connection, stream_name, message, expire_time):
+                    return original_message
+                message_id = connection.incr(cls.get_stream_id_counter(stream_name))
+                persistence_backend.persist(connection, stream_name, message_id, message, expire_time)
                 message = cls.format_message_with_id(message, message_id)
             else:
                 message = cls.format_message_vanilla(message)
@@ -113,6 +396,78 @@ class RedisStreamPublisher(object):
                 pass
         return original_message
 
+    @classmethod
+    def publish_to_streams(cls, stream_names: list[str], message: Any, serializer_class=StreamJSONEncoder,
+                           connection: Optional[StrictRedis] = None, persistence: bool = True, raw: bool = False,
+                           expire_time: Optional[int] = None) -> Any:
+        """
+        Publish the same message on multiple streams, serializing it only once and sending everything in one pipeline
+        """
+        original_message = message
+        message = cls.encode_message(message, serializer_class)
+        cls.num_published_messages += len(stream_names)
+        if expire_time is None:
+            expire_time = cls.message_timeout
+        # If a batch is already active, this one is merged into it
+        with RedisStreamPublishBatch(connection=connection) as batch:
+            for stream_name in stream_names:
+                batch.add(stream_name, message, persistence=persistence, raw=raw, expire_time=expire_time)
+        return original_message
+
+    @classmethod
+    def encode_message(cls, message: Any, serializer_class=StreamJSONEncoder) -> str:
+        if isinstance(message, str):
+            return message
+        encode_start = time.perf_counter()
+        message = json.dumps(message, cls=serializer_class)
+        cls.total_encode_time += time.perf_counter() - encode_start
+        cls.num_encoded_events += 1
+        # The default encoder escapes non-ascii characters, so this is also the number of bytes
+        cls.num_encoded_bytes += len(message)
+        return message
+
+    @classmethod
+    def get_encode_stats(cls) -> dict[str, Any]:
+        num_encoded_events = max(cls.num_encoded_events, 1)
+        return {
+            "num_encoded_events": cls.num_encoded_events,
+            "num_published_messages": cls.num_published_messages,
+            "total_encode_time": cls.total_encode_time,
+            "average_encode_time": cls.total_encode_time / num_encoded_events,
+            "average_event_bytes": cls.num_encoded_bytes / num_encoded_events,
+        }
+
+    @classmethod
+    def register_persistence_backend(cls, stream_name_prefix: str, persistence_backend: StreamPersistenceBackend):
+        """
+        Persist the messages of all streams starting with the given prefix through another backend
+        """
+        cls.persistence_backends.append((stream_name_prefix, persistence_backend))
+        cls.persistence_backends.sort(key=lambda entry: len(entry[0]), reverse=True)
+
+    @classmethod
+    def get_persistence_backend(cls, stream_name: str) -> StreamPersistenceBackend:
+        for stream_name_prefix, persistence_backend in cls.persistence_backends:
+            if stream_name.startswith(stream_name_prefix):
+                return persistence_backend
+        return cls.default_persistence_backend
+
+    @classmethod
+    def get_messages_since(cls, stream_name: str, message_id: int, connection: Optional[StrictRedis] = None,
+                           max_count: int = 1024) -> list[tuple[int, str]]:
+        """
+        Fetch the persisted messages a client missed, in a single call for the capped stream backend
+        :param message_id: The last message id the client received
+        :return: A list of (message id, message) pairs, oldest first
+        """
+        if connection is None:
+            connection = cls.get_global_connection()
+        return cls.get_persistence_backend(stream_name).get_messages_since(connection, stream_name, message_id, max_count)
+
+    @classmethod
+    def batch(cls, connection: Optional[StrictRedis] = None) -> "RedisStreamPublishBatch":
+        return RedisStreamPublishBatch(connection=connection)
+
     @classmethod
     def get_stream_id_counter(cls, stream_name: str) -> str:
         return "meta-" + stream_name + "-id-counter"
@@ -130,18 +485,190 @@ class RedisStreamPublisher(object):
         return "v " + message
 
 
+class RedisStreamPublishBatch(object):
+    """
+    Buffers all the messages published from the current thread while active, and sends them in a single flush.
+    Persisted messages go through the publish scripts of their persistence backends, or if scripting is disabled,
+    their ids are reserved with one INCRBY per stream. Either way, a flush takes two round trips no matter the number of events.
+    The messages are kept per connection pool, so each is sent on the connection it was published with.
+    Use it as a context manager, nested batches are merged into the outermost one.
+    """
+    thread_local = threading.local()
+
+    def __init__(self, connection: Optional[StrictRedis] = None):
+        self.connection = connection
+        # For each connection pool, a connection to it and the messages to send on it
+        self.pending_messages: dict[ConnectionPool, tuple[StrictRedis, list[tuple[str, str, bool, bool, int]]]] = {}
+        self.parent_batch: Optional[RedisStreamPublishBatch] = None
+
+    @classmethod
+    def get_active(cls) -> Optional["RedisStreamPublishBatch"]:
+        return getattr(cls.thread_local, "batch", None)
+
+    def add(self, stream_name: str, message: str, persistence: bool = True, raw: bool = False,
+            expire_time: int = RedisStreamPublisher.message_timeout, connection: Optional[StrictRedis] = None):
+        connection = connection or self.connection or RedisStreamPublisher.get_global_connection()
+        self.add_messages(connection, [(stream_name, message, persistence, raw, expire_time)])
+
+    def add_messages(self, connection: StrictRedis, messages: list[tuple[str, str, bool, bool, int]]):
+        connection_pool = connection.connection_pool
+        if connection_pool not in self.pending_messages:
+            self.pending_messages[connection_pool] = (connection, [])
+        self.pending_messages[connection_pool][1].extend(messages)
+
+    def reserve_message_ids(self, connection: StrictRedis, messages: list[tuple[str, str, bool, bool, int]]) -> dict[str, int]:
+        """
+        :return: The first reserved message id for each stream that has persisted messages
+        """
+        num_persisted: dict[str, int] = {}
+        for stream_name, message, persistence, raw, expire_time in messages:
+            if persistence and not raw:
+                num_persisted[stream_name] = num_persisted.get(stream_name, 0) + 1
+
+        if not num_persisted:
+            return {}
+
+        pipe = connection.pipeline(transaction=False)
+        for stream_name, count in num_persisted.items():
+            pipe.incrby(RedisStreamPublisher.get_stream_id_counter(stream_name), count)
+
+        first_ids = {}
+        for (stream_name, count), last_id in zip(num_persisted.items(), pipe.execute()):
+            first_ids[stream_name] = int(last_id) - count + 1
+        return first_ids
+
+    def get_publish_scripts(self, connection: StrictRedis,
+                            messages: list[tuple[str, str, bool, bool, int]]) -> Optional[list[Optional[Script]]]:
+        """
+        :return: The publish script of every persisted message, or None if any of them has scripting disabled
+        """
+        publish_scripts = []
+        for stream_name, message, persistence, raw, expire_time in messages:
+            publish_script = None
+            if persistence and not raw:
+                publish_script = RedisStreamPublisher.get_persistence_backend(stream_name).get_publish_script(connection)
+                if publish_script is None:
+                    return None
+            publish_scripts.append(publish_script)
+        return publish_scripts
+
+    def flush_with_scripts(self, connection: StrictRedis, publish_scripts: list[Optional[Script]],
+                           messages: list[tuple[str, str, bool, bool, int]]) -> tuple[int, list[tuple[str, str, bool, bool, int]]]:
+        """
+        Raises a ResponseError before sending anything if the scripts can't be loaded.
+        :return: The number of published messages, and the messages that need to be sent again without scripts,
+        because their script got flushed from redis after being loaded (NOSCRIPT)
+        """
+        pipe = connection.pipeline(transaction=False)
+        for publish_script, (stream_name, message, persistence, raw, expire_time) in zip(publish_scripts, messages):
+            if publish_script is not None:
+                persistence_backend = RedisStreamPublisher.get_persistence_backend(stream_name)
+                persistence_backend.call_publish_script(publish_script, pipe, stream_name, message, expire_time)
+            elif raw:
+                pipe.publish(stream_name, message)
+            else:
+                pipe.publish(stream_name, RedisStreamPublisher.format_message_vanilla(message))
+
+        # Errors of single commands are returned in place, so that the commands that succeeded aren't sent again
+        num_published = 0
+        unsent_messages = []
+        for message_entry, result in zip(messages, pipe.execute(raise_on_error=False)):
+            if isinstance(result, NoScriptError):
+                unsent_messages.append(message_entry)
+            elif isinstance(result, Exception):
+                logger.error("Failed to publish a message to stream " + message_entry[0] + ": " + str(result))
+            else:
+                num_published += 1
+        return num_published, unsent_messages
+
+    def flush_without_scripts(self, connection: StrictRedis, messages: list[tuple[str, str, bool, bool, int]]) -> int:
+        next_ids = self.reserve_message_ids(connection, messages)
+
+        pipe = connection.pipeline(transaction=False)
+        for stream_name, message, persistence, raw, expire_time in messages:
+            if not raw:
+                if persistence:
+                    message_id = next_ids[stream_name]
+                    next_ids[stream_name] += 1
+                    persistence_backend = RedisStreamPublisher.get_persistence_backend(stream_name)
+                    persistence_backend.persist(pipe, stream_name, message_id, message, expire_time)
+                    message = RedisStreamPublisher.format_message_with_id(message, message_id)
+                else:
+                    message = RedisStreamPublisher.format_message_vanilla(message)
+            pipe.publish(stream_name, message)
+        pipe.execute()
+
+        return len(messages)
+
+    def flush_connection(self, connection: StrictRedis, messages: list[tuple[str, str, bool, bool, int]]) -> int:
+        publish_scripts = self.get_publish_scripts(connection, messages)
+        if publish_scripts is None:
+            return self.flush_without_scripts(connection, messages)
+
+        try:
+            num_published, unsent_messages = self.flush_with_scripts(connection, publish_scripts, messages)
+        except ResponseError as e:
+            # The scripts couldn't be loaded, so scripting is unavailable and nothing was sent
+            persistence_backends = set(RedisStreamPublisher.get_persistence_backend(stream_name)
+                                       for stream_name, message, persistence, raw, expire_time in messages
+                                       if persistence and not raw)
+            for persistence_backend in persistence_backends:
+                persistence_backend.disable_publish_script(connection, e)
+            return self.flush_without_scripts(connection, messages)
+
+        if unsent_messages:
+            num_published += self.flush_without_scripts(connection, unsent_messages)
+        return num_published
+
+    def flush(self) -> int:
+        """
+        Send all the pending messages to redis
+        :return: The number of messages that were published
+        """
+        pending_messages, self.pending_messages = self.pending_messages, {}
+        num_published = 0
+        for connection, messages in pending_messages.values():
+            num_published += self.flush_connection(connection, messages)
+        return num_published
+
+    def __enter__(self):
+        self.parent_batch = self.get_active()
+        self.thread_local.batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.thread_local.batch = self.parent_batch
+        if self.parent_batch is not None:
+            for connection, messages in self.pending_messages.values():
+                self.parent_batch.add_messages(connection, messages)
+            self.pending_messages = {}
+        else:
+            self.flush()
+
+
+class RedisCacheFlight(object):
+    """
+    A cache regeneration in progress in the current process, that other threads needing the same key wait on
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.has_value = False
+        self.value = None
+
+
 class RedisCache(object):
-    connection_pool = None
+    update_scripts: dict[ConnectionPool, Script] = {}
+    # Only one thread per process asks redis for a missing key, the others wait for its result
+    flights: dict[str, RedisCacheFlight] = {}
+    flights_lock = threading.Lock()
 
     def __init__(self, key_prefix="cache-", redis_connection=None):
         self.key_prefix = key_prefix
-        self.redis_connection = redis_connection or StrictRedis(connection_pool=self.get_default_connection_pool())
+        self.redis_connection = redis_connection or get_redis("caching")
 
     @classmethod
     def get_default_connection_pool(cls):
-        if not cls.connection_pool:
-            cls.connection_pool = ConnectionPool(**settings.REDIS_CONNECTION_CACHING)
-        return cls.connection_pool
+        return get_redis_pool("caching")
 
     @staticmethod
     def serialize(value, cls=StreamJSONEncoder):
@@ -151,17 +678,93 @@ class RedisCache(object):
     def deserialize(value):
         return redis_response_to_json(value)
 
-    def update_key(self, key, generator, timeout, stale_extra=None):
+    @staticmethod
+    def get_lock_key(key: str) -> str:
+        return "lock-" + key
+
+    @staticmethod
+    def get_stale_key(key: str) -> str:
+        return "stale-" + key
+
+    @staticmethod
+    def get_notify_channel(key: str) -> str:
+        return "notify-" + key
+
+    def get_update_script(self) -> Script:
+        connection_pool = self.redis_connection.connection_pool
+        if connection_pool not in RedisCache.update_scripts:
+            RedisCache.update_scripts[connection_pool] = self.redis_connection.register_script(CACHE_UPDATE_SCRIPT)
+        return RedisCache.update_scripts[connection_pool]
+
+    def update_key(self, key, generator, timeout, stale_extra=None, lock_token=None):
         value = generator()
         serialized_value = self.serialize(value)
-        self.redis_connection.setex(key, timeout, serialized_value)
-        if stale_extra:
-            self.redis_connection.setex("stale-" + key, int(timeout + stale_extra), serialized_value)
-        self.redis_connection.delete("lock-" + key)
+        stale_timeout = timeout + stale_extra if stale_extra else 0
+        self.get_update_script()(keys=[key, self.get_stale_key(key), self.get_lock_key(key)],
+                                 args=[serialized_value, int(timeout * 1000), int(stale_timeout * 1000),
+                                       lock_token or "", self.get_notify_channel(key)],
+                                 client=self.redis_connection)
         # Returning the deserialized value to be consistent between calls of cached/uncached values
         return self.deserialize(serialized_value)
 
+    def wait_for_update(self, key: str, max_wait: float) -> Optional[bytes]:
+        """
+        Wait for the lock holder to publish the new value, at most max_wait seconds
+        :return: The serialized value, or None if we timed out
+        """
+        subscription = self.redis_connection.pubsub(ignore_subscribe_messages=True)
+        try:
+            subscription.subscribe(self.get_notify_channel(key))
+            # The value might have been set before we subscribed
+            value = self.redis_connection.get(key)
+            if value:
+                return value
+            deadline = time.time() + max_wait
+            while True:
+                remaining_time = deadline - time.time()
+                if remaining_time <= 0:
+                    return None
+                message = subscription.get_message(timeout=remaining_time)
+                if message is not None and message["type"] == "message":
+                    return message["data"]
+        finally:
+            subscription.close()
+
+    def get_or_set_from_redis(self, key: str, generator: Callable, timeout: float, stale_extra: float):
+        if not stale_extra:
+            return self.update_key(key, generator, timeout)
+
+        # We want to sync so that only a single process calls the generator
+        # and the others wait at most stale_extra to grab it
+        lock_token = uuid.uuid4().hex
+        stale_key = self.get_stale_key(key)
+        stale_extra_ms = max(int(stale_extra * 1000), 1)
+        if self.redis_connection.set(self.get_lock_key(key), lock_token, nx=True, px=stale_extra_ms):
+            # We grabbed the lock, put the stale copy so that all other readers use it
+            stale_value = self.redis_connection.get(stale_key)
+            if stale_value:
+                self.redis_connection.set(key, stale_value, nx=True, px=stale_extra_ms)
+            return self.update_key(key, generator, timeout, stale_extra, lock_token)
+
+        value = self.redis_connection.get(stale_key)
+        if not value:
+            value = self.wait_for_update(key, stale_extra)
+        if value:
+            return self.deserialize(value)
+        # The lock holder is too slow or died, its lock will expire by itself
+        return self.update_key(key, generator, timeout, stale_extra)
+
+    def invalidate(self, key: str):
+        if self.key_prefix:
+            key = self.key_prefix + key
+        self.redis_connection.delete(key, self.get_stale_key(key))
+
     def get_or_set(self, key: str, generator: Callable, timeout: float, stale_extra: Optional[float] = None, retries_per_second: int = 50):
+        """
+        Get the cached value of key, or regenerate it if missing. Concurrent misses of the same key are
+        single-flight: one thread per process asks redis, and one process across the cluster calls the generator.
+        retries_per_second is unused, waiters are notified through pubsub instead of polling.
+        """
         if stale_extra is None:
             stale_extra = min(timeout, max(1, timeout // 5))
         key = key or generator.__name__
@@ -171,31 +774,27 @@ class RedisCache(object):
         if value:
             return self.deserialize(value)
 
-        # We want to sync so that only a single process calls the generator
-        # and the others wait at most stale_extra to grab it
-        if stale_extra:
-            lock_key = "lock-" + key
-            stale_key = "stale-" + key
-            lock_status = self.redis_connection.getset(lock_key, str(time.time()))
-            if lock_status is None:
-                # We grabbed the lock, put the stale copy so that all other readers use it
-                stale_value = self.redis_connection.get(stale_key)
-                if stale_value:
-                    if self.redis_connection.setnx(key, stale_value) == 1:
-                        self.redis_connection.expire(key, stale_extra)
-                return self.update_key(key, generator, timeout, stale_extra)
-
-        value = self.redis_connection.get("stale-" + key)
-        if value:
-            return self.deserialize(value)
-        else:
-            # We didn't have the lock, retry for a while, waiting for
-            for _ in range(int(stale_extra * retries_per_second)):
-                time.sleep(1.0 / retries_per_second)
-                value = self.redis_connection.get(key)
-                if value:
-                    return self.deserialize(value)
-            return self.update_key(key, generator, timeout, stale_extra)
+        with RedisCache.flights_lock:
+            flight = RedisCache.flights.get(key)
+            is_flight_leader = flight is None
+            if is_flight_leader:
+                flight = RedisCache.flights[key] = RedisCacheFlight()
+
+        if not is_flight_leader:
+            flight.done.wait()
+            if flight.has_value:
+                return flight.value
+            # The leader failed, try on our own
+            return self.get_or_set_from_redis(key, generator, timeout, stale_extra)
+
+        try:
+            flight.value = self.get_or_set_from_redis(key, generator, timeout, stale_extra)
+            flight.has_value = True
+            return flight.value
+        finally:
+            with RedisCache.flights_lock:
+                del RedisCache.flights[key]
+            flight.done.set()
 
 
 class RedisCacheSerialized(RedisCache):
@@ -206,25 +805,89 @@ class RedisCacheSerialized(RedisCache):
         return value
 
 
-def serialize_arguments(*args, **kwargs):
-    def serialize(value):
-        if hasattr(value, "id"):
-            return value.__class__.__name__ + str(value.id)
-        else:
-            return value.__repr__()
-
-    args_serialized = [serialize(arg) for arg in args]
-    kwargs_serialized = [key + "=" + serialize(kwargs[key]) for key in sorted(kwargs.keys())]
+def serialize_argument(value: Any) -> str:
+    """
+    Canonical encoding of a cached function argument, that distinguishes between types (1 vs "1")
+    and between models with the same class name from different apps
+    """
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return json.dumps(value)
+    if isinstance(value, (list, tuple)):
+        return "[" + ",".join(serialize_argument(item) for item in value) + "]"
+    if isinstance(value, dict):
+        return "{" + ",".join(serialize_argument(key) + ":" + serialize_argument(value[key])
+                              for key in sorted(value.keys(), key=str)) + "}"
+    if hasattr(value, "id"):
+        meta = getattr(value, "_meta", None)
+        class_name = meta.label if meta is not None else value.__class__.__module__ + "." + value.__class__.__qualname__
+        return class_name + "#" + str(value.id)
+    return repr(value)
+
+
+def serialize_arguments(*args, **kwargs) -> str:
+    args_serialized = [serialize_argument(arg) for arg in args]
+    kwargs_serialized = [key + "=" + serialize_argument(kwargs[key]) for key in sorted(kwargs.keys())]
 
     return ",".join(args_serialized + kwargs_serialized)
 
 
-def redis_cached(expiration: float, *cache_args, **cache_kwargs) -> Callable:
+def get_cache_key(func: Callable, args: tuple, kwargs: dict[str, Any], version: Optional[str] = None) -> str:
+    """
+    Fixed length cache key for a function call, derived from the qualified function name, the version and the arguments
+    """
+    key_hash = hashlib.blake2b(digest_size=16)
+    key_hash.update((func.__module__ + "." + func.__qualname__).encode())
+    key_hash.update(b"\0" + str(version or "").encode() + b"\0")
+    key_hash.update(serialize_arguments(*args, **kwargs).encode())
+    return func.__name__[:32] + ":" + key_hash.hexdigest()
+
+
+def redis_cached(expiration: float, *cache_args, local_cache_size: int = 0, local_cache_ttl: Optional[float] = None,
+                 version: Optional[str] = None, **cache_kwargs) -> Callable:
+    """
+    Cache the results of the decorated function in redis for expiration seconds.
+    Changing the version invalidates all the results cached by previous versions.
+    With local_cache_size, the hottest results are also kept in an in-process LRU for at most local_cache_ttl seconds
+    (defaults to expiration). The wrapped function gets an invalidate(*args, **kwargs) method that drops a result
+    from redis and from the local caches of all processes.
+    """
     def _decorator(func: Callable) -> Callable:
+        redis_cache: Optional[RedisCache] = None
+        local_cache = None
+        if local_cache_size > 0:
+            from establishment.funnel.local_cache import LocalLRUCache
+            local_cache = LocalLRUCache(func.__module__ + "." + func.__qualname__, max_size=local_cache_size,
+                                        ttl=local_cache_ttl if local_cache_ttl is not None else expiration)
+
+        def get_redis_cache() -> RedisCache:
+            nonlocal redis_cache
+            if redis_cache is None:
+                redis_cache = RedisCache()
+            return redis_cache
+
+        def get_key_name(*func_args, **func_kwargs) -> str:
+            return get_cache_key(func, func_args, func_kwargs, version)
+
         def _wrapped_call(*func_args, **func_kwargs):
-            redis_cache = RedisCache()
-            key_name = func.__name__ + ":" + serialize_arguments(*func_args, **func_kwargs)
-            return redis_cache.get_or_set(key_name, func, expiration, *cache_args, **cache_kwargs)
+            key_name = get_key_name(*func_args, **func_kwargs)
+            if local_cache is not None:
+                found, value = local_cache.get(key_name)
+                if found:
+                    return value
+            generator = functools.partial(func, *func_args, **func_kwargs)
+            value = get_redis_cache().get_or_set(key_name, generator, expiration, *cache_args, **cache_kwargs)
+            if local_cache is not None:
+                local_cache.set(key_name, value)
+            return value
+
+        def invalidate(*func_args, **func_kwargs):
+            key_name = get_key_name(*func_args, **func_kwargs)
+            get_redis_cache().invalidate(key_name)
+            if local_cache is not None:
+                local_cache.invalidate(key_name)
+
+        _wrapped_call.invalidate = invalidate
+        _wrapped_call.local_cache = local_cache
         return _wrapped_call
 
     return _decorator
@@ -233,7 +896,7 @@ def redis_cached(expiration: float, *cache_args, **cache_kwargs) -> Callable:
 class RedisPriorityQueue(object):
     def __init__(self, name: str, **connection_info):
         self.name = name
-        self.redis_connection = StrictRedis(**connection_info)
+        self.redis_connection = StrictRedis(**connection_info) if connection_info else get_redis()
 
     def push(self, score: float, value: str):
         """
@@ -264,33 +927,171 @@ class RedisPriorityQueue(object):
         Gets the first element in queue and removes it
         :return: the first element in queue or None if the queue was empty
         """
-        pipeline = self.redis_connection.pipeline(transaction=True)
-        pipeline.zrange(self.name, 0, 0)
-        pipeline.zremrangebyrank(self.name, 0, 0)
-        result = pipeline.execute()
-        if len(result[0]) > 0:
+        result = self.redis_connection.zpopmin(self.name)
+        if len(result) > 0:
             return result[0][0]
         else:
             return None
 
+    def pop_many(self, count: int, timeout: Optional[float] = None) -> list[tuple[bytes, float]]:
+        """
+        Atomically gets and removes up to count of the first elements in queue
+        :param timeout: If set, block at most this many seconds until at least one element is available
+        :return: a list of (element, score) pairs, in queue order
+        """
+        if not timeout:
+            return self.redis_connection.zpopmin(self.name, count)
+        # BZMPOP needs Redis 7.0
+        result = self.redis_connection.bzmpop(timeout, 1, [self.name], min=True, count=count)
+        if not result:
+            return []
+        return [(element, float(score)) for element, score in result[1]]
+
+
+class RedisReliableQueue(RedisPriorityQueue):
+    """
+    Work queue where the score of an element is the time it's due, and popped elements are not lost if the consumer dies.
+    Popped elements are moved to an in-flight sorted set, scored by their visibility deadline, and must be acknowledged
+    before that, otherwise they are put back in the queue. Elements are unique, pushing an element twice only moves it.
+    """
+    def __init__(self, name: str, visibility_timeout: float = 60, **connection_info):
+        super().__init__(name, **connection_info)
+        self.in_flight_name = name + "-inflight"
+        self.visibility_timeout = visibility_timeout
+        self.pop_script = self.redis_connection.register_script(RELIABLE_QUEUE_POP_SCRIPT)
+        self.keep_working = False
+        # Rough stats
+        self.num_popped = 0
+        self.num_acknowledged = 0
+        self.num_failed = 0
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            "num_popped": self.num_popped,
+            "num_acknowledged": self.num_acknowledged,
+            "num_failed": self.num_failed,
+        }
+
+    def push_delayed(self, value: str, delay: float = 0) -> bool:
+        """
+        Adds the element to be delivered after delay seconds
+        :return: true if the element was added and false if it already exists
+        """
+        return self.push(time.time() + delay, value)
+
+    def push_many_delayed(self, values: list[str], delay: float = 0) -> int:
+        if len(values) == 0:
+            return 0
+        due_timestamp = time.time() + delay
+        return self.redis_connection.zadd(self.name, {value: due_timestamp for value in values})
+
+    def pop_due(self, count: int, visibility_timeout: Optional[float] = None) -> list[bytes]:
+        """
+        Atomically move up to count of the due elements in flight, after putting back in queue the elements
+        whose visibility timeout expired
+        """
+        current_timestamp = time.time()
+        visibility_timeout = visibility_timeout or self.visibility_timeout
+        result = self.pop_script(keys=[self.name, self.in_flight_name],
+                                 args=[current_timestamp, current_timestamp + visibility_timeout, count])
+        self.num_popped += len(result)
+        return result
+
+    def get_next_due_timestamp(self) -> Optional[float]:
+        result = self.redis_connection.zrange(self.name, 0, 0, withscores=True)
+        if len(result) > 0:
+            return result[0][1]
+        return None
+
+    def acknowledge(self, values: list) -> int:
+        """
+        Mark the popped elements as processed, so they are not delivered again
+        """
+        if len(values) == 0:
+            return 0
+        num_acknowledged = self.redis_connection.zrem(self.in_flight_name, *values)
+        self.num_acknowledged += num_acknowledged
+        return num_acknowledged
+
+    def extend(self, values: list, visibility_timeout: Optional[float] = None):
+        """
+        Give more time to process elements that are still in flight
+        """
+        if len(values) == 0:
+            return
+        deadline = time.time() + (visibility_timeout or self.visibility_timeout)
+        self.redis_connection.zadd(self.in_flight_name, {value: deadline for value in values}, xx=True)
+
+    def requeue(self, values: list, delay: float = 0):
+        """
+        Put elements that are in flight back in the queue, to be delivered again after delay seconds
+        """
+        if len(values) == 0:
+            return
+        due_timestamp = time.time() + delay
+        pipeline = self.redis_connection.pipeline(transaction=True)
+        pipeline.zrem(self.in_flight_name, *values)
+        pipeline.zadd(self.name, {value: due_timestamp for value in values})
+        pipeline.execute()
+
+    def consume(self, batch_size: int, handler: Callable[[list[bytes]], Any], visibility_timeout: Optional[float] = None,
+                max_wait: float = 1.0):
+        """
+        Pass batches of due elements to the handler until stop() is called. Batches are acknowledged if the handler
+        doesn't raise, otherwise they will be delivered again once their visibility timeout expires.
+        """
+        self.keep_working = True
+        while self.keep_working:
+            try:
+                batch = self.pop_due(batch_size, visibility_timeout)
+                if not batch:
+                    next_due_timestamp = self.get_next_due_timestamp()
+                    wait_time = max_wait
+                    if next_due_timestamp is not None:
+                        wait_time = min(max(next_due_timestamp - time.time(), 0.001), max_wait)
+                    time.sleep(wait_time)
+                    continue
+            except Exception:
+                logger.exception("Failed to pop from reliable queue " + self.name)
+                time.sleep(max_wait)
+                continue
+            try:
+                handler(batch)
+            except Exception:
+                self.num_failed += len(batch)
+                logger.exception("Unhandled error processing a batch from reliable queue " + self.name)
+                continue
+            self.acknowledge(batch)
+
+    def stop(self):
+        self.keep_working = False
+
 
 class RedisQueue(object):
     def __init__(self, queue_name, connection=None, max_size=16*1024):
         self.queue_name = queue_name
         if not connection:
-            connection = StrictRedis(connection_pool=get_default_redis_connection_pool())
+            connection = get_redis()
         self.redis_connection = connection
         self.max_size = max_size
         self.last_size = None
         self.pipe = self.redis_connection.pipeline(transaction=True)
 
     def push(self, value):
-        self.last_size = self.redis_connection.lpush(self.queue_name, value)
-        if self.last_size:
-            if self.last_size > self.max_size:
-                self.redis_connection.rpop(self.queue_name)
-                return False
-        return True
+        return self.push_many([value])
+
+    def push_many(self, values) -> bool:
+        """
+        Push all the values and drop the oldest entries that no longer fit, in a single round trip
+        :return: False if some entries were dropped
+        """
+        if len(values) == 0:
+            return True
+        pipe = self.redis_connection.pipeline(transaction=True)
+        pipe.lpush(self.queue_name, *values)
+        pipe.ltrim(self.queue_name, 0, self.max_size - 1)
+        self.last_size = pipe.execute()[0]
+        return self.last_size <= self.max_size
 
     def update_length(self):
         self.last_size = self.redis_connection.llen(self.queue_name)
@@ -308,17 +1109,40 @@ class RedisQueue(object):
             return result[1]
         return None
 
+    def pop_many(self, count: int, timeout: Optional[float] = None) -> list[bytes]:
+        """
+        Atomically pop up to count of the oldest entries, in the same order as pop()
+        :param timeout: If set, block at most this many seconds until at least one entry is available
+        """
+        if not timeout:
+            # RPOP with a count needs Redis 6.2
+            return self.redis_connection.rpop(self.queue_name, count) or []
+        # BLMPOP needs Redis 7.0
+        result = self.redis_connection.blmpop(timeout, 1, self.queue_name, direction="RIGHT", count=count)
+        if result:
+            return result[1]
+        return []
+
     def bulk_pop(self, bulk_size):
-        self.pipe.lrange(self.queue_name, 0, bulk_size)
-        self.pipe.ltrim(self.queue_name, bulk_size + 1, -1)
+        """
+        Pop up to bulk_size of the newest entries
+        """
+        self.pipe.lrange(self.queue_name, 0, bulk_size - 1)
+        self.pipe.ltrim(self.queue_name, bulk_size, -1)
         return self.pipe.execute()[0]
 
 
 # Implementation for Redis server 2.6.12 or greater and redis-py 2.7.4 or greater
 class RedisMutex(object):
+    """
+    Distributed mutex, held under a random owner token, that is kept alive by a background thread while acquired.
+    Every successful acquire also gets a fencing token, a number that increases with every acquisition of the mutex,
+    which can be passed along to storage to reject writes from an owner that lost the mutex.
+    """
     keep_alive_thread = None
     acquired_mutexes_mutex = threading.Lock()
-    acquired_mutexes: set[str] = set()
+    acquired_mutexes: set["RedisMutex"] = set()
+    scripts: dict[tuple[ConnectionPool, str], Script] = {}
 
     @classmethod
     def keep_alive_thread_worker(cls):
@@ -326,10 +1150,35 @@ class RedisMutex(object):
             if len(cls.acquired_mutexes) == 0:
                 cls.keep_alive_thread = None
                 return True
-            for redis_mutex in cls.acquired_mutexes:
-                redis_mutex.renew()
+            # Renew outside the lock, over a copy, since other threads can acquire or release meanwhile
+            acquired_mutexes = list(cls.acquired_mutexes)
+        cls.renew_many(acquired_mutexes)
         return False
 
+    @classmethod
+    def renew_many(cls, redis_mutexes: list["RedisMutex"]):
+        """
+        Renew all the mutexes, with a single pipeline per connection
+        """
+        mutexes_by_connection: dict[int, list[RedisMutex]] = {}
+        for redis_mutex in redis_mutexes:
+            mutexes_by_connection.setdefault(id(redis_mutex.redis_connection), []).append(redis_mutex)
+        for connection_mutexes in mutexes_by_connection.values():
+            # Mutexes released since the copy was made don't add a command to the pipeline
+            renewed_mutexes = []
+            try:
+                pipe = connection_mutexes[0].redis_connection.pipeline(transaction=False)
+                for redis_mutex in connection_mutexes:
+                    if redis_mutex.renew(pipe) is not False:
+                        renewed_mutexes.append(redis_mutex)
+                results = pipe.execute()
+            except Exception:
+                logger.exception("Failed to renew redis mutexes")
+                continue
+            for redis_mutex, renewed in zip(renewed_mutexes, results):
+                if not renewed and redis_mutex.acquired:
+                    redis_mutex.mark_lost()
+
     @classmethod
     def ensure_keep_alive_thread(cls):
         if cls.keep_alive_thread:
@@ -340,39 +1189,97 @@ class RedisMutex(object):
         self.owner_id = owner_id
         self.mutex_name = mutex_name
         if not connection:
-            connection = StrictRedis(connection_pool=get_default_redis_connection_pool())
+            connection = get_redis()
         self.redis_connection = connection
         self.redis_mutex_key = "mutex." + self.mutex_name
+        self.redis_fencing_key = "mutex." + self.mutex_name + ".fencing"
+        self.redis_release_channel = "mutex." + self.mutex_name + ".released"
         self.acquired = False
         self.expire = expire
+        self.token = None
+        self.fencing_token = None
 
-    def try_acquire(self):
+    def get_script(self, source: str) -> Script:
+        script_key = (self.redis_connection.connection_pool, source)
+        if script_key not in RedisMutex.scripts:
+            RedisMutex.scripts[script_key] = self.redis_connection.register_script(source)
+        return RedisMutex.scripts[script_key]
+
+    def try_acquire(self) -> Optional[int]:
+        """
+        :return: The fencing token if the mutex was acquired, None otherwise
+        """
         if self.acquired:
-            return True
-        result = self.redis_connection.set(self.redis_mutex_key, self.owner_id, nx=True, ex=self.expire)
-        if result is None or result == 0:
-            self.acquired = False
-            return False
+            return self.fencing_token
+        token = self.owner_id + "-" + uuid.uuid4().hex
+        fencing_token = self.get_script(MUTEX_ACQUIRE_SCRIPT)(keys=[self.redis_mutex_key, self.redis_fencing_key],
+                                                               args=[token, self.expire])
+        if not fencing_token:
+            return None
+        self.token = token
+        self.fencing_token = int(fencing_token)
         self.acquired = True
         with RedisMutex.acquired_mutexes_mutex:
             RedisMutex.acquired_mutexes.add(self)
         RedisMutex.ensure_keep_alive_thread()
-        return True
+        return self.fencing_token
 
-    def renew(self):
-        if self.acquired:
-            self.redis_connection.expire(self.redis_mutex_key, self.expire)
+    def renew(self, client=None):
+        """
+        Extend the expiration, only if we still own the mutex. When called on a pipeline, the result is in its response.
+        :return: True if the mutex is still ours
+        """
+        if not self.acquired:
+            return False
+        result = self.get_script(MUTEX_RENEW_SCRIPT)(keys=[self.redis_mutex_key], args=[self.token, self.expire],
+                                                     client=client or self.redis_connection)
+        if client is not None:
+            return result
+        if not result:
+            self.mark_lost()
+        return bool(result)
+
+    def forget(self):
+        with RedisMutex.acquired_mutexes_mutex:
+            RedisMutex.acquired_mutexes.discard(self)
+        self.acquired = False
+
+    def mark_lost(self):
+        logger.error("Lost ownership of redis mutex " + self.mutex_name)
+        self.forget()
 
     def release(self):
         if self.acquired:
-            self.redis_connection.delete(self.redis_mutex_key)
-            with RedisMutex.acquired_mutexes_mutex:
-                RedisMutex.acquired_mutexes.remove(self)
-            self.acquired = False
+            self.get_script(MUTEX_RELEASE_SCRIPT)(keys=[self.redis_mutex_key],
+                                                  args=[self.token, self.redis_release_channel])
+            self.forget()
 
-    def acquire(self, interval=0.5):
-        while not self.try_acquire():
-            time.sleep(interval)
+    def acquire(self, interval=0.5, timeout: Optional[float] = None) -> Optional[int]:
+        """
+        Block until the mutex is acquired, waking up when the owner releases it.
+        Since the mutex can also expire, we retry at least every interval seconds.
+        :return: The fencing token, or None if the timeout expired
+        """
+        fencing_token = self.try_acquire()
+        if fencing_token:
+            return fencing_token
+        deadline = time.time() + timeout if timeout is not None else None
+        subscription = self.redis_connection.pubsub(ignore_subscribe_messages=True)
+        try:
+            subscription.subscribe(self.redis_release_channel)
+            while True:
+                # The mutex might have been released before we subscribed, so always try first
+                fencing_token = self.try_acquire()
+                if fencing_token:
+                    return fencing_token
+                wait_time = interval
+                if deadline is not None:
+                    wait_time = min(wait_time, deadline - time.time())
+                    if wait_time <= 0:
+                        return None
+                subscription.get_message(timeout=wait_time)
+        finally:
+            subscription.close()
 
     def __enter__(self):
         self.acquire()
@@ -385,7 +1292,7 @@ class RedisMutex(object):
 class RedisScheduledJob(object):
     def __init__(self, name, connection=None, time_interval=1):
         if not connection:
-            connection = StrictRedis(connection_pool=get_default_redis_connection_pool())
+            connection = get_redis()
         self.redis_connection = connection
         self.name = name
         self.redis_mutex_name = "scheduled-job." + self.name
@@ -483,7 +1390,7 @@ class RedisStreamSubscriber(object):
     """
     def __init__(self, connection=None):
         if not connection:
-            connection = StrictRedis(connection_pool=get_default_redis_connection_pool())
+            connection = get_redis()
         self.connection = connection
         self.subscription = connection.pubsub()
 
@@ -0,0 +1,244 @@
+import os
+import queue
+import selectors
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from typing import Any, Optional
+
+from redis import StrictRedis
+
+from establishment.funnel.redis_stream import RedisStreamSubscriber, redis_response_to_str
+from establishment.misc.threading_helper import ThreadHandler
+from establishment.utils.logging import logger
+
+# Called with the raw message and the name of the channel it was published on
+StreamCallback = Callable[[bytes, str], Any]
+
+
+class RedisStreamSubscriberHub(object):
+    """
+    Serves any number of channel and pattern subscriptions from a single pubsub connection and a single thread.
+    Since pubsub objects are not thread safe, subscription changes requested from other threads are queued
+    and executed by the background thread, which is woken up through a pipe.
+    Messages are read into a bounded dispatch queue and callbacks are called once it's full or the socket is drained,
+    so a flood of messages on a few streams can't starve the others.
+    """
+    default_hub: Optional["RedisStreamSubscriberHub"] = None
+    default_hub_lock = threading.Lock()
+
+    def __init__(self, name: str = "RedisStreamSubscriberHub", connection: Optional[StrictRedis] = None,
+                 max_queue_size: int = 1024, select_timeout: float = 1.0):
+        self.name = name
+        self.subscriber = RedisStreamSubscriber(connection)
+        self.max_queue_size = max_queue_size
+        self.select_timeout = select_timeout
+
+        self.lock = threading.Lock()
+        self.channel_callbacks: dict[str, list[StreamCallback]] = {}
+        self.pattern_callbacks: dict[str, list[StreamCallback]] = {}
+        self.pending_commands: queue.SimpleQueue[tuple[str, str]] = queue.SimpleQueue()
+        self.dispatch_queue: deque[tuple[bytes, str, Optional[str]]] = deque()
+
+        self.wakeup_read_fd, self.wakeup_write_fd = os.pipe()
+        os.set_blocking(self.wakeup_read_fd, False)
+        os.set_blocking(self.wakeup_write_fd, False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.wakeup_read_fd, selectors.EVENT_READ)
+        self.subscription_fd: Optional[int] = None
+
+        self.keep_running = False
+        self.background_thread: Optional[ThreadHandler] = None
+
+        # Rough stats, only updated from the background thread
+        self.num_received = 0
+        self.num_dispatched = 0
+        self.num_callback_errors = 0
+        self.num_backpressure_pauses = 0
+        self.max_queue_size_reached = 0
+        self.max_dispatch_delay = 0.0
+
+    @classmethod
+    def get_default(cls) -> "RedisStreamSubscriberHub":
+        with cls.default_hub_lock:
+            if cls.default_hub is None:
+                cls.default_hub = cls("DefaultRedisStreamSubscriberHub")
+            return cls.default_hub
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            "num_channels": len(self.channel_callbacks),
+            "num_patterns": len(self.pattern_callbacks),
+            "queue_size": len(self.dispatch_queue),
+            "num_received": self.num_received,
+            "num_dispatched": self.num_dispatched,
+            "num_callback_errors": self.num_callback_errors,
+            "num_backpressure_pauses": self.num_backpressure_pauses,
+            "max_queue_size_reached": self.max_queue_size_reached,
+            "max_dispatch_delay": self.max_dispatch_delay,
+        }
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeup_write_fd, b"\0")
+        except BlockingIOError:
+            # The pipe is full, so the loop is going to wake up anyway
+            pass
+
+    @staticmethod
+    def add_callback(callbacks: dict[str, list[StreamCallback]], name: str, callback: StreamCallback) -> bool:
+        """
+        :return: True if this is the first callback for the name, and we need to subscribe to it
+        """
+        if name in callbacks:
+            callbacks[name].append(callback)
+            return False
+        callbacks[name] = [callback]
+        return True
+
+    @staticmethod
+    def remove_callback(callbacks: dict[str, list[StreamCallback]], name: str, callback: Optional[StreamCallback]) -> bool:
+        """
+        :return: True if there are no callbacks left for the name, and we need to unsubscribe from it
+        """
+        if name not in callbacks:
+            return False
+        if callback is not None and callback in callbacks[name]:
+            callbacks[name].remove(callback)
+        if callback is None or len(callbacks[name]) == 0:
+            del callbacks[name]
+            return True
+        return False
+
+    def queue_command(self, command: str, name: str):
+        self.pending_commands.put((command, name))
+        self.ensure_started()
+        self.wakeup()
+
+    def subscribe(self, stream_name: str, callback: StreamCallback):
+        with self.lock:
+            if self.add_callback(self.channel_callbacks, stream_name, callback):
+                self.queue_command("subscribe", stream_name)
+
+    def unsubscribe(self, stream_name: str, callback: Optional[StreamCallback] = None):
+        """
+        Remove the callback for the stream, or all of them if callback is None
+        """
+        with self.lock:
+            if self.remove_callback(self.channel_callbacks, stream_name, callback):
+                self.queue_command("unsubscribe", stream_name)
+
+    def psubscribe(self, pattern: str, callback: StreamCallback):
+        with self.lock:
+            if self.add_callback(self.pattern_callbacks, pattern, callback):
+                self.queue_command("psubscribe", pattern)
+
+    def punsubscribe(self, pattern: str, callback: Optional[StreamCallback] = None):
+        with self.lock:
+            if self.remove_callback(self.pattern_callbacks, pattern, callback):
+                self.queue_command("punsubscribe", pattern)
+
+    def execute_pending_commands(self):
+        while True:
+            try:
+                command, name = self.pending_commands.get_nowait()
+            except queue.Empty:
+                return
+            getattr(self.subscriber.subscription, command)(name)
+
+    def update_subscription_fd(self):
+        """
+        The pubsub socket only exists after the first subscription, and changes after a reconnect
+        """
+        connection = self.subscriber.subscription.connection
+        subscription_fd = None
+        if connection is not None and getattr(connection, "_sock", None) is not None:
+            subscription_fd = self.subscriber.get_file_descriptor()
+        if subscription_fd == self.subscription_fd:
+            return
+        if self.subscription_fd is not None:
+            try:
+                self.selector.unregister(self.subscription_fd)
+            except (KeyError, ValueError):
+                pass
+        if subscription_fd is not None:
+            self.selector.register(subscription_fd, selectors.EVENT_READ)
+        self.subscription_fd = subscription_fd
+
+    def drain_wakeup_pipe(self):
+        try:
+            while os.read(self.wakeup_read_fd, 1024):
+                pass
+        except BlockingIOError:
+            pass
+
+    def read_messages(self) -> bool:
+        """
+        Read messages until the socket is drained or the dispatch queue is full
+        :return: True if we stopped because of the queue, and there might still be messages to read
+        """
+        while len(self.dispatch_queue) < self.max_queue_size:
+            raw_message = self.subscriber.subscription.get_message(timeout=0.0)
+            if raw_message is None:
+                return False
+            if raw_message["type"] == "message":
+                pattern = None
+            elif raw_message["type"] == "pmessage":
+                pattern = redis_response_to_str(raw_message["pattern"])
+            else:
+                # Subscription confirmations and pongs
+                continue
+            self.dispatch_queue.append((raw_message["data"], redis_response_to_str(raw_message["channel"]), pattern))
+            self.num_received += 1
+        self.max_queue_size_reached = max(self.max_queue_size_reached, len(self.dispatch_queue))
+        self.num_backpressure_pauses += 1
+        return True
+
+    def dispatch_messages(self):
+        self.max_queue_size_reached = max(self.max_queue_size_reached, len(self.dispatch_queue))
+        dispatch_start = time.time()
+        while self.dispatch_queue:
+            message, channel, pattern = self.dispatch_queue.popleft()
+            with self.lock:
+                if pattern is None:
+                    callbacks = list(self.channel_callbacks.get(channel, []))
+                else:
+                    callbacks = list(self.pattern_callbacks.get(pattern, []))
+            for callback in callbacks:
+                try:
+                    callback(message, channel)
+                except Exception:
+                    self.num_callback_errors += 1
+                    logger.exception("Exception in " + self.name + " callback for " + channel)
+            self.num_dispatched += 1
+        self.max_dispatch_delay = max(self.max_dispatch_delay, time.time() - dispatch_start)
+
+    def process(self):
+        while self.keep_running:
+            try:
+                self.execute_pending_commands()
+                self.update_subscription_fd()
+                # Messages can already be buffered by the redis client, so only block on the socket if that's not the case
+                if self.subscription_fd is None or not self.subscriber.subscription.connection.can_read(timeout=0):
+                    self.selector.select(timeout=self.select_timeout)
+                self.drain_wakeup_pipe()
+                if self.subscription_fd is None:
+                    continue
+                while self.read_messages():
+                    self.dispatch_messages()
+                self.dispatch_messages()
+            except Exception:
+                logger.exception("Exception in " + self.name + ", retrying")
+                self.dispatch_queue.clear()
+                time.sleep(1.0)
+
+    def ensure_started(self):
+        if self.background_thread is not None:
+            return
+        self.keep_running = True
+        self.background_thread = ThreadHandler(self.name, self.process)
+
+    def stop(self):
+        self.keep_running = False
+        self.wakeup()
@@ -1,4 +1,5 @@
 import datetime
+import re
 from typing import Any, Optional, Self
 
 from django.db import models
@@ -8,31 +9,85 @@ from django.http.request import HttpRequest
 
 from establishment.utils.state import State
 from ..utils.convert import int_list
+from .encoder import StreamJSONEncoder
 from .json_helper import to_camel_case, to_json_dict
 from .redis_stream import RedisStreamPublisher
 
 StreamPermissionResponse = tuple[bool, str]
+StreamParams = dict[str, str]
 
 STREAM_HANDLERS = []
+# For each distinct prefix length, longest first, the handlers keyed by their literal stream name prefix
+STREAM_HANDLER_PREFIX_INDEX: list[tuple[int, dict[str, list]]] = []
+# Handlers without a literal prefix, that can only be checked one by one through matches_stream_name()
+STREAM_HANDLERS_WITHOUT_PREFIX = []
 
 
 def register_stream_handler(stream_handler):
+    """
+    Handlers that define a stream_name_prefix are indexed by it, and only have their stream_name_pattern
+    tried on stream names that start with that prefix. The others are checked linearly, after the indexed ones.
+    """
     STREAM_HANDLERS.append(stream_handler)
+    prefix = getattr(stream_handler, "stream_name_prefix", None)
+    if not prefix:
+        STREAM_HANDLERS_WITHOUT_PREFIX.append(stream_handler)
+        return
+    for prefix_length, handlers_by_prefix in STREAM_HANDLER_PREFIX_INDEX:
+        if prefix_length == len(prefix):
+            handlers_by_prefix.setdefault(prefix, []).append(stream_handler)
+            return
+    STREAM_HANDLER_PREFIX_INDEX.append((len(prefix), {prefix: [stream_handler]}))
+    STREAM_HANDLER_PREFIX_INDEX.sort(key=lambda entry: -entry[0])
+
+
+def resolve_stream_handler(stream_name: str) -> tuple[Any, Optional[StreamParams]]:
+    """
+    :return: The handler for the stream name and the parameters parsed from it, or (None, None) if there is no handler.
+    The parameters are None for handlers without a prefix, since those don't expose their parsing.
+    """
+    for prefix_length, handlers_by_prefix in STREAM_HANDLER_PREFIX_INDEX:
+        handlers = handlers_by_prefix.get(stream_name[:prefix_length])
+        if handlers is None:
+            continue
+        for stream_handler in handlers:
+            stream_params = stream_handler.parse_stream_name(stream_name)
+            if stream_params is not None:
+                return stream_handler, stream_params
+    for stream_handler in STREAM_HANDLERS_WITHOUT_PREFIX:
+        if stream_handler.matches_stream_name(stream_name):
+            return stream_handler, None
+    return None, None
 
 
 def get_stream_handler(stream_name: str):
-    for stream_class in STREAM_HANDLERS:
-        if stream_class.matches_stream_name(stream_name):
-            return stream_class
-    return None
+    return resolve_stream_handler(stream_name)[0]
 
 
 class StreamObjectMixin(models.Model):
     EVENT_PERSISTENCE_DURATION = 30 * 60   # 30 minutes
 
+    # Subclasses that are stream handlers set both of these, the pattern should use named groups for the parameters
+    stream_name_prefix: Optional[str] = None
+    stream_name_pattern: Optional[re.Pattern] = None
+
     class Meta:
         abstract = True
 
+    @classmethod
+    def parse_stream_name(cls, stream_name: str) -> Optional[StreamParams]:
+        """
+        :return: The named groups of the stream name pattern, or None if the stream name doesn't match it
+        """
+        match = cls.stream_name_pattern.match(stream_name)
+        if match is None:
+            return None
+        return match.groupdict()
+
+    @classmethod
+    def matches_stream_name(cls, stream_name: str) -> bool:
+        return cls.parse_stream_name(stream_name) is not None
+
     def has_field(self, field_name: str) -> bool:
         return field_name in map(lambda field: field.name, self._meta.get_fields())
 
@@ -346,6 +401,11 @@ class StreamObjectMixin(models.Model):
         self.publish_event_raw(event, stream_names, persistence, expire_time)
         return event
 
+    async def apublish_event(self, event_type, data, extra=None, stream_names=None, persistence=True, expire_time=None):
+        event = self.make_event(event_type, data, extra)
+        await self.apublish_event_raw(event, stream_names, persistence, expire_time)
+        return event
+
     def publish_create_event(self, *args, **kwargs):
         self.publish_event("create", self, *args, **kwargs)
 
@@ -373,8 +433,27 @@ class StreamObjectMixin(models.Model):
             stream_names = self.get_stream_name()
         if not isinstance(stream_names, list):
             stream_names = [stream_names]
+        RedisStreamPublisher.publish_to_streams(stream_names, event, persistence=persistence, expire_time=expire_time)
+
+    async def apublish_event_raw(self, event, stream_names=None, persistence=True, expire_time=None):
+        """
+        Async version of publish_event_raw, that doesn't block the event loop on redis
+        """
+        from asgiref.sync import sync_to_async
+        from .async_redis_stream import AsyncRedisStreamPublisher
+
+        def prepare_event():
+            # Reading the settings and serializing models can hit the database, so it's not done on the event loop
+            return self.get_default_event_persistence_duration(expire_time), StreamJSONEncoder.dumps(event)
+
+        expire_time, message = await sync_to_async(prepare_event)()
+        if not stream_names:
+            stream_names = await sync_to_async(self.get_stream_name)()
+        if not isinstance(stream_names, list):
+            stream_names = [stream_names]
         for stream_name in stream_names:
-            RedisStreamPublisher.publish_to_stream(stream_name, event, persistence=persistence, expire_time=expire_time)
+            await AsyncRedisStreamPublisher.publish_to_stream(stream_name, message, persistence=persistence,
+                                                              expire_time=expire_time)
 
     def add_to_state(self, state: State, user=None):
         state.add(self)
@@ -0,0 +1,504 @@
+import asyncio
+import gc
+import re
+import threading
+import time
+import uuid
+import weakref
+from unittest import mock
+
+from django.test import SimpleTestCase
+from redis.asyncio import Redis as AsyncRedis, ConnectionPool as AsyncConnectionPool
+from redis.exceptions import NoScriptError, ResponseError
+
+from establishment.funnel.async_redis_stream import AsyncRedisStreamPublisher
+from establishment.funnel import json_helper, stream
+from establishment.funnel.permission_checking import SubscriptionDecisionCache, user_can_subscribe_to_stream_uncached
+from establishment.funnel.redis_stream import get_cache_key, KeyPerMessagePersistence, RedisStreamPublisher, \
+    RedisStreamPublishBatch, RedisReliableQueue
+from establishment.utils import convert
+from establishment.utils.redis_connections import create_redis_pool, get_redis
+
+
+def make_function(name: str, module: str):
+    def func(*args, **kwargs):
+        pass
+
+    func.__name__ = name
+    func.__qualname__ = name
+    func.__module__ = module
+    return func
+
+
+class CacheKeyTest(SimpleTestCase):
+    def test_same_name_in_different_modules(self):
+        first_func = make_function("get_user_summary", "establishment.accounts.views")
+        second_func = make_function("get_user_summary", "establishment.social.views")
+        self.assertNotEqual(get_cache_key(first_func, (1,), {}), get_cache_key(second_func, (1,), {}))
+
+    def test_same_name_in_different_classes(self):
+        first_func = make_function("get", "establishment.blog.models")
+        second_func = make_function("get", "establishment.blog.models")
+        first_func.__qualname__ = "BlogEntry.get"
+        second_func.__qualname__ = "BlogPost.get"
+        self.assertNotEqual(get_cache_key(first_func, (), {}), get_cache_key(second_func, (), {}))
+
+    def test_argument_types(self):
+        func = make_function("get_value", "establishment.funnel.tests")
+        distinct_arguments = [(1,), ("1",), (1.0,), (True,), (None,), ("None",), ([1],), ((1, 2),), ("1,2",), ({"1": 2},)]
+        cache_keys = set(get_cache_key(func, args, {}) for args in distinct_arguments)
+        self.assertEqual(len(cache_keys), len(distinct_arguments))
+
+    def test_argument_positions(self):
+        func = make_function("get_value", "establishment.funnel.tests")
+        self.assertNotEqual(get_cache_key(func, (1, 2), {}), get_cache_key(func, (2, 1), {}))
+        self.assertNotEqual(get_cache_key(func, (1,), {}), get_cache_key(func, (), {"value": 1}))
+
+    def test_keyword_argument_order(self):
+        func = make_function("get_value", "establishment.funnel.tests")
+        self.assertEqual(get_cache_key(func, (), {"a": 1, "b": 2}), get_cache_key(func, (), {"b": 2, "a": 1}))
+
+    def test_version(self):
+        func = make_function("get_value", "establishment.funnel.tests")
+        self.assertNotEqual(get_cache_key(func, (1,), {}), get_cache_key(func, (1,), {}, version="2"))
+
+    def test_bounded_length(self):
+        func = make_function("get_value_with_a_very_long_function_name_that_goes_on", "establishment.funnel.tests")
+        self.assertEqual(len(get_cache_key(func, ("x" * 10000,), {})), len(get_cache_key(func, (), {})))
+
+    def test_models_from_different_apps(self):
+        class ModelMeta(object):
+            def __init__(self, label):
+                self.label = label
+
+        class Model(object):
+            def __init__(self, label, id):
+                self._meta = ModelMeta(label)
+                self.id = id
+
+        func = make_function("get_value", "establishment.funnel.tests")
+        self.assertNotEqual(get_cache_key(func, (Model("blog.Entry", 1),), {}),
+                            get_cache_key(func, (Model("forum.Entry", 1),), {}))
+        self.assertEqual(get_cache_key(func, (Model("blog.Entry", 1),), {}),
+                         get_cache_key(func, (Model("blog.Entry", 1),), {}))
+
+
+class PublishScriptTest(SimpleTestCase):
+    def setUp(self):
+        self.connection = get_redis()
+        self.persistence_backend = KeyPerMessagePersistence()
+        self.stream_name = "test-stream-" + uuid.uuid4().hex
+        self.id_counter = RedisStreamPublisher.get_stream_id_counter(self.stream_name)
+
+    def tearDown(self):
+        message_keys = self.connection.keys(RedisStreamPublisher.get_stream_message_id_prefix(self.stream_name) + "*")
+        self.connection.delete(self.id_counter, *message_keys)
+
+    def publish(self) -> bool:
+        return self.persistence_backend.publish_with_script(self.connection, self.stream_name, "{}", 60)
+
+    def is_script_enabled(self) -> bool:
+        return self.persistence_backend.get_pool_publish_scripts(self.connection).get(self.persistence_backend) is not None
+
+    def test_publish(self):
+        self.assertTrue(self.publish())
+        self.assertTrue(self.publish())
+        self.assertEqual(int(self.connection.get(self.id_counter)), 2)
+        self.assertEqual(self.persistence_backend.get_messages_since(self.connection, self.stream_name, 0, 10),
+                         [(1, "{}"), (2, "{}")])
+
+    def test_flushed_script_is_reloaded(self):
+        self.assertTrue(self.publish())
+        self.connection.script_flush()
+        self.assertTrue(self.publish())
+        self.assertTrue(self.is_script_enabled())
+
+    def test_errors_are_raised(self):
+        self.connection.set(self.id_counter, "not a number")
+        with self.assertRaises(ResponseError):
+            self.publish()
+        self.assertTrue(self.is_script_enabled())
+
+    def test_missing_script_disables_it(self):
+        with mock.patch.object(self.persistence_backend, "call_publish_script", side_effect=NoScriptError("NOSCRIPT")):
+            self.assertFalse(self.publish())
+        self.assertFalse(self.is_script_enabled())
+        self.assertFalse(self.publish())
+
+    def test_load_failure_disables_it(self):
+        with mock.patch.object(self.connection, "script_load", side_effect=ResponseError("unknown command")):
+            self.assertFalse(self.publish())
+        self.assertFalse(self.is_script_enabled())
+
+    def test_batch_publish(self):
+        with mock.patch.object(RedisStreamPublisher, "default_persistence_backend", self.persistence_backend):
+            for num_messages in (2, 3):
+                with RedisStreamPublishBatch(self.connection) as batch:
+                    for index in range(num_messages):
+                        batch.add(self.stream_name, "{}")
+                self.connection.script_flush()
+        self.assertEqual(int(self.connection.get(self.id_counter)), 5)
+        self.assertTrue(self.is_script_enabled())
+
+    def publish_async(self, side_effect=None):
+        async def publish():
+            # A pool of its own, that nothing else references
+            connection = AsyncRedis(connection_pool=create_redis_pool("default", AsyncConnectionPool))
+            try:
+                with mock.patch.object(RedisStreamPublisher, "default_persistence_backend", self.persistence_backend):
+                    if side_effect is None:
+                        await AsyncRedisStreamPublisher.publish_to_stream(self.stream_name, {}, connection=connection)
+                    else:
+                        with mock.patch.object(self.persistence_backend, "call_publish_script", side_effect=side_effect):
+                            await AsyncRedisStreamPublisher.publish_to_stream(self.stream_name, {}, connection=connection)
+                return weakref.ref(connection.connection_pool)
+            finally:
+                await connection.connection_pool.disconnect()
+
+        return asyncio.run(publish())
+
+    def test_async_publish(self):
+        connection_pool = self.publish_async()
+        self.assertEqual(int(self.connection.get(self.id_counter)), 1)
+        # The pool isn't kept alive by its scripts once the event loop is done with it
+        gc.collect()
+        self.assertIsNone(connection_pool())
+
+    def test_async_errors_are_raised(self):
+        with self.assertRaises(ResponseError):
+            self.publish_async(side_effect=ResponseError("OOM command not allowed"))
+        self.assertEqual(self.connection.get(self.id_counter), None)
+
+    def test_async_missing_script_falls_back(self):
+        self.publish_async(side_effect=NoScriptError("NOSCRIPT"))
+        self.assertEqual(int(self.connection.get(self.id_counter)), 1)
+
+
+class StreamUser(object):
+    is_anonymous = False
+    is_authenticated = True
+    is_superuser = False
+
+    def __init__(self, id):
+        self.id = id
+
+
+class SubscriptionDecisionCacheTest(SimpleTestCase):
+    stream_name = "test-stream"
+
+    def setUp(self):
+        self.user = StreamUser(10 ** 12 + uuid.uuid4().int % 10 ** 9)
+        self.cache_id = str(self.user.id)
+        self.redis_connection = SubscriptionDecisionCache.get_redis_connection()
+
+    def tearDown(self):
+        self.redis_connection.delete(SubscriptionDecisionCache.get_redis_key(self.cache_id),
+                                     SubscriptionDecisionCache.get_generation_key(self.cache_id))
+        SubscriptionDecisionCache.get_local_cache().delete(self.cache_id)
+
+    def get_decision(self, compute_decision):
+        with mock.patch("establishment.funnel.permission_checking.user_can_subscribe_to_stream_uncached",
+                        side_effect=compute_decision) as compute_mock:
+            decision = SubscriptionDecisionCache.get_decisions(self.user, [self.stream_name])[self.stream_name]
+        return decision, compute_mock.call_count
+
+    def is_cached(self) -> bool:
+        found, local_decisions = SubscriptionDecisionCache.get_local_cache().get(self.cache_id)
+        return found or self.redis_connection.exists(SubscriptionDecisionCache.get_redis_key(self.cache_id)) > 0
+
+    def test_decisions_are_cached(self):
+        self.assertEqual(self.get_decision(lambda user, stream_name: (True, "OK")), ((True, "OK"), 1))
+        self.assertEqual(self.get_decision(lambda user, stream_name: (False, "Changed")), ((True, "OK"), 0))
+        # Only in redis now
+        SubscriptionDecisionCache.get_local_cache().delete(self.cache_id)
+        self.assertEqual(self.get_decision(lambda user, stream_name: (False, "Changed")), ((True, "OK"), 0))
+
+    def test_invalidate(self):
+        self.get_decision(lambda user, stream_name: (True, "OK"))
+        SubscriptionDecisionCache.invalidate(self.user.id)
+        self.assertFalse(self.is_cached())
+        self.assertEqual(self.get_decision(lambda user, stream_name: (False, "Removed")), ((False, "Removed"), 1))
+
+    def test_invalidation_during_check(self):
+        def compute_decision(user, stream_name):
+            SubscriptionDecisionCache.invalidate(user.id)
+            return True, "Stale"
+
+        self.assertEqual(self.get_decision(compute_decision), ((True, "Stale"), 1))
+        self.assertFalse(self.is_cached())
+        self.assertEqual(self.get_decision(lambda user, stream_name: (False, "Removed")), ((False, "Removed"), 1))
+
+    def test_invalidation_from_another_process_during_check(self):
+        def compute_decision(user, stream_name):
+            # The redis part of an invalidation, before this process got the local cache invalidation message
+            generation_key = SubscriptionDecisionCache.get_generation_key(self.cache_id)
+            self.redis_connection.incr(generation_key)
+            self.redis_connection.delete(SubscriptionDecisionCache.get_redis_key(self.cache_id))
+            return True, "Stale"
+
+        self.get_decision(lambda user, stream_name: (True, "OK"))
+        SubscriptionDecisionCache.get_local_cache().delete(self.cache_id)
+        self.redis_connection.delete(SubscriptionDecisionCache.get_redis_key(self.cache_id))
+        self.assertEqual(self.get_decision(compute_decision), ((True, "Stale"), 1))
+        self.assertFalse(self.is_cached())
+
+
+def make_stream_handler(prefix, pattern):
+    class StreamHandler(object):
+        stream_name_prefix = prefix
+        stream_name_pattern = re.compile(pattern)
+
+        @classmethod
+        def parse_stream_name(cls, stream_name):
+            match = cls.stream_name_pattern.match(stream_name)
+            return match.groupdict() if match else None
+
+        @classmethod
+        def matches_stream_name(cls, stream_name):
+            return cls.parse_stream_name(stream_name) is not None
+
+        @classmethod
+        def can_subscribe(cls, user, stream_name, stream_params=None):
+            return stream_params is not None, "OK"
+
+    return StreamHandler
+
+
+def make_unindexed_stream_handler(pattern):
+    class StreamHandler(object):
+        stream_name_pattern = re.compile(pattern)
+
+        @classmethod
+        def matches_stream_name(cls, stream_name):
+            return cls.stream_name_pattern.match(stream_name) is not None
+
+        @classmethod
+        def can_subscribe(cls, user, stream_name):
+            return True, "OK"
+
+    return StreamHandler
+
+
+class ResolveStreamHandlerTest(SimpleTestCase):
+    def setUp(self):
+        # The handlers registered by the apps are left out
+        for name in ("STREAM_HANDLERS", "STREAM_HANDLER_PREFIX_INDEX", "STREAM_HANDLERS_WITHOUT_PREFIX"):
+            patcher = mock.patch.object(stream, name, [])
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_stream_params(self):
+        forum_handler = make_stream_handler("forum-", r"forum-(?P<forum_id>\d+)$")
+        stream.register_stream_handler(forum_handler)
+        self.assertEqual(stream.resolve_stream_handler("forum-12"), (forum_handler, {"forum_id": "12"}))
+        self.assertEqual(stream.resolve_stream_handler("forum-x"), (None, None))
+        self.assertEqual(stream.resolve_stream_handler("blog-12"), (None, None))
+        self.assertIs(stream.get_stream_handler("forum-12"), forum_handler)
+
+    def test_stream_params_are_passed_to_handler(self):
+        stream.register_stream_handler(make_stream_handler("forum-", r"forum-(?P<forum_id>\d+)$"))
+        self.assertEqual(user_can_subscribe_to_stream_uncached(StreamUser(1), "forum-12"), (True, "OK"))
+
+    def test_indexed_handlers_before_unindexed(self):
+        # Registered first, and matches the same stream names
+        unindexed_handler = make_unindexed_stream_handler(r"forum-\d+$")
+        forum_handler = make_stream_handler("forum-", r"forum-(?P<forum_id>\d+)$")
+        stream.register_stream_handler(unindexed_handler)
+        stream.register_stream_handler(forum_handler)
+        self.assertEqual(stream.resolve_stream_handler("forum-12"), (forum_handler, {"forum_id": "12"}))
+        # Stream names the indexed handlers reject still reach the unindexed ones, without parameters
+        catch_all_handler = make_unindexed_stream_handler(r"forum-")
+        stream.register_stream_handler(catch_all_handler)
+        self.assertEqual(stream.resolve_stream_handler("forum-x"), (catch_all_handler, None))
+
+    def test_longer_prefix_first(self):
+        thread_handler = make_stream_handler("messagethread-", r"messagethread-(?P<message_thread_id>\d+)$")
+        group_chat_handler = make_stream_handler("messagethread-groupchat-",
+                                                 r"messagethread-groupchat-(?P<group_chat_id>\d+)$")
+        stream.register_stream_handler(thread_handler)
+        stream.register_stream_handler(group_chat_handler)
+        self.assertEqual(stream.resolve_stream_handler("messagethread-groupchat-3"),
+                         (group_chat_handler, {"group_chat_id": "3"}))
+        self.assertEqual(stream.resolve_stream_handler("messagethread-3"), (thread_handler, {"message_thread_id": "3"}))
+
+    def test_longer_prefix_falls_back_to_shorter(self):
+        # The longer prefix matches, but not its pattern
+        any_handler = make_stream_handler("thread-", r"thread-(?P<name>.+)$")
+        numbered_handler = make_stream_handler("thread-numbered-", r"thread-numbered-(?P<number>\d+)$")
+        stream.register_stream_handler(any_handler)
+        stream.register_stream_handler(numbered_handler)
+        self.assertEqual(stream.resolve_stream_handler("thread-numbered-x"), (any_handler, {"name": "numbered-x"}))
+
+    def test_same_prefix_in_registration_order(self):
+        first_handler = make_stream_handler("object-", r"object-(?P<object_id>\d+)$")
+        second_handler = make_stream_handler("object-", r"object-(?P<object_id>\d+)(-(?P<version>\d+))?$")
+        stream.register_stream_handler(first_handler)
+        stream.register_stream_handler(second_handler)
+        self.assertIs(stream.get_stream_handler("object-1"), first_handler)
+        self.assertEqual(stream.resolve_stream_handler("object-1-2"), (second_handler, {"object_id": "1", "version": "2"}))
+
+
+# The key converters as they were before being memoized, to compare against
+def reference_json_helper_to_camel_case(txt):
+    capitalise_next = False
+    new_txt = ""
+    for c in txt:
+        if "A" <= c <= "Z":
+            new_txt += c
+        elif capitalise_next and "a" <= c <= "z":
+            new_txt += chr(ord(c) - ord("a") + ord("A"))
+            capitalise_next = False
+        elif c == "_":
+            capitalise_next = True
+        else:
+            capitalise_next = False
+            new_txt += c
+    return new_txt
+
+
+def reference_to_underscore_case(txt):
+    new_txt = ""
+    for c in txt:
+        if "A" <= c <= "Z":
+            new_txt += "_" + chr(ord(c) + ord("a") - ord("A"))
+        else:
+            new_txt += c
+    return new_txt
+
+
+def reference_to_snake_case(txt):
+    new_txt = ""
+    prev_char = None
+    for c in txt:
+        if "A" <= c <= "Z" and (prev_char is not None and "a" <= prev_char <= "z"):
+            new_txt += "_" + chr(ord(c) + ord("a") - ord("A"))
+        else:
+            new_txt += c
+        prev_char = c
+    return new_txt
+
+
+def reference_convert_to_camel_case(txt):
+    new_txt = ""
+    for i, part in enumerate(txt.split("_")):
+        if i == 0:
+            new_txt += part
+        elif part != part.capitalize():
+            new_txt += part.capitalize()
+        else:
+            new_txt += "_{}".format(part)
+    return new_txt
+
+
+class KeyConversionTest(SimpleTestCase):
+    keys = [
+        "", "_", "__", "a", "A", "1", "id", "ID", "userId", "user_id", "UserId", "user_id_2", "user__id", "_user_id",
+        "user_id_", "__user__id__", "userID", "HTTPResponse", "http_response_code", "already_snake", "alreadyCamel",
+        "a_b_c", "a1_b2", "key_1a", "x_Y", "X_y", "_Private", "dunder__", "über_straße", "überStraße", "naïveKey",
+        "ñandú_grande", "ключ_значение", "ключЗначение", "日本_語", "Émile_zola", "emile_Éclair", "ǅemal_x", "key with_space",
+        "kebab-case_key", "a.b_c", "ǲ_a",
+    ]
+
+    converters = [
+        (json_helper.to_camel_case, reference_json_helper_to_camel_case),
+        (json_helper.to_underscore_case, reference_to_underscore_case),
+        (convert.to_snake_case, reference_to_snake_case),
+        (convert.to_camel_case, reference_convert_to_camel_case),
+    ]
+
+    def assert_same_as_reference(self, keys):
+        for converter, reference_converter in self.converters:
+            for key in keys:
+                with self.subTest(converter=converter.__module__ + "." + converter.__name__, key=key):
+                    self.assertEqual(converter(key), reference_converter(key))
+                    # Again, from the cache
+                    self.assertEqual(converter(key), reference_converter(key))
+
+    def test_same_as_reference(self):
+        self.assert_same_as_reference(self.keys)
+
+    def test_converted_keys_are_stable(self):
+        for key in self.keys:
+            camel_case_key = json_helper.to_camel_case(key)
+            self.assertEqual(json_helper.to_camel_case(camel_case_key), reference_json_helper_to_camel_case(camel_case_key))
+            snake_case_key = convert.to_snake_case(key)
+            self.assertEqual(convert.to_snake_case(snake_case_key), reference_to_snake_case(snake_case_key))
+
+    def test_cache_size_limit(self):
+        keys = ["key_number_" + str(index) + "_" + key for index in range(5) for key in self.keys]
+        with mock.patch.object(convert, "KEY_CONVERSION_CACHE_MAX_SIZE", 16):
+            self.assert_same_as_reference(keys)
+            for converter, reference_converter in self.converters:
+                self.assertLessEqual(len(converter.cache), 16)
+            # The keys converted before the cache was last cleared
+            self.assert_same_as_reference(keys[:20])
+
+
+class RedisReliableQueueTest(SimpleTestCase):
+    def setUp(self):
+        self.queue = RedisReliableQueue("test-reliable-queue-" + uuid.uuid4().hex, visibility_timeout=0.2)
+
+    def tearDown(self):
+        self.queue.redis_connection.delete(self.queue.name, self.queue.in_flight_name)
+
+    def test_delayed_visibility(self):
+        self.queue.push_delayed("later", delay=0.3)
+        self.queue.push_many_delayed(["now", "also now"])
+        popped = self.queue.pop_due(10)
+        self.assertEqual(sorted(popped), [b"also now", b"now"])
+        self.queue.acknowledge(popped)
+        self.assertEqual(self.queue.pop_due(10), [])
+        time.sleep(0.35)
+        self.assertEqual(self.queue.pop_due(10), [b"later"])
+
+    def test_pop_count(self):
+        self.queue.push_many_delayed(["a", "b", "c"])
+        self.assertEqual(len(self.queue.pop_due(2)), 2)
+        self.assertEqual(len(self.queue.pop_due(2)), 1)
+
+    def test_lease_expiry_redelivers(self):
+        self.queue.push_delayed("job")
+        self.assertEqual(self.queue.pop_due(10), [b"job"])
+        # In flight until its visibility timeout expires
+        self.assertEqual(self.queue.pop_due(10), [])
+        time.sleep(0.25)
+        self.assertEqual(self.queue.pop_due(10), [b"job"])
+
+    def test_acknowledge(self):
+        self.queue.push_many_delayed(["first", "second"])
+        popped = self.queue.pop_due(10)
+        self.assertEqual(self.queue.acknowledge(popped), 2)
+        time.sleep(0.25)
+        self.assertEqual(self.queue.pop_due(10), [])
+        self.assertEqual(self.queue.redis_connection.zcard(self.queue.in_flight_name), 0)
+        self.assertEqual(self.queue.acknowledge(popped), 0)
+
+    def test_extend(self):
+        self.queue.push_delayed("slow job")
+        popped = self.queue.pop_due(10)
+        self.queue.extend(popped, visibility_timeout=5)
+        time.sleep(0.25)
+        self.assertEqual(self.queue.pop_due(10), [])
+
+    def test_requeue(self):
+        self.queue.push_delayed("job")
+        self.queue.requeue(self.queue.pop_due(10))
+        self.assertEqual(self.queue.pop_due(10), [b"job"])
+
+    def test_consume_redelivers_failed_batches(self):
+        batches = []
+
+        def handle_batch(batch):
+            batches.append(batch)
+            if len(batches) == 1:
+                raise RuntimeError("Failed on purpose")
+            self.queue.stop()
+
+        self.queue.push_delayed("job")
+        consumer_thread = threading.Thread(target=self.queue.consume, args=(10, handle_batch), kwargs={"max_wait": 0.05})
+        consumer_thread.start()
+        consumer_thread.join(timeout=5)
+        self.queue.stop()
+        self.assertFalse(consumer_thread.is_alive())
+        self.assertEqual(batches, [[b"job"], [b"job"]])
+        self.assertEqual(self.queue.get_stats(), {"num_popped": 2, "num_acknowledged": 1, "num_failed": 1})
@@ -4,7 +4,8 @@ import time
 from typing import Optional
 
 from establishment.misc.threading_helper import ThreadHandler
-from establishment.funnel.redis_stream import RedisStreamPublisher, RedisStreamSubscriber, RedisScheduledJob
+from establishment.funnel.redis_stream import RedisStreamPublisher, RedisStreamSubscriber, RedisQueue
+from establishment.misc.redis_scheduler import RedisJobScheduler, ScheduledJob
 
 
 class BaseProcessor(object):
@@ -36,22 +37,69 @@ class BaseProcessor(object):
 
 
 class RedisScheduledJobProcessor(BaseProcessor):
-    def __init__(self, redis_scheduled_job_name, callback, logger_name: Optional[str], try_lock_interval=1):
+    """
+    Runs the callback every time_interval seconds, on a single process of the cluster at a time.
+    The job is scheduled through the process-wide RedisJobScheduler, so there's no per-job polling of redis.
+    """
+    def __init__(self, redis_scheduled_job_name, callback, logger_name: Optional[str], try_lock_interval=1, time_interval=1):
         super().__init__(logger_name=logger_name)
+        # Only used to check if we were stopped
         self.try_lock_interval = try_lock_interval
         self.redis_scheduled_job_name = redis_scheduled_job_name
-        self.redis_scheduled_job = RedisScheduledJob(name=self.redis_scheduled_job_name)
+        self.redis_scheduled_job = ScheduledJob(self.redis_scheduled_job_name, self.run_callback, time_interval=time_interval)
         self.callback = callback
 
+    def run_callback(self, redis_scheduled_job):
+        try:
+            self.callback(redis_scheduled_job=redis_scheduled_job)
+        except:
+            self.logger.error("Unhandled error in acquired RedisLock! Critical!")
+
+    def main(self):
+        scheduler = RedisJobScheduler.get_default()
+        scheduler.add_job(self.redis_scheduled_job)
+        try:
+            while self.keep_working:
+                time.sleep(self.try_lock_interval)
+        finally:
+            scheduler.remove_job(self.redis_scheduled_job_name)
+
+
+class RedisQueueProcessor(BaseProcessor):
+    """
+    Drains a RedisQueue in batches, passing each batch of raw entries to the callback
+    """
+    def __init__(self, redis_queue: RedisQueue, callback, logger_name: Optional[str], batch_size=256, pop_timeout=1.0):
+        super().__init__(logger_name=logger_name)
+        self.redis_queue = redis_queue
+        self.callback = callback
+        self.batch_size = batch_size
+        self.pop_timeout = pop_timeout
+        self.num_batches = 0
+        self.num_processed = 0
+
+    def get_stats(self) -> dict:
+        return {
+            "num_batches": self.num_batches,
+            "num_processed": self.num_processed,
+        }
+
     def main(self):
         while self.keep_working:
-            if self.redis_scheduled_job.try_acquire():
-                try:
-                    self.callback(redis_scheduled_job=self.redis_scheduled_job)
-                except:
-                    self.logger.error("Unhandled error in acquired RedisLock! Critical!")
-                self.redis_scheduled_job.release()
-            time.sleep(self.try_lock_interval)
+            try:
+                batch = self.redis_queue.pop_many(self.batch_size, timeout=self.pop_timeout)
+            except Exception:
+                self.logger.exception("Failed to pop from redis queue " + str(self.redis_queue.queue_name))
+                time.sleep(1.0)
+                continue
+            if not batch:
+                continue
+            try:
+                self.callback(batch)
+            except Exception:
+                self.logger.exception("Unhandled error processing a batch from " + str(self.redis_queue.queue_name))
+            self.num_batches += 1
+            self.num_processed += len(batch)
 
 
 class BaseCommandProcessor(BaseProcessor):
@@ -14,7 +14,6 @@ import time
 
 from inspect import istraceback
 from collections import OrderedDict
-from redis import StrictRedis
 from establishment.misc.threading_helper import ThreadHandler
 
 
@@ -188,8 +187,8 @@ class RedisLoggingHandler(BackgroundLoggingHandler):
     def connect_to_redis(self):
         while True:
             try:
-                from django.conf import settings
-                self.connection = StrictRedis(**settings.REDIS_CONNECTION_LOGGING)
+                from establishment.utils.redis_connections import get_redis
+                self.connection = get_redis("logging")
                 return
             except Exception as e:
                 #TODO: log this to file also
@@ -0,0 +1,404 @@
+import json
+import threading
+import time
+import uuid
+from collections.abc import Callable
+from typing import Any, Optional
+
+from django.conf import settings
+from redis import StrictRedis
+
+from establishment.funnel.redis_stream import RedisMutex, redis_response_to_json
+from establishment.misc.threading_helper import ThreadHandler
+from establishment.utils.logging import logger
+from establishment.utils.redis_connections import get_redis
+
+# Claims a due job, by moving its next run to the end of the lease and recording the lease token
+# KEYS: schedule zset, leases hash, job data key
+# ARGV: job name, current timestamp, lease end timestamp, lease token
+SCHEDULER_CLAIM_SCRIPT = """
+local scheduled_timestamp = redis.call("ZSCORE", KEYS[1], ARGV[1])
+if not scheduled_timestamp or tonumber(scheduled_timestamp) > tonumber(ARGV[2]) then
+    return false
+end
+redis.call("ZADD", KEYS[1], ARGV[3], ARGV[1])
+redis.call("HSET", KEYS[2], ARGV[1], ARGV[4])
+return {scheduled_timestamp, redis.call("GET", KEYS[3]) or ""}
+"""
+
+# Extends the lease of a running job, if it's still ours
+# KEYS: schedule zset, leases hash
+# ARGV: job name, lease token, lease end timestamp
+SCHEDULER_RENEW_SCRIPT = """
+if redis.call("HGET", KEYS[2], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call("ZADD", KEYS[1], ARGV[3], ARGV[1])
+return 1
+"""
+
+# Stores the job data and schedules the next run, if the lease is still ours
+# KEYS: schedule zset, leases hash, job data key
+# ARGV: job name, lease token, next run timestamp, job data
+SCHEDULER_COMPLETE_SCRIPT = """
+if redis.call("HGET", KEYS[2], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call("HDEL", KEYS[2], ARGV[1])
+redis.call("ZADD", KEYS[1], ARGV[3], ARGV[1])
+redis.call("SET", KEYS[3], ARGV[4])
+return 1
+"""
+
+
+def get_next_job_timestamp(scheduled_timestamp: float, time_interval: float, current_timestamp: float) -> float:
+    """
+    The first multiple of the interval after the scheduled time that is in the future, so missed runs are skipped
+    """
+    count = max(int((current_timestamp - scheduled_timestamp) / time_interval), 1)
+    next_timestamp = scheduled_timestamp + time_interval * count
+    if next_timestamp <= current_timestamp:
+        next_timestamp += time_interval
+    return next_timestamp
+
+
+class ScheduledJob(object):
+    """
+    A job that runs every time_interval seconds, on a single process of the cluster at a time.
+    The callback is called with redis_scheduled_job=<this job>, like for a RedisScheduledJob, and can change job_data,
+    which is stored back in redis after the run, under the same key and format as for RedisScheduledJob.
+    With use_legacy_mutex, a claimed run also takes the scheduled-job.<name> mutex of RedisScheduledJob, and is skipped
+    if the job data says it isn't due, so that it never overlaps with processes still running RedisScheduledJob.
+    It defaults to settings.SCHEDULED_JOBS_USE_LEGACY_MUTEX (True if not set), which can be turned off once no deployed
+    process runs RedisScheduledJob anymore.
+    """
+    def __init__(self, name: str, callback: Callable, time_interval: float = 1, lease_duration: Optional[float] = None,
+                 use_legacy_mutex: Optional[bool] = None):
+        self.name = name
+        self.callback = callback
+        self.time_interval = time_interval
+        # A job that doesn't renew its lease for this long is considered dead, and can be claimed again
+        self.lease_duration = lease_duration or max(60.0, 2 * time_interval)
+        self.redis_job_data_key = "scheduled-job." + self.name + ".job_data"
+        if use_legacy_mutex is None:
+            use_legacy_mutex = getattr(settings, "SCHEDULED_JOBS_USE_LEGACY_MUTEX", True)
+        self.use_legacy_mutex = use_legacy_mutex
+        self.legacy_mutex: Optional[RedisMutex] = None
+        # The next run as written in the job data, which is what RedisScheduledJob goes by
+        self.legacy_timestamp = None
+
+        self.job_data = None
+        self.redis_time_interval = None
+        self.redis_timestamp = None
+        self.job_start_timestamp = 0
+        self.lease_token = None
+        self.lease_end_timestamp = 0
+        # The thread that runs the job every time it's claimed, and how it's told to
+        self.worker_thread: Optional[ThreadHandler] = None
+        self.run_event = threading.Event()
+
+        # Rough stats, only updated by the thread running the job
+        self.num_runs = 0
+        self.num_errors = 0
+        self.num_lost_leases = 0
+        self.num_postponed_runs = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+
+    def load_job_data(self, raw_job_data: Any):
+        self.job_data = None
+        self.redis_time_interval = None
+        self.legacy_timestamp = None
+        redis_job_data = redis_response_to_json(raw_job_data) if raw_job_data else None
+        if redis_job_data is None:
+            return
+        self.job_data = redis_job_data.get("data")
+        if redis_job_data.get("timestamp") is not None:
+            self.legacy_timestamp = float(redis_job_data["timestamp"])
+        if redis_job_data.get("timeInterval") is not None:
+            self.redis_time_interval = float(redis_job_data["timeInterval"])
+
+    def dump_job_data(self) -> str:
+        return json.dumps({
+            "data": self.job_data,
+            "timestamp": self.redis_timestamp,
+            "timeInterval": self.redis_time_interval,
+        })
+
+    def get_time_interval(self) -> float:
+        if self.redis_time_interval is None or self.redis_time_interval <= 0:
+            self.redis_time_interval = self.time_interval
+        return self.redis_time_interval
+
+    def update_stats(self, lag: float, duration: float):
+        self.num_runs += 1
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.total_duration += duration
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            "numRuns": self.num_runs,
+            "numErrors": self.num_errors,
+            "numLostLeases": self.num_lost_leases,
+            "numPostponedRuns": self.num_postponed_runs,
+            "lastLag": self.last_lag,
+            "maxLag": self.max_lag,
+            "lastDuration": self.last_duration,
+            "maxDuration": self.max_duration,
+            "averageDuration": self.total_duration / self.num_runs if self.num_runs else 0.0,
+        }
+
+
+class RedisJobScheduler(object):
+    """
+    Keeps the next run of all scheduled jobs in a single redis sorted set.
+    A single leader thread per process reads the next runs of the jobs it knows about in one command,
+    sleeps until the earliest one is due and claims it atomically, with a lease that it keeps renewing while the job runs.
+    Every job has its own worker thread, reused for all its runs, so a slow job doesn't delay the others.
+    """
+    default_scheduler: Optional["RedisJobScheduler"] = None
+    default_scheduler_lock = threading.Lock()
+
+    def __init__(self, name: str = "RedisJobScheduler", connection: Optional[StrictRedis] = None,
+                 schedule_key: str = "scheduled-jobs", max_wait: float = 5.0):
+        self.name = name
+        self.redis_connection = connection or get_redis()
+        self.schedule_key = schedule_key
+        self.leases_key = schedule_key + "-leases"
+        # Other processes can change the schedule, so we check it at least this often
+        self.max_wait = max_wait
+
+        self.claim_script = self.redis_connection.register_script(SCHEDULER_CLAIM_SCRIPT)
+        self.renew_script = self.redis_connection.register_script(SCHEDULER_RENEW_SCRIPT)
+        self.complete_script = self.redis_connection.register_script(SCHEDULER_COMPLETE_SCRIPT)
+
+        self.lock = threading.Lock()
+        self.jobs: dict[str, ScheduledJob] = {}
+        self.running_jobs: dict[str, ScheduledJob] = {}
+        self.wakeup_event = threading.Event()
+        self.keep_running = False
+        self.background_thread: Optional[ThreadHandler] = None
+
+    @classmethod
+    def get_default(cls) -> "RedisJobScheduler":
+        with cls.default_scheduler_lock:
+            if cls.default_scheduler is None:
+                from establishment.services.status import ServiceStatus
+
+                cls.default_scheduler = cls("DefaultRedisJobScheduler")
+                ServiceStatus.add_stats_provider("scheduledJobs", cls.default_scheduler.get_stats)
+            return cls.default_scheduler
+
+    def get_stats(self) -> dict[str, Any]:
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return {job.name: job.get_stats() for job in jobs}
+
+    def add_job(self, job: ScheduledJob):
+        # Jobs previously run by RedisScheduledJob keep their next run
+        redis_job_data = redis_response_to_json(self.redis_connection.get(job.redis_job_data_key)) or {}
+        self.redis_connection.zadd(self.schedule_key, {job.name: redis_job_data.get("timestamp") or time.time()}, nx=True)
+        with self.lock:
+            self.jobs[job.name] = job
+        self.ensure_started()
+        self.wakeup_event.set()
+
+    def remove_job(self, job_name: str):
+        with self.lock:
+            self.jobs.pop(job_name, None)
+
+    def schedule(self, name: str, callback: Callable, time_interval: float = 1, **kwargs) -> ScheduledJob:
+        job = ScheduledJob(name, callback, time_interval, **kwargs)
+        self.add_job(job)
+        return job
+
+    def try_claim(self, job: ScheduledJob) -> bool:
+        current_timestamp = time.time()
+        lease_token = uuid.uuid4().hex
+        result = self.claim_script(keys=[self.schedule_key, self.leases_key, job.redis_job_data_key],
+                                   args=[job.name, current_timestamp, current_timestamp + job.lease_duration, lease_token])
+        if not result:
+            return False
+        job.redis_timestamp = float(result[0])
+        job.load_job_data(result[1])
+        job.lease_token = lease_token
+        job.lease_end_timestamp = current_timestamp + job.lease_duration
+        return True
+
+    def renew_leases(self):
+        """
+        Extend the leases of the running jobs that passed half of them, in a single pipeline
+        """
+        current_timestamp = time.time()
+        with self.lock:
+            jobs = [job for job in self.running_jobs.values()
+                    if job.lease_end_timestamp - current_timestamp < job.lease_duration / 2]
+        if not jobs:
+            return
+        pipe = self.redis_connection.pipeline(transaction=False)
+        for job in jobs:
+            self.renew_script(keys=[self.schedule_key, self.leases_key],
+                              args=[job.name, job.lease_token, current_timestamp + job.lease_duration], client=pipe)
+        for job, renewed in zip(jobs, pipe.execute()):
+            if renewed:
+                job.lease_end_timestamp = current_timestamp + job.lease_duration
+            else:
+                job.num_lost_leases += 1
+                logger.error("Lost the lease of scheduled job " + job.name)
+
+    def acquire_legacy_mutex(self, job: ScheduledJob) -> bool:
+        """
+        Processes running RedisScheduledJob only coordinate through its mutex and the timestamp in the job data,
+        so a claimed run also needs both, until all of them are gone
+        :return: If the job can run
+        """
+        if not job.use_legacy_mutex:
+            return True
+        if job.legacy_mutex is None:
+            job.legacy_mutex = RedisMutex("scheduled-job." + job.name, connection=self.redis_connection)
+        if job.legacy_mutex.try_acquire() is None:
+            return False
+        # An older process may have run the job between our claim and taking the mutex
+        job.load_job_data(self.redis_connection.get(job.redis_job_data_key))
+        if job.legacy_timestamp is not None and job.legacy_timestamp > time.time():
+            job.legacy_mutex.release()
+            return False
+        return True
+
+    def release_legacy_mutex(self, job: ScheduledJob):
+        if job.legacy_mutex is None:
+            return
+        try:
+            job.legacy_mutex.release()
+        except Exception:
+            logger.exception("Failed to release the legacy mutex of scheduled job " + job.name)
+            # It expires on its own once it's not kept alive anymore
+            job.legacy_mutex.forget()
+
+    def postpone_job(self, job: ScheduledJob):
+        """
+        Leave the run to the older process that has it, and check again when the job data says it's next due
+        """
+        job.num_postponed_runs += 1
+        retry_timestamp = max(job.legacy_timestamp or 0, time.time() + job.time_interval)
+        try:
+            self.renew_script(keys=[self.schedule_key, self.leases_key], args=[job.name, job.lease_token, retry_timestamp])
+        except Exception:
+            logger.exception("Failed to postpone scheduled job " + job.name)
+        with self.lock:
+            self.running_jobs.pop(job.name, None)
+        self.wakeup_event.set()
+
+    def run_job(self, job: ScheduledJob):
+        try:
+            can_run = self.acquire_legacy_mutex(job)
+        except Exception:
+            logger.exception("Failed to take the legacy mutex of scheduled job " + job.name)
+            self.release_legacy_mutex(job)
+            can_run = False
+        if not can_run:
+            self.postpone_job(job)
+            return
+
+        job.job_start_timestamp = time.time()
+        try:
+            job.callback(redis_scheduled_job=job)
+        except Exception:
+            job.num_errors += 1
+            logger.exception("Unhandled error in scheduled job " + job.name)
+        job_end_timestamp = time.time()
+        job.update_stats(job.job_start_timestamp - job.redis_timestamp, job_end_timestamp - job.job_start_timestamp)
+
+        job.redis_timestamp = get_next_job_timestamp(job.redis_timestamp, job.get_time_interval(), job_end_timestamp)
+        try:
+            completed = self.complete_script(keys=[self.schedule_key, self.leases_key, job.redis_job_data_key],
+                                             args=[job.name, job.lease_token, job.redis_timestamp, job.dump_job_data()])
+            if not completed:
+                job.num_lost_leases += 1
+                logger.error("Scheduled job " + job.name + " finished after losing its lease")
+        except Exception:
+            logger.exception("Failed to reschedule job " + job.name)
+        self.release_legacy_mutex(job)
+        with self.lock:
+            self.running_jobs.pop(job.name, None)
+        self.wakeup_event.set()
+
+    def run_due_jobs(self) -> float:
+        """
+        :return: How long to wait until the earliest job is due
+        """
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if job.name not in self.running_jobs]
+        wait_time = self.max_wait
+        if not jobs:
+            return wait_time
+        scheduled_timestamps = self.redis_connection.zmscore(self.schedule_key, [job.name for job in jobs])
+        current_timestamp = time.time()
+        for job, scheduled_timestamp in zip(jobs, scheduled_timestamps):
+            if scheduled_timestamp is None:
+                # The schedule was cleared, start over
+                self.redis_connection.zadd(self.schedule_key, {job.name: current_timestamp}, nx=True)
+                wait_time = 0
+                continue
+            if scheduled_timestamp > current_timestamp:
+                wait_time = min(wait_time, scheduled_timestamp - current_timestamp)
+                continue
+            if self.try_claim(job):
+                self.start_job(job)
+        return wait_time
+
+    def start_job(self, job: ScheduledJob):
+        with self.lock:
+            self.running_jobs[job.name] = job
+            job.run_event.set()
+            if job.worker_thread is None:
+                job.worker_thread = ThreadHandler(self.name + " " + job.name, self.run_job_worker, job)
+
+    def run_job_worker(self, job: ScheduledJob):
+        """
+        Run the job every time it's claimed, until the scheduler is stopped
+        """
+        while True:
+            job.run_event.wait(self.max_wait)
+            with self.lock:
+                if not job.run_event.is_set():
+                    if not self.keep_running:
+                        job.worker_thread = None
+                        return
+                    continue
+                job.run_event.clear()
+            try:
+                self.run_job(job)
+            except Exception:
+                logger.exception("Exception running scheduled job " + job.name)
+                with self.lock:
+                    self.running_jobs.pop(job.name, None)
+
+    def process(self):
+        while self.keep_running:
+            # Cleared before looking at the schedule, so that no wakeup gets lost
+            self.wakeup_event.clear()
+            try:
+                self.renew_leases()
+                wait_time = self.run_due_jobs()
+            except Exception:
+                logger.exception("Exception in " + self.name + ", retrying")
+                wait_time = 1.0
+            self.wakeup_event.wait(wait_time)
+
+    def ensure_started(self):
+        with self.lock:
+            if self.background_thread is not None:
+                return
+            self.keep_running = True
+            self.background_thread = ThreadHandler(self.name, self.process)
+
+    def stop(self):
+        self.keep_running = False
+        self.wakeup_event.set()
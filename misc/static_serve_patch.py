@@ -55,8 +55,8 @@ def patch_static_serve():
 
 class RollupFileServer(object):
     def __init__(self, **kwargs):
-        from establishment.funnel.redis_stream import StrictRedis, get_default_redis_connection_pool
-        self.redis_connection = StrictRedis(connection_pool=get_default_redis_connection_pool())
+        from establishment.utils.redis_connections import get_redis
+        self.redis_connection = get_redis()
 
     def is_ready(self, file_name):
         bundle_state = self.redis_connection.get("bundle-ready")
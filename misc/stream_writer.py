@@ -1,12 +1,9 @@
 import os
-import queue
 import sys
-import threading
 import traceback
 
 from establishment.misc.rotating_file import RotatingFile
-from establishment.misc.threading_helper import ThreadHandler
-from establishment.funnel.redis_stream import RedisStreamSubscriber
+from establishment.funnel.redis_stream_hub import RedisStreamSubscriberHub
 
 
 class BasicStreamWriter(object):
@@ -26,23 +23,15 @@ class StreamWriterManager(object):
         self.name = name
         self.own_writer = BasicStreamWriter(os.path.join("/logging/", name), name)
         self.stream_writers = {}
-        # The redis subscription is created in a separate thread since pubsub is not thread safe (and reads don't need to block)
-        self.subscription = None
-        # self.subscription = RedisStreamSubscriber()
-        self.subscription_queue = queue.Queue()
+        # All the streams are read from a single pubsub connection, by the background thread of the hub
+        self.subscription = RedisStreamSubscriberHub("background updating stream " + name)
         self.streams = streams
-        self.lock = threading.Lock()
-        self.background_updating_thread = ThreadHandler("background updating stream " + name, self.background_updating)
+        for stream in streams:
+            self.subscribe(stream)
+        self.own_writer.write("Starting to listen")
 
-    def log_next_message(self):
-        message = None
-        stream_name = None
+    def log_message(self, message, stream_name):
         try:
-            message, stream_name = self.subscription.next_message()
-
-            if stream_name:
-                stream_name = stream_name.decode("utf-8")
-
             if stream_name in self.stream_writers and message is not None:
                 self.stream_writers[stream_name].write(message.decode("utf-8"))
         except Exception as e:
@@ -50,18 +39,6 @@ class StreamWriterManager(object):
                                   "\nException: " + str(e) +
                                   "\nMore info: " + str(sys.exc_info()) + "\n" + traceback.format_exc())
 
-    def background_updating(self):
-        self.subscription = RedisStreamSubscriber()
-
-        for stream in self.streams:
-            self.stream_writers[stream] = BasicStreamWriter(os.path.join("/logging/", stream), stream)
-            self.subscription.subscribe(stream)
-
-        self.own_writer.write("Starting to listen")
-        while True:
-            with self.lock:
-                self.log_next_message()
-
     def subscribe(self, stream_name, folder_path=""):
         if stream_name in self.stream_writers:
             print("Stream already added: ", stream_name)
@@ -72,6 +49,5 @@ class StreamWriterManager(object):
 
         #TODO: ensure folder exists
 
-        with self.lock:
-            self.stream_writers[stream_name] = BasicStreamWriter(folder_path, stream_name)
-            self.subscription.subscribe(stream_name)
+        self.stream_writers[stream_name] = BasicStreamWriter(folder_path, stream_name)
+        self.subscription.subscribe(stream_name, self.log_message)
@@ -0,0 +1,63 @@
+import threading
+import uuid
+
+from django.test import SimpleTestCase, override_settings
+
+from establishment.misc.redis_scheduler import RedisJobScheduler, ScheduledJob
+
+
+class RedisJobSchedulerTest(SimpleTestCase):
+    def setUp(self):
+        self.scheduler = RedisJobScheduler("TestRedisJobScheduler", schedule_key="test-scheduled-jobs-" + uuid.uuid4().hex,
+                                           max_wait=0.1)
+        self.job_name = "test-job-" + uuid.uuid4().hex
+
+    def tearDown(self):
+        self.scheduler.stop()
+        # Let the last runs finish, before their keys are deleted
+        for job in self.scheduler.jobs.values():
+            worker_thread = job.worker_thread
+            if worker_thread is not None:
+                worker_thread.thread.join(timeout=5)
+        self.scheduler.redis_connection.delete(self.scheduler.schedule_key, self.scheduler.leases_key,
+                                               "scheduled-job." + self.job_name + ".job_data",
+                                               "scheduled-job." + self.job_name)
+
+    def run_job(self, num_runs: int, **kwargs) -> list[threading.Thread]:
+        run_threads = []
+        done_event = threading.Event()
+
+        def callback(redis_scheduled_job):
+            run_threads.append(threading.current_thread())
+            redis_scheduled_job.job_data = len(run_threads)
+            if len(run_threads) == num_runs:
+                done_event.set()
+
+        job = self.scheduler.schedule(self.job_name, callback, time_interval=0.05, **kwargs)
+        self.assertTrue(done_event.wait(5))
+        self.assertEqual(job.num_errors, 0)
+        return run_threads
+
+    def test_runs_reuse_the_job_thread(self):
+        run_threads = self.run_job(4, use_legacy_mutex=False)
+        self.assertEqual(len(set(run_threads)), 1)
+        self.assertIsNot(run_threads[0], self.scheduler.background_thread.thread)
+
+    def test_legacy_mutex(self):
+        run_threads = self.run_job(2, use_legacy_mutex=True)
+        self.assertEqual(len(set(run_threads)), 1)
+
+    def test_worker_stops_with_scheduler(self):
+        self.run_job(1, use_legacy_mutex=False)
+        job = self.scheduler.jobs[self.job_name]
+        worker_thread = job.worker_thread.thread
+        self.scheduler.stop()
+        worker_thread.join(timeout=5)
+        self.assertFalse(worker_thread.is_alive())
+        self.assertIsNone(job.worker_thread)
+
+    def test_legacy_mutex_setting(self):
+        self.assertTrue(ScheduledJob("job", print).use_legacy_mutex)
+        with override_settings(SCHEDULED_JOBS_USE_LEGACY_MUTEX=False):
+            self.assertFalse(ScheduledJob("job", print).use_legacy_mutex)
+            self.assertTrue(ScheduledJob("job", print, use_legacy_mutex=True).use_legacy_mutex)
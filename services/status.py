@@ -2,7 +2,7 @@ import os
 import resource
 import threading
 import time
-from typing import Optional, Any
+from typing import Optional, Any, Callable
 
 from establishment.misc.ifconfig import get_default_network_interface
 from establishment.misc.threading_helper import ThreadHandler
@@ -24,6 +24,8 @@ class ServiceStatus(object):
     init_time: Optional[float] = None
     machine_id: Optional[int] = None
     background_thread_handler: Optional[ThreadHandler] = None
+    # Functions called on every status update, with their results added to the status under the given name
+    stats_providers: dict[str, Callable[[], Any]] = {}
 
     @classmethod
     def init(cls, name: str, update_interval: float = 2.0):
@@ -94,6 +96,10 @@ class ServiceStatus(object):
             cls.status[name] += value
             return cls.status[name]
 
+    @classmethod
+    def add_stats_provider(cls, name: str, provider: Callable[[], Any]):
+        cls.stats_providers[name] = provider
+
     @classmethod
     def log_json(cls):
         return cls.log_info
@@ -127,6 +133,12 @@ class ServiceStatus(object):
         temp_status["involuntaryContextSwitches"] = rusage.ru_nivcsw
         temp_status["uptime"] = time.time() - cls.init_time
 
+        for name, provider in list(cls.stats_providers.items()):
+            try:
+                temp_status[name] = provider()
+            except Exception as e:
+                temp_status[name] = {"error": str(e)}
+
         if lifecycle is not None:
             temp_status["lifecycle"] = lifecycle
 
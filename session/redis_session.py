@@ -1,6 +1,25 @@
+from typing import Optional
+
 import redis
-from django.conf import settings as django_settings
 from django.contrib.sessions.backends.base import SessionBase, CreateError
+from redis.commands.core import Script
+
+from establishment.utils.redis_connections import get_redis
+
+# Every stored session has this field, so that empty sessions also exist in redis
+SESSION_MARKER_FIELD = "__session__"
+
+# Creates the session hash, only if the key isn't already used
+# KEYS: session key
+# ARGV: expire time in seconds, then the fields and values
+SESSION_CREATE_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    return 0
+end
+redis.call("HSET", KEYS[1], unpack(ARGV, 2))
+redis.call("EXPIRE", KEYS[1], ARGV[1])
+return 1
+"""
 
 
 class UselessByteWrapper(str):
@@ -12,20 +31,54 @@ class UselessByteWrapper(str):
 
 
 class SessionStore(SessionBase):
+    """
+    Session backend that keeps each session in a redis hash, with a field per session key.
+    The fields are only written when their serialized value changed, otherwise the save is just an EXPIRE.
+    Sessions stored by older versions as a single encoded string are read, and rewritten as a hash on the next save.
+    """
+    create_script: Optional[Script] = None
+
     def __init__(self, session_key=None):
         super().__init__(session_key)
-        self.server = redis.StrictRedis(**django_settings.REDIS_CONNECTION_SESSION)
+        self.server = get_redis("session")
+        # The serialized fields as we last read or wrote them, and for which session key
+        self.stored_fields: dict[str, bytes] = {}
+        self.stored_session_key = None
 
     @classmethod
     def clear_expired(cls):
         # Redis already has expiration built-in
         pass
 
+    def get_create_script(self) -> Script:
+        if SessionStore.create_script is None:
+            SessionStore.create_script = self.server.register_script(SESSION_CREATE_SCRIPT)
+        return SessionStore.create_script
+
+    def serialize_value(self, value) -> bytes:
+        return self.serializer().dumps(value)
+
+    def deserialize_value(self, value: bytes):
+        return self.serializer().loads(value)
+
     def load(self):
         try:
             self._get_or_create_session_key()
-            session_data = self.server.get(self.get_redis_key_name())
-            return self.decode(session_data.decode("utf-8"))
+            redis_key = self.get_redis_key_name()
+            try:
+                stored_fields = self.server.hgetall(redis_key)
+            except redis.ResponseError:
+                # A session stored as a single string, the next save rewrites it as a hash
+                session_data = self.server.get(redis_key)
+                self.stored_fields = {}
+                self.stored_session_key = None
+                return self.decode(session_data.decode("utf-8"))
+            stored_fields = {str(field, "utf-8"): value for field, value in stored_fields.items()}
+            if stored_fields.pop(SESSION_MARKER_FIELD, None) is None:
+                raise KeyError(redis_key)
+            self.stored_fields = stored_fields
+            self.stored_session_key = self._session_key
+            return {field: self.deserialize_value(value) for field, value in stored_fields.items()}
         except Exception as e:
             self._session_key = None
             return {}
@@ -49,16 +102,52 @@ class SessionStore(SessionBase):
 
     def save(self, must_create=False):
         # Make sure the session key exists
-        self._get_or_create_session_key()
-
-        if must_create and self.exists(self._get_or_create_session_key()):
-            raise CreateError
-
-        data = self.encode(self._get_session(no_load=must_create))
-
-        self.server.setex(self.get_redis_key_name(), self.get_expiry_age(), data)
+        session_key = self._get_or_create_session_key()
+        redis_key = self.get_redis_key_name()
+
+        session_data = self._get_session(no_load=must_create)
+        fields = {field: self.serialize_value(value) for field, value in session_data.items()}
+        expiry_age = self.get_expiry_age()
+
+        if must_create:
+            args = [expiry_age, SESSION_MARKER_FIELD, "1"]
+            for field, value in fields.items():
+                args += [field, value]
+            if not self.get_create_script()(keys=[redis_key], args=args):
+                raise CreateError
+        elif self.stored_session_key != session_key:
+            # New key, or a session not stored as a hash yet, so everything is written
+            pipe = self.server.pipeline(transaction=True)
+            pipe.delete(redis_key)
+            pipe.hset(redis_key, mapping={SESSION_MARKER_FIELD: "1", **fields})
+            pipe.expire(redis_key, expiry_age)
+            pipe.execute()
+        else:
+            changed_fields = {field: value for field, value in fields.items() if self.stored_fields.get(field) != value}
+            removed_fields = [field for field in self.stored_fields if field not in fields]
+            if not changed_fields and not removed_fields:
+                self.touch(expiry_age)
+                return
+            pipe = self.server.pipeline(transaction=True)
+            if changed_fields:
+                pipe.hset(redis_key, mapping=changed_fields)
+            if removed_fields:
+                pipe.hdel(redis_key, *removed_fields)
+            pipe.expire(redis_key, expiry_age)
+            pipe.execute()
+
+        self.stored_fields = fields
+        self.stored_session_key = session_key
+
+    def touch(self, expiry_age: Optional[int] = None):
+        """
+        Only refresh the expiration of the session
+        """
+        self.server.expire(self.get_redis_key_name(), expiry_age or self.get_expiry_age())
 
     def delete(self, session_key=None):
+        if session_key is None or session_key == self.stored_session_key:
+            self.stored_session_key = None
         try:
             self.server.delete(self.get_redis_key_name(session_key))
         except:
@@ -4,6 +4,7 @@ from django.conf import settings
 from establishment.accounts.models import UserGroup, UserGroupMember, ReactionableMixin
 from establishment.chat.models import Commentable
 from establishment.content.models import Article
+from establishment.funnel.permission_checking import invalidate_subscription_decisions
 from establishment.funnel.stream import StreamObjectMixin
 
 
@@ -66,12 +67,15 @@ class SocialGroup(StreamObjectMixin):
 
     def add_user(self, user):
         with transaction.atomic():
-            user_group_member, created = UserGroupMember.objects.get_or_create(group_id=self.group_id, user=user)
-            if created:
+            user_group_member, user_group_member_created = UserGroupMember.objects.get_or_create(group_id=self.group_id, user=user)
+            if user_group_member_created:
                 social_user_member, created = SocialGroupMember.objects.get_or_create(group=self, user=user)
             else:
                 social_user_member = SocialGroupMember.objects.get(group=self, user=user)
 
+        if user_group_member_created:
+            invalidate_subscription_decisions(user.id)
+
         # TODO: publish to group stream
         return social_user_member
 
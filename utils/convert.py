@@ -1,10 +1,11 @@
 from __future__ import annotations
 
+import functools
 import json
 import re
 import string
 import unicodedata
-from typing import Optional, Union, Any
+from typing import Callable, Optional, Union, Any
 
 from django.http.request import QueryDict
 
@@ -12,6 +13,29 @@ from django.http.request import QueryDict
 orda = ord("a")
 ordA = ord("A")
 
+# The keys of the JSON objects are few and repeat a lot, so their conversions are remembered, up to this many of them
+KEY_CONVERSION_CACHE_MAX_SIZE = 4096
+
+
+def memoize_key_conversion(func: Callable[[str], str]) -> Callable[[str], str]:
+    """
+    Cache the results of a key conversion function in a dict, that is emptied when it gets full.
+    """
+    cache: dict[str, str] = {}
+
+    @functools.wraps(func)
+    def convert(txt: str) -> str:
+        result = cache.get(txt)
+        if result is None:
+            result = func(txt)
+            if len(cache) >= KEY_CONVERSION_CACHE_MAX_SIZE:
+                cache.clear()
+            cache[txt] = result
+        return result
+
+    convert.cache = cache
+    return convert
+
 
 def query_dict_to_dict(query_dict: QueryDict) -> dict:
     d: dict[str, Union[str, list[str]]] = {}
@@ -44,18 +68,23 @@ def to_snake_case_json(json_obj: Any) -> Any:
     return json_obj
 
 
+@memoize_key_conversion
 def to_snake_case(txt: str) -> str:
-    new_txt = ""
+    if txt.islower():
+        # No upper case letter to convert
+        return txt
 
+    new_chars = []
     prev_char: Optional[str] = None
     for c in txt:
         if "A" <= c <= "Z" and (prev_char is not None and "a" <= prev_char <= "z"):
-            new_txt += "_" + chr(ord(c) + orda - ordA)
+            new_chars.append("_")
+            new_chars.append(chr(ord(c) + orda - ordA))
         else:
-            new_txt += c
+            new_chars.append(c)
         prev_char = c
 
-    return new_txt
+    return "".join(new_chars)
 
 
 def to_camel_case_json(json_obj: Any) -> Any:
@@ -68,21 +97,23 @@ def to_camel_case_json(json_obj: Any) -> Any:
     return json_obj
 
 
+@memoize_key_conversion
 def to_camel_case(txt: str) -> str:
-    new_txt = ""
-
-    for i, part in enumerate(txt.split("_")):
-        if i == 0:
-            # don't change the first part
-            new_txt += part
-        elif part != part.capitalize():
+    if "_" not in txt:
+        return txt
+
+    parts = txt.split("_")
+    new_parts = [parts[0]]  # don't change the first part
+    for part in parts[1:]:
+        capitalized_part = part.capitalize()
+        if part != capitalized_part:
             # part starts with a lower case
-            new_txt += part.capitalize()
+            new_parts.append(capitalized_part)
         else:
             # part starts with something else
-            new_txt += "_{}".format(part)
+            new_parts.append("_" + part)
 
-    return new_txt
+    return "".join(new_parts)
 
 
 def canonical_str(obj: Any, normalize_keys: bool = True) -> str:
@@ -90,8 +121,9 @@ def canonical_str(obj: Any, normalize_keys: bool = True) -> str:
         return obj
     if normalize_keys:
         # TODO @establify fix this
-        from establishment.utils.http.renderers import to_pure_camel_case_json
-        obj = to_pure_camel_case_json(obj)
+        from establishment.utils.http.renderers import to_camel_case_primitive
+        obj = to_camel_case_primitive(obj)
+    # Kept on json.dumps, since the ASCII escaping is part of the canonical form
     return json.dumps(obj, separators=(",", ":"), sort_keys=True, check_circular=False)
 
 
@@ -0,0 +1,154 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+from django.conf import settings
+from psycopg import Connection
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import ConnectionPool, PoolTimeout
+
+# The libpq parameters that can be passed through the OPTIONS of a database
+LIBPQ_OPTIONS = ("sslmode", "sslrootcert", "sslcert", "sslkey", "connect_timeout", "application_name", "options")
+
+
+def get_database_conninfo(alias: str = "default") -> str:
+    settings_dict = settings.DATABASES[alias]
+    conninfo_params = {
+        "dbname": settings_dict.get("NAME"),
+        "user": settings_dict.get("USER"),
+        "password": settings_dict.get("PASSWORD"),
+        "host": settings_dict.get("HOST"),
+        "port": settings_dict.get("PORT"),
+    }
+    options = settings_dict.get("OPTIONS", {})
+    for option in LIBPQ_OPTIONS:
+        if option in options:
+            conninfo_params[option] = options[option]
+    return make_conninfo(**{key: value for key, value in conninfo_params.items() if value})
+
+
+class DatabaseConnectionPool(object):
+    """
+    Bounded pool of psycopg connections, meant for the worker threads of long-running daemons,
+    that would otherwise each keep their own Django connection open.
+    Connections are borrowed with borrow(), and the time spent waiting for one is recorded.
+    This is an opt-in helper for code that runs its own SQL: it hands out plain psycopg connections, not Django ones,
+    so nothing that goes through the ORM (ServiceDaemon, BackgroundObjectSaver, the command processors) uses it.
+    """
+    def __init__(self, alias: str = "default", min_size: int = 1, max_size: int = 8, timeout: float = 30.0):
+        self.alias = alias
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.pool: Optional[ConnectionPool] = None
+        self.lock = threading.Lock()
+
+        # Rough stats, not synchronized
+        self.num_borrows = 0
+        self.num_timeouts = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def get_pool(self) -> ConnectionPool:
+        if self.pool is None:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ConnectionPool(get_database_conninfo(self.alias),
+                                               min_size=self.min_size,
+                                               max_size=self.max_size,
+                                               timeout=self.timeout,
+                                               name="establishment-" + self.alias,
+                                               open=True)
+        return self.pool
+
+    @contextmanager
+    def borrow(self, timeout: Optional[float] = None) -> Iterator[Connection]:
+        """
+        Borrow a connection for the duration of the block. It's committed at the end of the block,
+        or rolled back if it raised, and returned to the pool either way.
+        """
+        pool = self.get_pool()
+        start_time = time.time()
+        try:
+            connection = pool.getconn(timeout=timeout)
+        except PoolTimeout:
+            self.num_timeouts += 1
+            raise
+        wait_time = time.time() - start_time
+        self.num_borrows += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        try:
+            # Pooled connections are not closed when exiting their block, only their transaction is ended
+            with connection:
+                yield connection
+        finally:
+            pool.putconn(connection)
+
+    def reset_after_fork(self):
+        """
+        The connections belong to the parent, so they must not be closed, as that would also end them for the parent.
+        We just forget them, and a new pool is created on the next borrow.
+        """
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool = None
+
+    def get_stats(self) -> dict[str, Any]:
+        stats = {
+            "numBorrows": self.num_borrows,
+            "numTimeouts": self.num_timeouts,
+            "averageWaitTime": self.total_wait_time / self.num_borrows if self.num_borrows else 0.0,
+            "maxWaitTime": self.max_wait_time,
+        }
+        if self.pool is not None:
+            stats["pool"] = self.pool.get_stats()
+        return stats
+
+
+database_pools: dict[str, DatabaseConnectionPool] = {}
+database_pools_lock = threading.Lock()
+
+
+def get_database_pool(alias: str = "default") -> DatabaseConnectionPool:
+    """
+    :return: The pool of the database for this process, sized by settings.DATABASE_POOL_OPTIONS[alias]
+    """
+    database_pool = database_pools.get(alias)
+    if database_pool is None:
+        with database_pools_lock:
+            database_pool = database_pools.get(alias)
+            if database_pool is None:
+                from establishment.services.status import ServiceStatus
+
+                pool_options = getattr(settings, "DATABASE_POOL_OPTIONS", {}).get(alias, {})
+                database_pool = database_pools[alias] = DatabaseConnectionPool(alias, **pool_options)
+                ServiceStatus.add_stats_provider("databasePools", get_database_pool_stats)
+    return database_pool
+
+
+def borrow_database_connection(alias: str = "default", timeout: Optional[float] = None):
+    return get_database_pool(alias).borrow(timeout)
+
+
+def get_database_pool_stats() -> dict[str, Any]:
+    with database_pools_lock:
+        pools = list(database_pools.values())
+    return {database_pool.alias: database_pool.get_stats() for database_pool in pools}
+
+
+def reset_database_pools_after_fork():
+    global database_pools_lock
+    database_pools_lock = threading.Lock()
+    for database_pool in database_pools.values():
+        database_pool.reset_after_fork()
+
+
+os.register_at_fork(after_in_child=reset_database_pools_after_fork)
@@ -5,6 +5,8 @@ import decimal
 import dataclasses
 from typing import Callable, Any
 
+import orjson
+from django.http import HttpResponse
 from django.utils import timezone
 from django.conf import settings
 
@@ -115,11 +117,62 @@ def to_camel_case_key(key: Any) -> Any:
     return key
 
 
+# The types that are already JSON primitives, and don't need any conversion
+PRIMITIVE_TYPES = (str, float, bool, type(None))
+
+
+def to_camel_case_primitive(obj: Any) -> Any:
+    """
+    Same result as serialize_to_json(obj, to_camel_case_key), but with the common types checked first,
+    and with the keys converted by the memoized to_camel_case.
+    """
+    obj_type = type(obj)
+    if obj_type in PRIMITIVE_TYPES:
+        return obj
+    if obj_type is int:
+        return obj if abs(obj) < 2**52 else str(obj)
+    if obj_type is dict:
+        return {to_camel_case_key(k): to_camel_case_primitive(v) for k, v in obj.items()}
+    if obj_type is list or obj_type is tuple:
+        return [to_camel_case_primitive(item) for item in obj]
+
+    if isinstance(obj, (JSONFieldValueDict, JSONFieldValueList)):
+        # If this object comes from a Django JSONField, don't touch it.
+        return obj
+    if isinstance(obj, (list, tuple)):
+        return [to_camel_case_primitive(item) for item in obj]
+    if isinstance(obj, dict):
+        return {to_camel_case_key(k): to_camel_case_primitive(v) for k, v in obj.items()}
+
+    new_obj = normalize_to_primitive_type(obj)
+    if new_obj is not obj:
+        # It's not the exact same object
+        return to_camel_case_primitive(new_obj)
+    return obj
+
+
 # TODO: Should this be merged with to_camel_case_json?
 def to_pure_camel_case_json(obj: Any) -> Any:
     # Integer keys are left as they are
-    return serialize_to_json(obj, key_transform=to_camel_case_key)
+    return to_camel_case_primitive(obj)
 
 
 def to_pure_json(obj: Any) -> Any:
     return serialize_to_json(obj, key_transform=lambda k: k)
+
+
+def orjson_default(obj: Any) -> Any:
+    # Only reached for the values orjson can't encode, that to_camel_case_primitive left untouched (JSONField contents)
+    try:
+        return normalize_to_primitive_type(obj)
+    except SerializeError:
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps_camel_case_json(obj: Any) -> bytes:
+    # Integer keys are encoded as strings, like json.dumps does
+    return orjson.dumps(to_camel_case_primitive(obj), default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def render_camel_case_json_response(obj: Any, status: int = 200) -> HttpResponse:
+    return HttpResponse(dumps_camel_case_json(obj), content_type="application/json", status=status)
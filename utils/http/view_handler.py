@@ -5,13 +5,13 @@ from typing import Callable, Any, ClassVar, Optional, Unpack
 
 from django.conf import settings
 from django.core.exceptions import DisallowedHost
-from django.http import HttpRequest, HttpResponse, JsonResponse
+from django.http import HttpRequest, HttpResponse
 from django.urls import URLPattern, re_path, path, include
 
 from establishment.utils.bound_types import CallableT
 from establishment.utils.errors import BadRequest, HTTPMethodNotAllowed, Throttled
 from establishment.utils.http.permissions import Permission, allow_any
-from establishment.utils.http.renderers import to_pure_camel_case_json
+from establishment.utils.http.renderers import render_camel_case_json_response
 from establishment.utils.http.view_config import ViewConfig, ViewMethod, ViewConfigOverrides, add_view_config
 from establishment.utils.throttling import Throttle
 
@@ -63,8 +63,9 @@ class BaseView:
 
         # Check throttling -- Should also include per user
         if not settings.DISABLE_THROTTLING:
-            if self.throttle.throttle_request(view_context.ip):
-                raise Throttled
+            retry_after = self.throttle.get_retry_after(view_context.ip)
+            if retry_after > 0:
+                raise Throttled(detail={"retryAfter": retry_after})
 
         # Check permission filters
         self.permissions.check_permission()
@@ -72,7 +73,7 @@ class BaseView:
     def format_response(self, response: Any) -> HttpResponse:
         if not isinstance(response, HttpResponse):
             # If the view does not return an HTTP request, assume it's JSON-serializable.
-            response = JsonResponse(to_pure_camel_case_json(response))
+            response = render_camel_case_json_response(response)
 
         # Add the Content-Length header to responses if not already set.
         if not response.has_header("Content-Length"):
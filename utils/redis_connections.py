@@ -0,0 +1,149 @@
+"""
+Registry of the named redis connection pools of the process, created lazily from the settings.
+
+A pool is configured by settings.REDIS_CONNECTIONS[name], either a dict of connection arguments (which can include
+max_connections, and the URL as "url") or a URL, and otherwise by the older per-purpose setting of that name,
+falling back to the default connection.
+"""
+import asyncio
+import os
+import threading
+import weakref
+from typing import Any, Optional, Union
+
+from django.conf import settings
+from redis import StrictRedis, ConnectionPool
+
+# The settings that configured each connection before the registry existed
+LEGACY_CONNECTION_SETTINGS = {
+    "default": "REDIS_CONNECTION",
+    "caching": "REDIS_CONNECTION_CACHING",
+    "session": "REDIS_CONNECTION_SESSION",
+    "logging": "REDIS_CONNECTION_LOGGING",
+    "throttling": "RATE_LIMITER_REDIS_URL",
+}
+
+DEFAULT_HEALTH_CHECK_INTERVAL = 30
+
+redis_pools: dict[str, ConnectionPool] = {}
+redis_clients: dict[str, StrictRedis] = {}
+# The asyncio pools are kept per event loop, since their connections can't be used from another loop
+async_redis_pools: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+redis_pools_lock = threading.Lock()
+stats_provider_registered = False
+
+
+def get_redis_connection_config(name: str) -> Union[str, dict[str, Any]]:
+    connection_configs = getattr(settings, "REDIS_CONNECTIONS", None) or {}
+    if name in connection_configs:
+        return connection_configs[name]
+    legacy_setting = LEGACY_CONNECTION_SETTINGS.get(name)
+    if legacy_setting is not None and getattr(settings, legacy_setting, None):
+        return getattr(settings, legacy_setting)
+    if name != "default":
+        return get_redis_connection_config("default")
+    return settings.REDIS_CONNECTION
+
+
+def get_redis_pool_arguments(name: str) -> tuple[Optional[str], dict[str, Any]]:
+    """
+    :return: The URL of the connection, if it's configured by one, and the other connection arguments
+    """
+    config = get_redis_connection_config(name)
+    if isinstance(config, str):
+        url, connection_arguments = config, {}
+    else:
+        connection_arguments = dict(config)
+        url = connection_arguments.pop("url", None)
+    connection_arguments.setdefault("health_check_interval", DEFAULT_HEALTH_CHECK_INTERVAL)
+    return url, connection_arguments
+
+
+def create_redis_pool(name: str, pool_class=ConnectionPool):
+    url, connection_arguments = get_redis_pool_arguments(name)
+    if url is not None:
+        return pool_class.from_url(url, **connection_arguments)
+    return pool_class(**connection_arguments)
+
+
+def get_redis_pool(name: str = "default") -> ConnectionPool:
+    pool = redis_pools.get(name)
+    if pool is None:
+        with redis_pools_lock:
+            pool = redis_pools.get(name)
+            if pool is None:
+                pool = redis_pools[name] = create_redis_pool(name)
+        register_stats_provider()
+    return pool
+
+
+def get_redis(name: str = "default") -> StrictRedis:
+    """
+    :return: A client for the named connection, shared by the whole process
+    """
+    client = redis_clients.get(name)
+    if client is None:
+        client = redis_clients.setdefault(name, StrictRedis(connection_pool=get_redis_pool(name)))
+    return client
+
+
+def get_async_redis_pool(name: str = "default"):
+    """
+    :return: The asyncio pool for the named connection of the running event loop, so it must be called from a coroutine
+    """
+    loop = asyncio.get_running_loop()
+    loop_pools = async_redis_pools.get(loop)
+    if loop_pools is None:
+        with redis_pools_lock:
+            loop_pools = async_redis_pools.setdefault(loop, {})
+    # Only the thread running the loop uses its pools
+    pool = loop_pools.get(name)
+    if pool is None:
+        from redis.asyncio import ConnectionPool as AsyncConnectionPool
+
+        pool = loop_pools[name] = create_redis_pool(name, AsyncConnectionPool)
+    return pool
+
+
+def get_redis_pool_stats() -> dict[str, Any]:
+    with redis_pools_lock:
+        pools = list(redis_pools.items())
+    stats = {}
+    for name, pool in pools:
+        # redis-py doesn't expose these publicly
+        num_in_use = len(getattr(pool, "_in_use_connections", ()))
+        max_connections = pool.max_connections
+        stats[name] = {
+            "numCreated": getattr(pool, "_created_connections", 0),
+            "numAvailable": len(getattr(pool, "_available_connections", ())),
+            "numInUse": num_in_use,
+            "maxConnections": max_connections,
+            "utilization": num_in_use / max_connections if max_connections else 0.0,
+        }
+    return stats
+
+
+def register_stats_provider():
+    global stats_provider_registered
+    if stats_provider_registered:
+        return
+    stats_provider_registered = True
+    from establishment.services.status import ServiceStatus
+
+    ServiceStatus.add_stats_provider("redisPools", get_redis_pool_stats)
+
+
+def reset_redis_pools_after_fork():
+    """
+    The child must not use the sockets of the parent. The pools are reset in place, rather than dropped,
+    since clients created before the fork keep referencing them.
+    """
+    global redis_pools_lock
+    redis_pools_lock = threading.Lock()
+    for pool in redis_pools.values():
+        pool.reset()
+    # Asyncio pools belong to the event loops of the parent
+    async_redis_pools.clear()
+
+
+os.register_at_fork(after_in_child=reset_redis_pools_after_fork)
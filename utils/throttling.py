@@ -1,15 +1,85 @@
+import threading
 import time
 import uuid
 from enum import Enum
 from typing import Union, Optional, Any
 
-import redis.lock
 from django.conf import settings
+from redis.commands.core import Script
 
 from establishment.utils.logging import logger
+from establishment.utils.redis_connections import get_redis
 
-throttling_redis_client = redis.Redis.from_url(settings.RATE_LIMITER_REDIS_URL)
 BUCKET_KEY_FORMAT = "throttle-{scope}-{duration}-{identity}-{timestamp}"  # TODO @cleanup rename this field
+LOCAL_THROTTLE_STATE_MAX_SIZE = 16 * 1024
+throttle_script: Optional[Script] = None
+
+
+# Checks all the windows of a throttle with the sliding window approximation, where the count of the previous
+# fixed window is weighted by how much of it still overlaps the sliding window. If all of them have room, counts the
+# request in each of them and tries to also reserve extra requests, to be spent in process without asking redis.
+# KEYS: the current and previous window buckets of each rate
+# ARGV: number of requests to reserve, then for each rate: max requests, duration, seconds elapsed in the current window
+# Returns the number of requests counted, or 0 and the number of seconds to wait until a request would be allowed
+THROTTLE_SCRIPT = """
+local reserve = tonumber(ARGV[1])
+local retry_after = 0
+for i = 1, #KEYS / 2 do
+    local max_requests = tonumber(ARGV[3 * i - 1])
+    local duration = tonumber(ARGV[3 * i])
+    local elapsed = tonumber(ARGV[3 * i + 1])
+    local current = tonumber(redis.call("GET", KEYS[2 * i - 1]) or "0")
+    local previous = tonumber(redis.call("GET", KEYS[2 * i]) or "0")
+    local available = max_requests - current - previous * (duration - elapsed) / duration
+    if available < 1 then
+        local wait
+        if current + 1 <= max_requests then
+            wait = duration * (1 - (max_requests - current - 1) / previous) - elapsed
+        else
+            wait = duration - elapsed + duration * (1 - (max_requests - 1) / current)
+        end
+        retry_after = math.max(retry_after, wait)
+    else
+        reserve = math.min(reserve, math.floor(available))
+    end
+end
+if retry_after > 0 then
+    return {0, tostring(retry_after)}
+end
+for i = 1, #KEYS / 2 do
+    redis.call("INCRBY", KEYS[2 * i - 1], reserve)
+    redis.call("EXPIRE", KEYS[2 * i - 1], 2 * tonumber(ARGV[3 * i]))
+end
+return {reserve, "0"}
+"""
+
+
+# Sliding window log for each of the actions, as a sorted set of the action timestamps.
+# The actions are only recorded if none of them hit its limit.
+# KEYS: the key of each action
+# ARGV: current timestamp, unique member, then for each action: max count, duration
+# Returns 1 if the actions should be throttled
+ACTION_THROTTLE_SCRIPT = """
+local timestamp = tonumber(ARGV[1])
+for i = 1, #KEYS do
+    redis.call("ZREMRANGEBYSCORE", KEYS[i], "-inf", timestamp - tonumber(ARGV[2 * i + 2]))
+    if redis.call("ZCARD", KEYS[i]) >= tonumber(ARGV[2 * i + 1]) then
+        return 1
+    end
+end
+for i = 1, #KEYS do
+    redis.call("ZADD", KEYS[i], "NX", timestamp, ARGV[2])
+    redis.call("EXPIRE", KEYS[i], ARGV[2 * i + 2])
+end
+return 0
+"""
+
+
+def get_throttle_script() -> Script:
+    global throttle_script
+    if throttle_script is None:
+        throttle_script = get_redis("throttling").register_script(THROTTLE_SCRIPT)
+    return throttle_script
 
 
 def parse_rate(rate: str) -> tuple[int, int]:
@@ -49,32 +119,81 @@ class Throttle(Enum):
             rates = rates_list
         self.rates = rates
         self.scope = scope or self.name or str(rates)
+        # How many requests to reserve from redis at once, to be spent in process. Off by default, since it makes
+        # the limits per process less precise, as a process can hold on to requests that another one needs.
+        self.local_allowance = 0
+        # Per identity, the requests reserved in process, until when they can be spent, and until when we're throttled
+        self.local_state: dict[str, tuple[int, float, float]] = {}
+        self.local_state_lock = threading.Lock()
 
-    def throttle_request(self, identity: str) -> bool:
-        timestamp = int(time.time())
+    def set_local_allowance(self, local_allowance: int):
+        self.local_allowance = local_allowance
+
+    def check_local_state(self, identity: str, timestamp: float) -> Optional[float]:
+        """
+        :return: The retry after if the request can be decided in process, None if redis needs to be asked
+        """
+        with self.local_state_lock:
+            local_state = self.local_state.get(identity)
+            if local_state is None:
+                return None
+            num_reserved, reserved_until, throttled_until = local_state
+            if timestamp < throttled_until:
+                return throttled_until - timestamp
+            if num_reserved > 0 and timestamp < reserved_until:
+                self.local_state[identity] = (num_reserved - 1, reserved_until, 0)
+                return 0
+            del self.local_state[identity]
+        return None
+
+    def update_local_state(self, identity: str, num_reserved: int, reserved_until: float, throttled_until: float):
+        with self.local_state_lock:
+            if len(self.local_state) >= LOCAL_THROTTLE_STATE_MAX_SIZE:
+                self.local_state.clear()
+            self.local_state[identity] = (num_reserved, reserved_until, throttled_until)
+
+    def get_retry_after(self, identity: str) -> float:
+        """
+        Count the request against all the rates, in a single round trip
+        :return: 0 if the request is allowed, otherwise how many seconds to wait until it would be
+        """
+        timestamp = time.time()
+        local_retry_after = self.check_local_state(identity, timestamp)
+        if local_retry_after is not None:
+            return local_retry_after
+
+        keys = []
+        args = [max(self.local_allowance, 1)]
         for max_num_requests, duration in self.rates:
-            bucket_key = BUCKET_KEY_FORMAT.format(
-                scope=self.scope,
-                duration=duration,
-                identity=identity,
-                timestamp=int(timestamp / duration) * duration,  # The start of the window
-            )
-
-            try:
-                multi = throttling_redis_client.pipeline()
-                multi.incr(bucket_key)
-                multi.expire(bucket_key, duration)
-                num_requests = multi.execute()[0]
-            except Exception as e:
-                # TODO: this error should probably be silently throttled if our Redis server ever dies :)
-                # TODO: so if we ever lose our Redis every request is rejected because of throttling?
-                logger.error("Failed to update throttle bucket {}: {}".format(bucket_key, str(e)))
-                return False
-
-            if num_requests > max_num_requests:
-                return True
+            window_start = int(timestamp / duration) * duration
+            for bucket_start in (window_start, window_start - duration):
+                keys.append(BUCKET_KEY_FORMAT.format(
+                    scope=self.scope,
+                    duration=duration,
+                    identity=identity,
+                    timestamp=bucket_start,
+                ))
+            args += [max_num_requests, duration, timestamp - window_start]
 
-        return False
+        try:
+            num_counted, retry_after = get_throttle_script()(keys=keys, args=args)
+        except Exception as e:
+            # TODO: this error should probably be silently throttled if our Redis server ever dies :)
+            logger.error("Failed to update throttle buckets {}: {}".format(keys, str(e)))
+            return 0
+
+        retry_after = float(retry_after)
+        if retry_after > 0:
+            # Rejections are remembered, there's no point in asking redis again until then
+            self.update_local_state(identity, 0, 0, timestamp + retry_after)
+        elif num_counted > 1:
+            # The reserved requests can only be spent in the current window of all the rates
+            reserved_until = min((int(timestamp / duration) + 1) * duration for _, duration in self.rates)
+            self.update_local_state(identity, num_counted - 1, reserved_until, 0)
+        return retry_after
+
+    def throttle_request(self, identity: str) -> bool:
+        return self.get_retry_after(identity) > 0
 
     def to_json(self) -> dict[str, Any]:
         return {
@@ -85,39 +204,47 @@ class Throttle(Enum):
 
 # TODO: this shouldn't be completely independent of the method above
 class ActionThrottler:
+    script: Optional[Script] = None
+
+    @classmethod
+    def get_script(cls) -> Script:
+        if cls.script is None:
+            cls.script = get_redis("throttling").register_script(ACTION_THROTTLE_SCRIPT)
+        return cls.script
+
     def should_throttle(self, owner: str, action: str, rate: str) -> bool:
+        return self.should_throttle_many(owner, [(action, rate)])
+
+    def should_throttle_many(self, owner: str, actions: list[tuple[str, str]]) -> bool:
+        """
+        Check several actions of the owner at once, in a single round trip
+        :param actions: A list of (action, rate) pairs
+        :return: True if any of the actions should be throttled, in which case none of them is counted
+        """
         if settings.DISABLE_THROTTLING:
             return False
 
-        key = self.compute_key(owner, action)
-        max_count, duration = parse_rate(rate)
-        timestamp = int(time.time())
+        keys = []
+        args = [int(time.time()), uuid.uuid4().hex]
+        for action, rate in actions:
+            max_count, duration = parse_rate(rate)
+            keys.append(self.compute_key(owner, action))
+            args += [max_count, duration]
 
         try:
-            with self.lock(key):
-                throttling_redis_client.zremrangebyscore(key, "-inf", timestamp - duration)
-                if throttling_redis_client.zcard(key) >= max_count:
-                    return True
-                p = throttling_redis_client.pipeline()
-                p.zadd(key, {uuid.uuid4().hex: timestamp}, nx=True)
-                p.expire(key, duration)
-                p.execute()
+            return self.get_script()(keys=keys, args=args) == 1
         except Exception as e:
-            logger.error(f"Failed to update throttle key {key}", exc_info=e)
+            logger.error(f"Failed to update throttle keys {keys}", exc_info=e)
 
         return False
 
     def reset_throttle(self, owner: str, action: str):
         key = self.compute_key(owner, action)
         try:
-            with self.lock(key):
-                throttling_redis_client.delete(key)
+            get_redis("throttling").delete(key)
         except Exception as e:
             logger.error(f"Failed to delete key {key}", exc_info=e)
 
-    def lock(self, key: str) -> redis.lock.Lock:
-        return throttling_redis_client.lock(f"{key}-lock", timeout=2, blocking_timeout=2)
-
     def compute_key(self, owner: str, action: str) -> str:
         return f"action-throttle-{action}-{owner}"
 
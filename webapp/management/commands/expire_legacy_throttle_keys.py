@@ -0,0 +1,13 @@
+from django.core.management import BaseCommand
+
+from establishment.webapp.throttle import ActionThrottler
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("--max-timeframe", type=int, default=24 * 60 * 60,
+                            help="The longest throttler timeframe in use, in seconds")
+
+    def handle(self, *args, **options):
+        num_updated = ActionThrottler.expire_legacy_keys(max_timeframe=options["max_timeframe"])
+        self.stdout.write("Updated " + str(num_updated) + " throttle keys")
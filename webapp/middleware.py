@@ -1,3 +1,4 @@
+from establishment.funnel.redis_stream import RedisStreamPublishBatch
 from establishment.utils.http.request import is_ajax
 from establishment.webapp.base_views import JSONResponse
 
@@ -19,6 +20,16 @@ class ProcessResponseMiddleware(object):
         return None
 
 
+# Middleware that sends all the stream events published while handling a request in a single flush
+class RedisStreamPublishBatchMiddleware(object):
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with RedisStreamPublishBatch():
+            return self.get_response(request)
+
+
 from .base_views import get_remote_ip
 
 
@@ -0,0 +1,34 @@
+import time
+import uuid
+
+from django.test import SimpleTestCase
+
+from establishment.utils.redis_connections import get_redis
+from establishment.webapp.throttle import ActionThrottler
+
+
+class ActionThrottlerTest(SimpleTestCase):
+    def setUp(self):
+        self.name = "test-action-" + uuid.uuid4().hex
+
+    def tearDown(self):
+        get_redis().delete("throttle-" + self.name)
+
+    def test_limit(self):
+        throttler = ActionThrottler(self.name, 60, 3)
+        self.assertEqual([throttler.increm() for index in range(4)], [True, True, True, False])
+        self.assertTrue(ActionThrottler(self.name, 60, 4).increm(just_check=True))
+
+    def test_existing_actions_are_counted(self):
+        # Lists written before the throttlers had an expiry keep counting, under the same key
+        get_redis().rpush("throttle-" + self.name, str(time.time() - 100), str(time.time()), str(time.time()))
+        self.assertEqual(get_redis().ttl("throttle-" + self.name), -1)
+        self.assertFalse(ActionThrottler(self.name, 60, 2).increm())
+        self.assertTrue(ActionThrottler(self.name, 60, 3).increm())
+        self.assertEqual(get_redis().llen("throttle-" + self.name), 3)
+        self.assertGreater(get_redis().ttl("throttle-" + self.name), 0)
+
+    def test_expiry_covers_longest_timeframe(self):
+        self.assertTrue(ActionThrottler(self.name, 3600, 10).increm())
+        self.assertTrue(ActionThrottler(self.name, 60, 10).increm())
+        self.assertGreater(get_redis().ttl("throttle-" + self.name), 60)
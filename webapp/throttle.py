@@ -1,15 +1,67 @@
-from redis import StrictRedis
+import math
 import time
-from django.conf import settings
-
-redis_connection = StrictRedis(**settings.REDIS_CONNECTION)
+from typing import Optional
+
+from redis.commands.core import Script
+
+from establishment.utils.redis_connections import get_redis
+
+# Checks a list of throttlers and, if none of them is over its limit, counts the action in all of them.
+# Throttlers keep the timestamps of the actions in a list, except the ones with a limit of 1 which just use a string key.
+# KEYS: the key of each throttler
+# ARGV: current timestamp, just check (1 or 0), then for each throttler: limit, timeframe in seconds
+# Returns 1 if the action is allowed
+THROTTLE_INCREM_SCRIPT = """
+local timestamp = tonumber(ARGV[1])
+for i = 1, #KEYS do
+    local limit = tonumber(ARGV[2 * i + 1])
+    local timeframe = tonumber(ARGV[2 * i + 2])
+    local key_type = redis.call("TYPE", KEYS[i]).ok
+    local count = 0
+    if key_type == "list" then
+        local oldest = redis.call("LINDEX", KEYS[i], 0)
+        while oldest and tonumber(oldest) + timeframe < timestamp do
+            redis.call("LPOP", KEYS[i])
+            oldest = redis.call("LINDEX", KEYS[i], 0)
+        end
+        count = redis.call("LLEN", KEYS[i])
+    elseif key_type ~= "none" then
+        count = 1
+    end
+    if count >= limit then
+        return 0
+    end
+end
+if ARGV[2] == "1" then
+    return 1
+end
+for i = 1, #KEYS do
+    local limit = tonumber(ARGV[2 * i + 1])
+    local timeframe = tonumber(ARGV[2 * i + 2])
+    if limit == 1 then
+        redis.call("SET", KEYS[i], "true", "EX", timeframe)
+    else
+        if redis.call("TYPE", KEYS[i]).ok ~= "list" then
+            redis.call("DEL", KEYS[i])
+        end
+        -- The check above already dropped the actions older than the timeframe, so the list stays within the limit
+        redis.call("RPUSH", KEYS[i], ARGV[1])
+        -- Throttlers of the same action can have different timeframes, the key lives as long as the longest one
+        if redis.call("TTL", KEYS[i]) < timeframe then
+            redis.call("EXPIRE", KEYS[i], timeframe)
+        end
+    end
+end
+return 1
+"""
 
 
 class ActionThrottler(object):
     """
     Class to support a generic way of throttling user generated action inside our system
     """
-    # TODO: support multiple filters and multiple timeframes
+    increm_script: Optional[Script] = None
+
     def __init__(self, name, timeframe, limit):
         """
         :param name: The global name of the action (ex. user-<userId>-change-profile)
@@ -20,39 +72,59 @@ class ActionThrottler(object):
         self.timeframe = timeframe
         self.limit = limit
 
-    def single_increm(self) -> bool:
-        if redis_connection.set(self.key_name, "true", self.timeframe, nx=True):
-            return True
-        return False
-
-    def increm(self, just_check=False):
-        if self.limit == 1:
-            return self.single_increm()
-
-        # TODO: this is a shitty implementation, works for now
-        first = redis_connection.lindex(self.key_name, 0)
-
-        # TODO: if length < limit, stop after a few pops
-        while first and float(first) + self.timeframe < time.time():
-            redis_connection.lpop(self.key_name)
-            first = redis_connection.lindex(self.key_name, 0)
-
-        if redis_connection.llen(self.key_name) >= self.limit:
-            return False
+    @classmethod
+    def get_increm_script(cls) -> Script:
+        if cls.increm_script is None:
+            cls.increm_script = get_redis().register_script(THROTTLE_INCREM_SCRIPT)
+        return cls.increm_script
 
-        if just_check:
-            return True
+    @classmethod
+    def increm_many(cls, throttlers: list["ActionThrottler"], just_check=False, client=None):
+        """
+        Check several throttlers of the same action at once (ex. per user and per IP), in a single round trip.
+        The action is only counted if none of them is over its limit.
+        :param client: A pipeline can be passed, in which case the result is in its response
+        :return: True if the action is allowed
+        """
+        args = [str(time.time()), "1" if just_check else "0"]
+        for throttler in throttlers:
+            args += [throttler.limit, int(math.ceil(throttler.timeframe))]
+        result = cls.get_increm_script()(keys=[throttler.key_name for throttler in throttlers], args=args,
+                                         client=client or get_redis())
+        if client is not None:
+            return result
+        return result == 1
 
-        redis_connection.rpush(self.key_name, str(time.time()))
-        # TODO: set expire to self.key_name in timeframe
-        return True
+    def increm(self, just_check=False):
+        return self.increm_many([self], just_check=just_check)
 
     def increm_or_raise(self, error):
         if not self.increm():
             raise error
 
     def clear(self):
-        redis_connection.delete(self.key_name)
+        get_redis().delete(self.key_name)
+
+    @staticmethod
+    def expire_legacy_keys(max_timeframe: int = 24 * 60 * 60, scan_count: int = 1000) -> int:
+        """
+        Throttler lists used to be created without an expiry, so they were never removed. Give them one, based on
+        their last action and the longest timeframe in use, or delete them if that already passed.
+        :return: The number of keys updated
+        """
+        num_updated = 0
+        current_timestamp = time.time()
+        for key in get_redis().scan_iter(match="throttle-*", count=scan_count, _type="LIST"):
+            if get_redis().ttl(key) != -1:
+                continue
+            last_timestamp = get_redis().lindex(key, -1)
+            remaining_time = int(float(last_timestamp) + max_timeframe - current_timestamp) if last_timestamp else 0
+            if remaining_time > 0:
+                get_redis().expire(key, remaining_time)
+            else:
+                get_redis().delete(key)
+            num_updated += 1
+        return num_updated
 
     @classmethod  # type: ignore[no-redef]
     def increm_or_raise(cls, error, timeframe, limit):